@@ -1,21 +1,37 @@
 from __future__ import print_function
 from wsgiref.handlers import format_date_time
-from datetime import datetime
-from datetime import timedelta
-from time import mktime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qsl, unquote
 from hashlib import sha1
 from hashlib import md5
 
 import sys
+import argparse
+import re
 import requests
 import json
 import base64
 import io
 import hmac
 import time
-import codecs
+import random
 import warnings
 import traceback
+import threading
+import queue
+import asyncio
+import sqlite3
+import math
+import os
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
 warnings.filterwarnings("ignore")
 
 #=== Description ===
@@ -51,6 +67,7 @@ config = {
     'redlock_password': <password>,
     'redlock_tenant': <customer name>,
     'redlock_api_base': 'https://api.redlock.io',
+    'evident_api_base': 'https://api.evident.io',
     'evident_public_key': <public key>,
     'evident_secret_key': <secret key>,
 
@@ -91,17 +108,113 @@ config = {
     # -- Overwrite existing Alert Rules with their associated Cloud Account
     'overwrite_alert_rules': True,
 
-    # Refresh RedLock session token timer (in minutes)
-    'refresh_in': 4
+    # Refresh RedLock session token timer (in minutes).  The token is extended in the background
+    # once it is 3/4 of this old, requests only wait for a refresh when that did not happen in time
+    'refresh_in': 4,
+
+    # HTTP connection pooling, shared by every Evident and RedLock call
+    # -- Number of per-host connection pools to keep
+    'pool_connections': 10,
+    # -- Max keep-alive connections per host
+    'pool_maxsize': 20,
+    # -- Block when the per-host limit is reached instead of opening extra connections
+    'pool_block': True,
+
+    # Fetch Evident relationship pages concurrently (e.g. each Team's External Accounts)
+    'concurrent_collection': True,
+    # -- Number of worker threads used for concurrent Evident requests
+    'ev_max_workers': 10,
+    # -- Max Evident requests in flight at once, across all workers
+    'ev_max_in_flight': 20,
+    # -- Print a progress line every N External Accounts
+    'progress_every': 100,
+    # Side-load related records (include=credentials,team,...) instead of following every relationship link
+    'ev_include': True,
+    # Request the next page of an Evident listing while the current page is being processed
+    'ev_prefetch': True,
+    # Request every page of an Evident listing at once when the first page links to the last one
+    'ev_parallel_pages': True,
+
+    # Evident API rate limiting, shared by all workers
+    # -- Starting (and maximum) request rate, in requests per second.  Halved on every rate limit hit
+    'ev_rate_limit': 10,
+    # -- Max requests that can be sent in a burst
+    'ev_rate_burst': 20,
+    # -- Retries per request before giving up
+    'ev_max_retries': 5,
+    # -- Base and max back-off between retries (in seconds), randomized with jitter
+    'ev_backoff_base': 2,
+    'ev_backoff_max': 120,
+
+    # On-disk cache of Evident GET responses, so re-runs don't download the whole org again.
+    # Path of the cache file, e.g. 'evident_cache.sqlite', or None to disable
+    'ev_cache_path': None,
+    # -- Seconds a cached response is used without asking Evident; stale entries are revalidated (ETag/Last-Modified)
+    'ev_cache_ttl': 3600,
+    # -- Max size of the cache in MB, least recently used responses are evicted first
+    'ev_cache_max_mb': 512,
+
+    # RedLock API retries
+    # -- Retries per request before giving up
+    'rl_max_retries': 5,
+    # -- Total retries allowed for the whole run.  Once spent, failing requests are not retried
+    'rl_retry_budget': 200,
+    # -- Request timeout (in seconds), grows with every retry
+    'rl_timeout': 5,
+    # -- Base and max back-off between retries (in seconds), randomized with jitter
+    'rl_backoff_base': 1,
+    'rl_backoff_max': 60,
+
+    # Request telemetry.  Latency percentiles and totals per endpoint are printed at the end of the run
+    # -- Also write every request to this file as JSON Lines, e.g. 'asset_migrator_trace.jsonl', or None to disable
+    'telemetry_trace_path': None,
+
+    # Profiling.  Wall and CPU time of every migration phase are printed at the end of the run
+    # -- Profile each phase: None, 'sampling' (samples the stacks of every thread) or 'cprofile' (main thread only)
+    'profiler': None,
+    # -- Seconds between two samples of the sampling profiler
+    'profile_interval': 0.005,
+    # -- Directory the profiles are written to, one collapsed stack file (<phase>.collapsed) per phase
+    'profile_dir': 'asset_migrator_profiles',
+
+    # Collect Evident and RedLock data with asyncio instead of threads.  Requires aiohttp (pip3 install aiohttp)
+    # -- Collection only: RedLock creates, updates and deletes always run on the threaded write pipeline
+    'async_mode': False,
+    # -- Max requests in flight at once in async mode
+    'async_max_in_flight': 200,
+
+    # RedLock writes run in a pipeline: Account Groups, then User Roles, then Users, then Alert Rules
+    # -- Max planned writes waiting to run.  Planning pauses while the queue is full
+    'rl_write_queue_size': 100,
+    # -- Number of writes run in parallel, per resource type
+    'rl_write_workers': {
+        'account_group': 4,
+        'user_role': 4,
+        'user': 4,
+        'alert_rule': 8
+    },
+
+    # Save progress to this SQLite file (e.g. 'asset_migrator_checkpoint.sqlite'), so an interrupted
+    # run can be finished with --resume.  None (default) to not save anything
+    'checkpoint_path': None,
+
+    # Incremental re-runs: compare every planned object with the current RedLock one and only write
+    # the ones that changed.  Objects created by an earlier run and no longer planned are reported
+    'incremental': False,
+    # -- Delete those objects instead of only reporting them
+    'delete_stale': False
 }
 
 stats = {
     'alert_rule_count': 0,
-    'user_role_count': {}
+    'user_role_count': {},
+    'errors': []
 }
+stats_lock = threading.Lock()
+
+# Per-endpoint request telemetry, keyed by API ('evident' or 'redlock'), then by "METHOD /templated/path"
+endpoint_stats = {}
 
-redlock_token = ''
-token_created_at = None
 version = '1.6a'
 
 global_signature_ids = [
@@ -401,91 +514,635 @@ def convert_team_name(team_name):
 
 #=== End Helper Methods ===
 
+#=== HTTP Transport ===
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+# Global cap on concurrent Evident requests, shared by every worker
+ev_in_flight = threading.BoundedSemaphore(config['ev_max_in_flight'])
+
+# Return the shared keep-alive session for an API ('evident' or 'redlock')
+def get_session(api):
+    with sessions_lock:
+        if api not in sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=config['pool_connections'],
+                                  pool_maxsize=config['pool_maxsize'],
+                                  pool_block=config['pool_block'])
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            sessions[api] = session
+        return sessions[api]
+
+# Count connections opened and reused by each API's session
+def get_connection_stats():
+    connection_stats = {}
+    for api, session in sessions.items():
+        opened = 0
+        requests_sent = 0
+        # The same adapter is mounted for http:// and https://, count it once
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                requests_sent += pool.num_requests
+        connection_stats[api] = {'opened': opened, 'reused': max(requests_sent - opened, 0)}
+    return connection_stats
+
+# Thread-safe progress counter, prints the completion rate every `every` items
+class ProgressMeter(object):
+    def __init__(self, label, every):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def tick(self):
+        with self.lock:
+            self.count += 1
+            if self.every and self.count % self.every == 0:
+                self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.started_at, 0.000001)
+        print("-- %d %s retrieved (%.1f %s/sec)" % (self.count, self.label, self.count / elapsed, self.label))
+
+#=== End HTTP Transport ===
+
+#=== Rate Limiting ===
+
+# Raised when the Evident API returns an error or keeps failing after all retries
+class EvidentApiError(Exception):
+    def __init__(self, message, status=None):
+        super(EvidentApiError, self).__init__(message)
+        self.status = status
+
+# Helper method - exponential back-off with full jitter for the given retry attempt
+def get_backoff(attempt, base, maximum):
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+# Helper method - get the number of seconds to wait from a Retry-After header (seconds or HTTP date)
+def get_retry_after(headers):
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+# Token bucket shared by all workers calling an API.
+# The refill rate starts at `rate`, is halved whenever the server throttles us and creeps back up
+# on every successful request.  Retry-After and X-RateLimit-* headers pause the whole bucket,
+# so every worker waits instead of each one hitting the limit on its own.
+class RateLimiter(object):
+    def __init__(self, rate, burst, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Take a token if one is available.  Returns 0 on success, otherwise the seconds to wait before trying again
+    def reserve(self):
+        with self.lock:
+            now = time.time()
+            # The bucket stays empty while paused, it only starts refilling when the pause ends
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # Block until a request may be sent
+    def acquire(self):
+        wait = self.reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    # Stop all workers for `seconds`
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0
+            self.updated_at = self.paused_until
+
+    # Additive increase after a successful request
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 1 / max(self.rate, 1))
+
+    # Multiplicative decrease after being throttled, then wait out the server's Retry-After
+    def on_throttle(self, retry_after):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.pause(retry_after)
+
+    # Follow the server's advertised allowance, if it sends rate limit headers
+    def update_from_headers(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = float(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+        # Reset is either an epoch timestamp or a number of seconds
+        reset_in = reset - time.time() if reset > 1000000000 else reset
+        reset_in = max(reset_in, 0)
+        if remaining <= 0:
+            self.pause(reset_in)
+        elif reset_in > 0:
+            with self.lock:
+                self.rate = max(self.min_rate, min(self.max_rate, remaining / reset_in))
+
+ev_rate_limiter = RateLimiter(config['ev_rate_limit'], config['ev_rate_burst'])
+
+# Raised when a RedLock request cannot be completed
+class RedLockApiError(Exception):
+    def __init__(self, message, status=None):
+        super(RedLockApiError, self).__init__(message)
+        self.status = status
+
+# Statuses worth retrying: throttling, expired sessions and server-side failures
+rl_retry_statuses = [401, 408, 429, 500, 502, 503, 504]
+
+rl_retry_budget = {'remaining': config['rl_retry_budget']}
+rl_retry_budget_lock = threading.Lock()
+
+# Take one retry from the run-wide RedLock retry budget, False if it is spent
+def use_rl_retry():
+    with rl_retry_budget_lock:
+        if rl_retry_budget['remaining'] <= 0:
+            return False
+        rl_retry_budget['remaining'] -= 1
+        return True
+
+#=== End Rate Limiting ===
+
+#=== Telemetry ===
+# Every Evident and RedLock request (all of its retries included) is recorded once per API and
+# templated endpoint: status, response size, latency, retries and time spent waiting on rate
+# limits.  Latency percentiles and totals are printed at the end of the run, and with
+# telemetry_trace_path set each request is also written to that file as one JSON line.
+
+api_names = {'evident': 'Evident', 'redlock': 'RedLock'}
+
+# Upper bounds (in seconds) of the latency histogram buckets
+latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+endpoint_stats_lock = threading.Lock()
+telemetry_trace = {'file': None}
+
+# Helper method - templated endpoint for a request, IDs replaced with {id}
+# Example: PUT /cloud/group/1234 -> PUT /cloud/group/{id}
+def get_endpoint(action, url):
+    path = url.split('?')[0]
+    segments = []
+    for segment in path.split('/'):
+        # API versions (/api/v2) are not IDs
+        if re.search(r'[0-9@]', segment) and not re.match(r'v[0-9]+$', segment):
+            segment = '{id}'
+        segments.append(segment)
+    return '%s %s' % (action, '/'.join(segments))
+
+# Helper method - nearest-rank percentile of a sorted list
+def get_percentile(values, percent):
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+# Write one request to the trace file, opening it on first use.  Called with endpoint_stats_lock held
+def write_telemetry_trace(record):
+    if telemetry_trace['file'] is None:
+        telemetry_trace['file'] = open(config['telemetry_trace_path'], 'w')
+    telemetry_trace['file'].write(json.dumps(record) + '\n')
+
+def close_telemetry_trace():
+    with endpoint_stats_lock:
+        if telemetry_trace['file'] is not None:
+            telemetry_trace['file'].close()
+            telemetry_trace['file'] = None
+            print("Request trace written to %s." % config['telemetry_trace_path'])
+
+# Record one request in endpoint_stats.  status_code is None when it timed out
+def record_endpoint(api, action, url, status_code, size, latency, retries, rate_limit_wait):
+    endpoint = get_endpoint(action, url)
+    failed = status_code is None or status_code >= 400
+    with endpoint_stats_lock:
+        if endpoint not in endpoint_stats.setdefault(api, {}):
+            endpoint_stats[api][endpoint] = {'calls': 0, 'retries': 0, 'failures': 0, 'bytes': 0,
+                                             'rate_limit_wait': 0.0, 'statuses': {}, 'latencies': []}
+        counters = endpoint_stats[api][endpoint]
+        counters['calls'] += 1
+        counters['retries'] += retries
+        counters['failures'] += 1 if failed else 0
+        counters['bytes'] += size
+        counters['rate_limit_wait'] += rate_limit_wait
+        status = str(status_code) if status_code is not None else 'timeout'
+        counters['statuses'][status] = counters['statuses'].get(status, 0) + 1
+        counters['latencies'].append(latency)
+
+        if config['telemetry_trace_path']:
+            write_telemetry_trace({
+                'time': round(time.time() - latency, 6),
+                'api': api,
+                'endpoint': endpoint,
+                'url': url,
+                'status': status_code,
+                'bytes': size,
+                'latency': round(latency, 6),
+                'retries': retries,
+                'rate_limit_wait': round(rate_limit_wait, 6)
+            })
+
+# Print endpoint_stats per API, slowest endpoints first, then the API's totals and latency histogram
+def print_endpoint_stats():
+    for api in sorted(endpoint_stats):
+        print("%s API requests per endpoint:" % api_names.get(api, api))
+        all_latencies = []
+        totals = {'calls': 0, 'retries': 0, 'failures': 0, 'bytes': 0, 'rate_limit_wait': 0.0}
+        for endpoint, counters in sorted(endpoint_stats[api].items(), key=lambda item: -sum(item[1]['latencies'])):
+            latencies = sorted(counters['latencies'])
+            all_latencies.extend(latencies)
+            for total in totals:
+                totals[total] += counters[total]
+            print("-- %s: %d calls, %d retries, %d failures, %.1f KB, p50 %.3fs, p95 %.3fs, p99 %.3fs, max %.3fs, rate limit waits %.1fs" % (
+                endpoint, counters['calls'], counters['retries'], counters['failures'], counters['bytes'] / 1024.0,
+                get_percentile(latencies, 50), get_percentile(latencies, 95), get_percentile(latencies, 99),
+                latencies[-1], counters['rate_limit_wait']))
+
+        all_latencies.sort()
+        print("-- Total: %d calls, %d retries, %d failures, %.1f MB, %.1fs in requests, p50 %.3fs, p95 %.3fs, p99 %.3fs, rate limit waits %.1fs" % (
+            totals['calls'], totals['retries'], totals['failures'], totals['bytes'] / 1048576.0, sum(all_latencies),
+            get_percentile(all_latencies, 50), get_percentile(all_latencies, 95), get_percentile(all_latencies, 99),
+            totals['rate_limit_wait']))
+        histogram = []
+        lower = 0
+        for upper in latency_buckets + [None]:
+            count = len([latency for latency in all_latencies if latency >= lower and (upper is None or latency < upper)])
+            if count:
+                label = '<%gs' % upper if upper is not None else '>=%gs' % lower
+                histogram.append('%s: %d' % (label, count))
+            lower = upper
+        print("-- Latency histogram: %s" % ', '.join(histogram))
+
+#=== End Telemetry ===
+
+#=== Response Cache ===
+
+# SQLite-backed cache of API responses, keyed by canonical URL, with LRU eviction by total size
+class ResponseCache(object):
+    def __init__(self, path, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body TEXT, etag TEXT, '
+                        'last_modified TEXT, stored_at REAL, accessed_at REAL, size INTEGER)')
+        self.db.commit()
+
+    # Return the cached entry for `url` as a dict (with a `fresh` flag), or None
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (now, url))
+            self.db.commit()
+        return {'body': row[0], 'etag': row[1], 'last_modified': row[2], 'fresh': now - row[3] < self.ttl}
+
+    def put(self, url, body, etag, last_modified):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (url, body, etag, last_modified, now, now, len(body)))
+            self.evict()
+            self.db.commit()
+
+    # Entry was revalidated by the server, restart its TTL
+    def refresh(self, url):
+        now = time.time()
+        with self.lock:
+            self.db.execute('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+            self.db.commit()
+
+    # Drop least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY accessed_at').fetchall():
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+ev_cache = None
+ev_cache_lock = threading.Lock()
+
+# Return the Evident response cache, or None if ev_cache_path is not set
+def get_ev_cache():
+    global ev_cache
+
+    if not config['ev_cache_path']:
+        return None
+    with ev_cache_lock:
+        if ev_cache is None:
+            ev_cache = ResponseCache(config['ev_cache_path'], config['ev_cache_ttl'], config['ev_cache_max_mb'] * 1024 * 1024)
+        return ev_cache
+
+# Helper method - cache key for an Evident request path
+# Query parameters are decoded and sorted, so page%5Bsize%5D=100&include=x and include=x&page[size]=100
+# share an entry.  The key is scoped to the API key, so different organizations never share responses.
+def get_ev_cache_key(url):
+    parts = urlsplit(url)
+    params = sorted(parse_qsl(parts.query, keep_blank_values=True))
+    query = '&'.join('%s=%s' % (unquote(key), unquote(value)) for key, value in params)
+    return '%s:%s?%s' % (config['evident_public_key'], parts.path, query)
+
+# Look up an Evident GET in the response cache.  Returns (result, headers): result is the cached
+# JSON while it is fresh, otherwise headers holds the conditional request headers to revalidate it.
+def get_ev_cached(action, url):
+    cache = get_ev_cache()
+    if action != 'GET' or cache is None:
+        return None, {}
+    entry = cache.get(get_ev_cache_key(url))
+    if entry is None:
+        return None, {}
+    if entry['fresh']:
+        return json.loads(entry['body']), {}
+
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return None, headers
+
+# The server confirmed a stale entry with 304 Not Modified, reuse it.  Returns None when the entry
+# was evicted since it was looked up, the request has to be sent again without conditional headers.
+def revalidate_ev_cache(url):
+    cache = get_ev_cache()
+    key = get_ev_cache_key(url)
+    cache.refresh(key)
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    return json.loads(entry['body'])
+
+# Store a successful Evident GET response
+def store_ev_cache(action, url, status_code, headers, text, result):
+    cache = get_ev_cache()
+    if action != 'GET' or cache is None or status_code != 200 or not isinstance(result, dict):
+        return
+    cache.put(get_ev_cache_key(url), text, headers.get('ETag'), headers.get('Last-Modified'))
+
+#=== End Response Cache ===
+
+#=== Checkpoint ===
+# Progress is saved to checkpoint_path as the run goes: every Evident collection and every
+# completed RedLock write.  With --resume, an interrupted run reuses the collections and skips
+# the writes already done.  A run without --resume starts a new checkpoint.
+
+# SQLite-backed record of a run's Evident collections and completed writes.  Writes are keyed by
+# a hash of the planned write, so a write planned differently on resume runs again.
+class MigrationCheckpoint(object):
+    def __init__(self, path, resume):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS collections (step TEXT PRIMARY KEY, data TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS writes (op_key TEXT PRIMARY KEY, type TEXT, name TEXT, outcome TEXT)')
+        if not resume:
+            self.db.execute('DELETE FROM collections')
+            self.db.execute('DELETE FROM writes')
+        self.db.commit()
+
+    # Saved result of a collection step, or None
+    def get_collection(self, step):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM collections WHERE step = ?', (step,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put_collection(self, step, data):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO collections VALUES (?, ?)', (step, json.dumps(data)))
+            self.db.commit()
+
+    def get_op_key(self, op):
+        return sha1(json.dumps(op, sort_keys=True).encode('UTF-8')).hexdigest()
+
+    # Whether a planned write was completed by an earlier attempt of this run
+    def is_done(self, op):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM writes WHERE op_key = ?', (self.get_op_key(op),)).fetchone()
+        return row is not None
+
+    def done(self, op, outcome):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?)', (self.get_op_key(op), op['type'], op['name'], outcome))
+            self.db.commit()
+
+migration_checkpoint = None
+
+# Open the checkpoint of this run, unless checkpoint_path is not set
+def open_checkpoint(resume):
+    global migration_checkpoint
+
+    migration_checkpoint = None
+    if config['checkpoint_path']:
+        migration_checkpoint = MigrationCheckpoint(config['checkpoint_path'], resume)
+
+# Helper method - checkpoint key of a collection step, e.g. ev_external_accounts:["detailed"]
+def get_checkpoint_step(name, step):
+    return '%s:%s' % (name, json.dumps(step[1:]))
+
+# Saved Evident collection for a collect() step, or None.  RedLock collections are never
+# reused, they change with the writes of the interrupted run.
+def get_checkpointed_collection(name, step):
+    if migration_checkpoint is None or not name.startswith('ev_'):
+        return None
+    return migration_checkpoint.get_collection(get_checkpoint_step(name, step))
+
+def checkpoint_collection(name, step, data):
+    if migration_checkpoint is not None and name.startswith('ev_'):
+        migration_checkpoint.put_collection(get_checkpoint_step(name, step), data)
+
+#=== End Checkpoint ===
+
 #=== Evident Methods ===
 
-def call_ev_api(action, url, data, count = 0):
+# Signs Evident requests with APIAuth.  The keyed HMAC is set up once and copied for every request,
+# the Content-MD5 of an empty body (every GET) is computed once and the Date header is only formatted
+# again when the second changes.  Signing never blocks, so the threads and the async client share it.
+class EvidentSigner(object):
+    def __init__(self, public_key, secret_key):
+        self.public_key = public_key
+        # An unset key (None) signs with an empty one, which Evident rejects
+        self.hmac = hmac.new(bytes(secret_key or '', 'UTF-8'), digestmod=sha1)
+        self.empty_md5 = str(base64.b64encode(md5(b'').digest()), 'UTF-8')
+        self.date = (None, None)
+
+    # Base64 MD5 digest of a request body
+    def get_content_md5(self, data):
+        if not data:
+            return self.empty_md5
+        return str(base64.b64encode(md5(data.encode('UTF-8')).digest()), 'UTF-8')
+
+    # HTTP date of the current second.  The (second, header) pair is replaced as a whole, so
+    # concurrent callers never see a header of another second.
+    def get_date(self):
+        now = int(time.time())
+        stamp, dated = self.date
+        if stamp != now:
+            dated = format_date_time(now)
+            self.date = (now, dated)
+        return dated
+
+    # Build the signed APIAuth headers for an Evident request
+    def get_headers(self, action, url, data):
+        data_hash = self.get_content_md5(data)
+        dated = self.get_date()
+
+        # Create Authorization Header
+        canonical = '%s,application/vnd.api+json,%s,%s,%s' % (action, data_hash, url, dated)
+        hashed = self.hmac.copy()
+        hashed.update(canonical.encode('UTF-8'))
+        auth = str(base64.b64encode(hashed.digest()), 'UTF-8')
+        return {'Date': dated,
+                'Content-MD5': data_hash,
+                'Content-Type': 'application/vnd.api+json',
+                'Accept': 'application/vnd.api+json',
+                'Authorization': 'APIAuth %s:%s' % (self.public_key, auth)}
+
+ev_signer = EvidentSigner(config['evident_public_key'], config['evident_secret_key'])
+
+# Build the signed APIAuth headers for an Evident request
+def get_ev_headers(action, url, data):
+    return ev_signer.get_headers(action, url, data)
+
+# Helper method - get the request path and full Evident URL for a (possibly absolute) link
+def get_ev_url(url):
     # If URL already contains domain, need to remove
-    if "https://api.evident.io" in url or "https://esp.evident.io" in url:
-        url = url[22:]
+    if url.startswith('https://') or url.startswith('http://'):
+        parts = urlsplit(url)
+        url = parts.path
+        if parts.query:
+            url = '%s?%s' % (url, parts.query)
     
     # Construct ESP API URL
-    ev_create_url = 'https://api.evident.io%s' % (url)
-    
-    # Create md5 hash of body
-    hex = md5(data.encode('UTF-8')).hexdigest()
-    data_hash = codecs.encode(codecs.decode(hex, 'hex'),
-                         'base64').decode().rstrip('\n')
-    
-    # Find Time
-    now = datetime.now()
-    stamp = mktime(now.timetuple())
-    dated = format_date_time(stamp)
-    
-    # Create Authorization Header
-    canonical = '%s,application/vnd.api+json,%s,%s,%s' % (action, data_hash, url, dated)
-    key_bytes= bytes(config['evident_secret_key'], 'UTF-8')
-    data_bytes= bytes(canonical, 'UTF-8')
-
-    hashed = hmac.new(key_bytes, data_bytes, sha1)
-    auth = str(base64.b64encode(hashed.digest()), 'UTF-8')
-    headers = {'Date': '%s' % dated,
-               'Content-MD5': '%s' % data_hash,
-               'Content-Type': 'application/vnd.api+json',
-               'Accept': 'application/vnd.api+json',
-               'Authorization': 'APIAuth %s:%s' % (config['evident_public_key'], auth)}
-    
-    r = requests.Request(action, ev_create_url, data=data, headers=headers)
-    p = r.prepare()
-    s = requests.Session()
-    try:
-        ask = s.send(p, timeout=10, verify=False)
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        if count < 5:
-            # Wait 60 seconds for every retry
-            print("Timed out, retrying in %d seconds." % (60 * (count + 1)))
-            time.sleep(60 * (count + 1))
-            count += 1
-            return call_ev_api(action, url, data, count)
-        else:
-            # Give-up after 5 retries
-            return false
-    # Weird error where response is not JSON.  Just ignore call.
+    return url, '%s%s' % (config['evident_api_base'], url)
+
+# Handle an Evident response.  Returns (True, result) when the call is finished, or (False, None)
+# when it should be retried after the rate limiter lets it through again.
+def handle_ev_response(status_code, headers, text, wait):
+    ev_rate_limiter.update_from_headers(headers)
+    retry_after = get_retry_after(headers)
+    if status_code == 429:
+        wait = retry_after if retry_after is not None else wait
+        print("rate limit hit, retrying in %.1f seconds." % wait)
+        ev_rate_limiter.on_throttle(wait)
+        return False, None
+
+    # Weird error where response is not JSON (usually a throttling proxy).  Back off and retry.
     try:
-        ev_response_json = ask.json()
-    except Exception as e:
-        if count < 5:
-            # Wait 10 seconds for every retry
-            print("rate limit hit, retrying in %d seconds." % (10 * (count + 1)))
-            time.sleep(10 * (count + 1))
-            count += 1
-            return call_ev_api(action, url, data, count)
-        else:
-            # Give-up after 5 retries
-            return false
-    
+        ev_response_json = json.loads(text)
+    except ValueError:
+        print("Unreadable response (%d), retrying in %.1f seconds." % (status_code, wait))
+        ev_rate_limiter.on_throttle(wait)
+        return False, None
+
     # Handle rate-limit exceptions
     if 'errors' in ev_response_json:
         for error in ev_response_json['errors']:
             print(error)
             if int(error['status']) == 429:
-                if count < 5:
-                    # Wait 10 seconds for every retry
-                    print("rate limit hit, retrying in %d seconds." % (10 * (count + 1)))
-                    time.sleep(10 * (count + 1))
-                    count += 1
-                    return call_ev_api(action, url, data, count)
-                else:
-                    # Give-up after 5 retries
-                    return false
+                wait = retry_after if retry_after is not None else wait
+                print("rate limit hit, retrying in %.1f seconds." % wait)
+                ev_rate_limiter.on_throttle(wait)
+                return False, None
             elif int(error['status']) == 422:
-                return 'already added, but lets move on'
+                return True, 'already added, but lets move on'
             elif int(error['status']) == 404:
-                return 'cant find, but whatever, lets move on'
+                return True, 'cant find, but whatever, lets move on'
             else:
                 # Throw Exception and end script if any other error occurs
-                raise Exception('%d - %s' % (int(error['status']), error['title']))
-    
-    return ev_response_json
+                raise EvidentApiError('%d - %s' % (int(error['status']), error['title']), int(error['status']))
+
+    ev_rate_limiter.on_success()
+    return True, ev_response_json
+
+# Process Evident API requests
+# Every attempt waits on the shared rate limiter.  Throttled and failed attempts are retried with
+# jittered exponential back-off (or the server's Retry-After), and an EvidentApiError is raised once
+# ev_max_retries is used up.
+def call_ev_api(action, url, data):
+    url, ev_create_url = get_ev_url(url)
+    result, cache_headers = get_ev_cached(action, url)
+    if result is not None:
+        return result
+
+    s = get_session('evident')
+    started_at = time.time()
+    status_code, size, retries, rate_limit_wait = None, 0, 0, 0.0
+    try:
+        for attempt in range(config['ev_max_retries'] + 1):
+            retries = attempt
+            waiting_since = time.time()
+            ev_rate_limiter.acquire()
+            rate_limit_wait += time.time() - waiting_since
+            # Sign every attempt, the Date header has to be current
+            headers = get_ev_headers(action, url, data)
+            headers.update(cache_headers)
+            r = requests.Request(action, ev_create_url, data=data, headers=headers)
+            p = s.prepare_request(r)
+            wait = get_backoff(attempt, config['ev_backoff_base'], config['ev_backoff_max'])
+            try:
+                with ev_in_flight:
+                    ask = s.send(p, timeout=10, verify=False)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                status_code, size = None, 0
+                print("Timed out, retrying in %.1f seconds." % wait)
+                time.sleep(wait)
+                continue
+            status_code, size = ask.status_code, len(ask.content)
+
+            if ask.status_code == 304 and cache_headers:
+                ev_rate_limiter.on_success()
+                result = revalidate_ev_cache(url)
+                if result is not None:
+                    return result
+                cache_headers = {}
+                continue
+
+            done, result = handle_ev_response(ask.status_code, ask.headers, ask.text, wait)
+            if done:
+                store_ev_cache(action, url, ask.status_code, ask.headers, ask.text, result)
+                return result
+
+        # Give-up after all retries
+        raise EvidentApiError('%s %s failed after %d retries' % (action, url, config['ev_max_retries']))
+    finally:
+        record_endpoint('evident', action, url, status_code, size, time.time() - started_at, retries, rate_limit_wait)
 
 # Helper method - get id from relationship link
 # Example: http://test.host/api/v2/signatures/1003.json
@@ -499,10 +1156,133 @@ def get_id(link):
 # Example: https://api.evident.io/api/v2/reports/22952488/alerts?filter%5Bstatus_eq%5D=fail&page%5Bnumber%5D=6&page%5Bsize%5D=20
 # Should return 6
 def get_page_number(link):
-    a = link.split("page%5Bnumber%5D=")
+    a = link.replace("page[number]=", "page%5Bnumber%5D=").split("page%5Bnumber%5D=")
     b = a[1].split("&")
     return int(b[0])
 
+# Helper method - replace the page number of a link
+def set_page_number(link, number):
+    return re.sub(r"(page(%5B|\[)number(%5D|\])=)[0-9]+", r"\g<1>%d" % number, link)
+
+# Helper method - links to every remaining page of a listing, built from its next and last links
+# Returns None when the listing does not say which page is the last one
+def get_ev_page_urls(ev_response_json):
+    links = ev_response_json['links']
+    if not config['ev_parallel_pages'] or not links.get('next') or not links.get('last'):
+        return None
+    try:
+        first = get_page_number(links['next'])
+        last = get_page_number(links['last'])
+    except (IndexError, ValueError):
+        return None
+
+    page_urls = []
+    for number in range(first, last + 1):
+        page_urls.append(set_page_number(links['next'], number))
+    return page_urls
+
+# Sentinel for relationship data the API did not side-load, which must be fetched from its link instead
+NOT_INCLUDED = object()
+
+# Helper method - index the `included` records of a JSON:API compound document by (type, id)
+def index_ev_included(ev_response_json):
+    included = {}
+    for record in ev_response_json.get('included', []):
+        included[(record['type'], record['id'])] = record
+    return included
+
+# Helper method - get the IDs of a to-many relationship from its resource linkage
+# Returns NOT_INCLUDED if the response did not carry the linkage
+def get_ev_relationship_ids(item, relationship):
+    if 'data' not in item['relationships'].get(relationship, {}):
+        return NOT_INCLUDED
+    ids = []
+    for ref in item['relationships'][relationship]['data']:
+        ids.append(ref['id'])
+    return ids
+
+# Helper method - get the side-loaded record(s) of a relationship from the included index
+# Returns a record for to-one relationships, a list of records for to-many relationships, None for an
+# empty to-one relationship, or NOT_INCLUDED if any of the records were not side-loaded
+def get_ev_included(item, relationship, included):
+    if 'data' not in item['relationships'].get(relationship, {}):
+        return NOT_INCLUDED
+    data = item['relationships'][relationship]['data']
+    if data is None:
+        return None
+    if isinstance(data, list):
+        records = []
+        for ref in data:
+            if (ref['type'], ref['id']) not in included:
+                return NOT_INCLUDED
+            records.append(included[(ref['type'], ref['id'])])
+        return records
+    return included.get((data['type'], data['id']), NOT_INCLUDED)
+
+# Helper method - add an include= parameter to a listing URL when side-loading is enabled
+def with_ev_include(url, relationships):
+    if config['ev_include'] and relationships:
+        return '%s&include=%s' % (url, ','.join(relationships))
+    return url
+
+# Paginator - yields each page of an Evident listing, in order
+# With ev_parallel_pages enabled and a links.last on the first page, all remaining pages are
+# requested at once on the worker pool.  Otherwise links.next is followed; with ev_prefetch
+# enabled the next page is requested in the background while the caller processes the current one.
+def ev_pages(url):
+    ev_response_json = call_ev_api('GET', url, '')
+    page_urls = get_ev_page_urls(ev_response_json)
+    if page_urls:
+        executor = ThreadPoolExecutor(max_workers=min(config['ev_max_workers'], len(page_urls)))
+        try:
+            futures = []
+            for page_url in page_urls:
+                futures.append(executor.submit(call_ev_api, 'GET', page_url, ''))
+            yield ev_response_json
+            for future in futures:
+                yield future.result()
+        finally:
+            executor.shutdown(wait=True)
+        return
+
+    executor = None
+    if config['ev_prefetch']:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        while True:
+            next_page = ev_response_json['links'].get('next')
+            if not next_page:
+                yield ev_response_json
+                return
+            if executor:
+                future = executor.submit(call_ev_api, 'GET', next_page, '')
+                yield ev_response_json
+                ev_response_json = future.result()
+            else:
+                yield ev_response_json
+                ev_response_json = call_ev_api('GET', next_page, '')
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+
+# Paginator - yields each record of an Evident listing as its page arrives
+def ev_records(url):
+    for ev_response_json in ev_pages(url):
+        for item in ev_response_json['data']:
+            yield item
+
+# Collect the IDs of every record of an Evident listing
+def ev_ids(url):
+    ids = []
+    for item in ev_records(url):
+        ids.append(item['id'])
+    return ids
+
+# Raised when the migration must not run at all
+class MigrationAbortedError(Exception):
+    pass
+
 # Check if script should run
 # Should ONLY run if authenticated user do not have Evident role
 def can_proceed():
@@ -510,198 +1290,204 @@ def can_proceed():
     ev_response_json = call_ev_api('GET', ev_create_url, '')
 
     if len(ev_response_json['data']) > 1:
-        print("Do NOT run this with a Evident role user.")
-        sys.exit()
+        raise MigrationAbortedError("Do NOT run this with a Evident role user.")
+
+# Retrieve the External Account IDs of a single Evident Team
+def get_ev_team_external_account_ids(item):
+    external_account_ids = get_ev_relationship_ids(item, 'external_accounts')
+    if external_account_ids is not NOT_INCLUDED:
+        return external_account_ids
+    return ev_ids("%s?page[size]=100" % item['relationships']['external_accounts']['links']['related'])
 
 # Retrieve Evident Teams
+# With concurrent_collection enabled, each Team's External Accounts are fetched by a worker pool
+# while the next page of Teams is being retrieved.  Teams keep the order the API returned them in.
 def get_ev_teams():
     print("Retrieve Evident Teams.")
 
     teams = {}
+    pending = []
+    executor = None
+    if config['concurrent_collection']:
+        executor = ThreadPoolExecutor(max_workers=config['ev_max_workers'])
 
-    next_page = '/api/v2/teams?page[size]=100'
-    ev_create_url = next_page
-    ev_response_json = call_ev_api('GET', ev_create_url, '')
-    while (next_page != False):     
-        for item in ev_response_json['data']:
+    try:
+        for item in ev_records(with_ev_include('/api/v2/teams?page[size]=100', ['external_accounts'])):
             team = {}
             team['name'] = item['attributes']['name']
+            teams[item['id']] = team
 
-            # Retrieve external accounts IDs
-            external_account_ids = []
-            next_page2 = "%s?page[size]=100" % item['relationships']['external_accounts']['links']['related']
-            ev_create_url2 = next_page2
-            ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-            while (next_page2 != False):    
-                for item2 in ev_response_json2['data']:
-                    external_account_ids.append(item2['id'])
-
-                if 'next' in ev_response_json2['links']:
-                    next_page2 = ev_response_json2['links']['next']
-                    ev_create_url2 = next_page2
-                    ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-                else:
-                    next_page2 = False   
+            # Retrieve external accounts IDs, unless the listing already carried them
+            if executor and get_ev_relationship_ids(item, 'external_accounts') is NOT_INCLUDED:
+                pending.append((team, executor.submit(get_ev_team_external_account_ids, item)))
+            else:
+                team['external_account_ids'] = get_ev_team_external_account_ids(item)
 
-            team['external_account_ids'] = external_account_ids
+        for team, future in pending:
+            team['external_account_ids'] = future.result()
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
 
-            teams[item['id']] = team
+    return teams
 
-        if 'next' in ev_response_json['links']:
-            next_page = ev_response_json['links']['next']
-            ev_create_url = next_page
-            ev_response_json = call_ev_api('GET', ev_create_url, '')
-        else:
-            next_page = False
+# Build a user record from an Evident user, without its teams
+def parse_ev_user(item):
+    user = {}
+    user['first_name'] = item['attributes']['first_name']
+    user['last_name'] = item['attributes']['last_name']
+    user['email'] = item['attributes']['email']
+    user['access_level'] = item['attributes']['access_level']
+    user['time_zone'] = item['attributes']['time_zone']
+
+    if get_id(item['relationships']['role']['links']['related']) == 2:
+        user['role'] = 'manager'
+    else:
+        user['role'] = 'customer'
 
-    return teams
+    return user
 
 # Retrieve Evident Users
 def get_ev_users():
     print("Retrieve Evident Users.")
     users = []
 
-    next_page = '/api/v2/users?page[size]=100'
-    ev_create_url = next_page
-    ev_response_json = call_ev_api('GET', ev_create_url, '')
-    while (next_page != False):     
+    for ev_response_json in ev_pages(with_ev_include('/api/v2/users?page[size]=100', ['teams'])):
+        included = index_ev_included(ev_response_json)
         for item in ev_response_json['data']:
-            user = {}
-            user['first_name'] = item['attributes']['first_name']
-            user['last_name'] = item['attributes']['last_name']
-            user['email'] = item['attributes']['email']
-            user['access_level'] = item['attributes']['access_level']
-            user['time_zone'] = item['attributes']['time_zone']
-
-            if get_id(item['relationships']['role']['links']['related']) == 2:
-                user['role'] = 'manager'
-            else:
-                user['role'] = 'customer'
+            user = parse_ev_user(item)
 
             # Retrieve teams if access level is not organization level
             if user['access_level'] != 'organization_level':
                 teams = []
+                included_teams = get_ev_included(item, 'teams', included)
+                if included_teams is not NOT_INCLUDED:
+                    for item2 in included_teams:
+                        teams.append({'name': item2['attributes']['name']})
                 # Possible for user to have no teams (no access), need to check for that
-                if item['relationships']['teams']['links']['related'] is not None:
-                    next_page2 = "%s?page[size]=100" % item['relationships']['teams']['links']['related']
-                    ev_create_url2 = next_page2
-                    ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-                    while (next_page2 != False):    
-                        for item2 in ev_response_json2['data']:
-                            team = {
-                                'name': item2['attributes']['name']
-                            }
-                            teams.append(team)
-
-                        if 'next' in ev_response_json2['links']:
-                            next_page2 = ev_response_json2['links']['next']
-                            ev_create_url2 = next_page2
-                            ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-                        else:
-                            next_page2 = False   
+                elif item['relationships']['teams']['links']['related'] is not None:
+                    for item2 in ev_records("%s?page[size]=100" % item['relationships']['teams']['links']['related']):
+                        teams.append({'name': item2['attributes']['name']})
 
                 user['teams'] = teams
 
             users.append(user)
 
-        if 'next' in ev_response_json['links']:
-            next_page = ev_response_json['links']['next']
-            ev_create_url = next_page
-            ev_response_json = call_ev_api('GET', ev_create_url, '')
-        else:
-            next_page = False
-
     return users
 
+# Retrieve the RedLock ID (AWS account / Azure subscription) of an Evident External Account
+def get_ev_external_account_rl_id(item, included):
+    credentials = get_ev_included(item, 'credentials', included)
+    if credentials is NOT_INCLUDED:
+        ev_create_url = item['relationships']['credentials']['links']['related']
+        credentials = call_ev_api('GET', ev_create_url, '')['data']
+    return parse_ev_credentials(item, credentials)
+
+# Helper method - get the RedLock ID (AWS account / Azure subscription) from an account's credentials
+def parse_ev_credentials(item, credentials):
+    if item['attributes']['provider'] == 'amazon':
+        return credentials['attributes']['account']
+    elif item['attributes']['provider'] == 'azure':
+        return credentials['attributes']['subscription_id']
+    else:
+        return ''
+
+# Retrieve the disabled signature IDs of an Evident External Account
+def get_ev_external_account_disabled_signature_ids(item):
+    disabled_signature_ids = get_ev_relationship_ids(item, 'disabled_signatures')
+    if disabled_signature_ids is not NOT_INCLUDED:
+        return disabled_signature_ids
+    return ev_ids("%s?page[size]=100" % item['relationships']['disabled_signatures']['links']['related'])
+
+# Retrieve the team name of an Evident External Account, -1 if it has none
+def get_ev_external_account_team_name(item, included):
+    team = get_ev_included(item, 'team', included)
+    if team is NOT_INCLUDED:
+        ev_create_url = item['relationships']['team']['links']['related']
+        team = call_ev_api('GET', ev_create_url, '')['data']
+    return parse_ev_team_name(team)
+
+# Helper method - get the name of an account's team record, -1 if it has none
+def parse_ev_team_name(team):
+    if team and 'attributes' in team:
+        return team['attributes']['name']
+    else:
+        return -1
+
+# Build an External Account record from its list entry, following its relationship links
+def get_ev_external_account(item, level, included, progress):
+    external_account = {}
+    external_account['name'] = item['attributes']['name']
+    external_account['provider'] = item['attributes']['provider']
+    external_account['rl_id'] = get_ev_external_account_rl_id(item, included)
+
+    if level == 'detailed':
+        external_account['disabled_signature_ids'] = get_ev_external_account_disabled_signature_ids(item)
+        external_account['team_name'] = get_ev_external_account_team_name(item, included)
+
+    progress.tick()
+    return external_account
+
 # Retrieve Evident External Accounts
+# Credentials, teams and disabled signatures are side-loaded with include= (see ev_include), and only
+# relationships missing from the compound document are fetched from their links.
+# With concurrent_collection enabled, the per-account credentials, disabled signatures and team
+# lookups run across accounts on a worker pool (bounded overall by ev_max_in_flight), and are
+# merged back in the order the API listed the accounts.
 def get_ev_external_accounts(level):
     print("Retrieve Evident External Accounts. Level of data - %s" % level)
     external_accounts = {}
+    pending = []
+    progress = ProgressMeter('accounts', config['progress_every'])
+    executor = None
+    if config['concurrent_collection']:
+        executor = ThreadPoolExecutor(max_workers=config['ev_max_workers'])
+
+    if level == 'detailed':
+        url = with_ev_include('/api/v2/external_accounts?page[size]=100', ['credentials', 'team', 'disabled_signatures'])
+    else:
+        url = with_ev_include('/api/v2/external_accounts?page[size]=100', ['credentials'])
 
-    next_page = '/api/v2/external_accounts?page[size]=100'
-    ev_create_url = next_page
-    ev_response_json = call_ev_api('GET', ev_create_url, '')
-    while (next_page != False):     
-        for item in ev_response_json['data']:
-            external_account = {}
-            external_account['name'] = item['attributes']['name']
-            external_account['provider'] = item['attributes']['provider']
-
-            ev_create_url2 = item['relationships']['credentials']['links']['related']
-            ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-            if external_account['provider'] == 'amazon':
-                external_account['rl_id'] = ev_response_json2['data']['attributes']['account']
-            elif external_account['provider'] == 'azure':
-                external_account['rl_id'] = ev_response_json2['data']['attributes']['subscription_id']
-            else:
-                external_account['rl_id'] = ''
-
-            if level == 'detailed':
-                print("-- %s" % external_account['name'])
-
-                # Retrieve disabled signatures
-                disabled_signature_ids = []
-                next_page2 = "%s?page[size]=100" % item['relationships']['disabled_signatures']['links']['related']
-                ev_create_url2 = next_page2
-                ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-                while (next_page2 != False):    
-                    for item2 in ev_response_json2['data']:
-                        disabled_signature_ids.append(item2['id'])
-
-                    if 'next' in ev_response_json2['links']:
-                        next_page2 = ev_response_json2['links']['next']
-                        ev_create_url2 = next_page2
-                        ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-                    else:
-                        next_page2 = False
-                external_account['disabled_signature_ids'] = disabled_signature_ids
-
-                # Retrieve team name
-                ev_create_url2 = item['relationships']['team']['links']['related']
-                ev_response_json2 = call_ev_api('GET', ev_create_url2, '')
-                if 'attributes' in ev_response_json2['data']:
-                    external_account['team_name'] = ev_response_json2['data']['attributes']['name']
+    try:
+        for ev_response_json in ev_pages(url):
+            included = index_ev_included(ev_response_json)
+            for item in ev_response_json['data']:
+                if executor:
+                    pending.append((item['id'], executor.submit(get_ev_external_account, item, level, included, progress)))
                 else:
-                    external_account['team_name'] = -1
-
-            external_accounts[item['id']] = external_account
+                    external_accounts[item['id']] = get_ev_external_account(item, level, included, progress)
+                    if level == 'detailed':
+                        print("-- %s" % external_accounts[item['id']]['name'])
 
-        if 'next' in ev_response_json['links']:
-            next_page = ev_response_json['links']['next']
-            ev_create_url = next_page
-            ev_response_json = call_ev_api('GET', ev_create_url, '')
-        else:
-            next_page = False
+        for external_account_id, future in pending:
+            external_accounts[external_account_id] = future.result()
+            if level == 'detailed':
+                print("-- %s" % external_accounts[external_account_id]['name'])
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
 
+    progress.report()
     return external_accounts
 
+# Add an Evident region to the AWS or Azure region map
+def parse_ev_region(item, aws_regions, azure_regions):
+    # Convert Evident region code to RedLock region code
+    if item['attributes']['provider'] == 'amazon':
+        code = item['attributes']['code'].replace("_", "-")
+        aws_regions[item['id']] = code
+    elif item['attributes']['provider'] == 'azure':
+        code = item['attributes']['code']
+        azure_regions[item['id']] = code
+
 # Retrieve Evident Regions
 def get_ev_regions():
     print("Retrieve Evident Regions.")
     aws_regions = {}
     azure_regions = {}
 
-    next_page = '/api/v2/regions?page[size]=100'
-    ev_create_url = next_page
-    ev_response_json = call_ev_api('GET', ev_create_url, '')
-    while (next_page != False):     
-        for item in ev_response_json['data']:
-            # Convert Evident region code to RedLock region code
-            if item['attributes']['provider'] == 'amazon':
-                code = item['attributes']['code'].replace("_", "-")
-                aws_regions[item['id']] = code
-            elif item['attributes']['provider'] == 'azure':
-                code = item['attributes']['code']
-                azure_regions[item['id']] = code
-            else:
-                continue
-
-        if 'next' in ev_response_json['links']:
-            next_page = ev_response_json['links']['next']
-            ev_create_url = next_page
-            ev_response_json = call_ev_api('GET', ev_create_url, '')
-        else:
-            next_page = False
+    for item in ev_records('/api/v2/regions?page[size]=100'):
+        parse_ev_region(item, aws_regions, azure_regions)
 
     regions = {
         'aws': aws_regions,
@@ -709,41 +1495,33 @@ def get_ev_regions():
     }
     return regions
 
+# Build a suppression record from an Evident suppression
+def parse_ev_suppression(item):
+    suppression = {}
+    suppression['id'] = item['id']
+    suppression['resource'] = item['attributes']['resource']
+    suppression['region_ids'] = []
+    for region in item['relationships']['regions']['data']:
+        suppression['region_ids'].append(region['id'])
+    suppression['external_account_ids'] = []
+    for external_account in item['relationships']['external_accounts']['data']:
+        suppression['external_account_ids'].append(external_account['id'])
+    suppression['signature_ids'] = []
+    for signature in item['relationships']['signatures']['data']:
+        suppression['signature_ids'].append(signature['id'])
+    return suppression
+
 # Retrieve Evident Signature and Regional Suppression Rules
 def get_ev_suppressions():
     print("Retrieve Evident Suppression Rules.")
     suppressions = []
 
-    next_page = '/api/v2/suppressions?page[size]=100&filter[status_eq]=active&include=regions,external_accounts,signatures,custom_signatures'
-    ev_create_url = next_page
-    ev_response_json = call_ev_api('GET', ev_create_url, '')
-    while (next_page != False):     
-        for item in ev_response_json['data']:
-            # Signature or Custom signatures are defined = not regional, skip
-            #if item['relationships']['signatures']['data'] or item['relationships']['custom_signatures']['data']:
-            #    continue
-
-            suppression = {}
-            suppression['id'] = item['id']
-            suppression['resource'] = item['attributes']['resource']
-            suppression['region_ids'] = []
-            for region in item['relationships']['regions']['data']:
-                suppression['region_ids'].append(region['id'])
-            suppression['external_account_ids'] = []
-            for external_account in item['relationships']['external_accounts']['data']:
-                suppression['external_account_ids'].append(external_account['id'])
-            suppression['signature_ids'] = []
-            for signature in item['relationships']['signatures']['data']:
-                suppression['signature_ids'].append(signature['id'])
-
-            suppressions.append(suppression)
-
-        if 'next' in ev_response_json['links']:
-            next_page = ev_response_json['links']['next']
-            ev_create_url = next_page
-            ev_response_json = call_ev_api('GET', ev_create_url, '')
-        else:
-            next_page = False
+    url = '/api/v2/suppressions?page[size]=100&filter[status_eq]=active&include=regions,external_accounts,signatures,custom_signatures'
+    for item in ev_records(url):
+        # Signature or Custom signatures are defined = not regional, skip
+        #if item['relationships']['signatures']['data'] or item['relationships']['custom_signatures']['data']:
+        #    continue
+        suppressions.append(parse_ev_suppression(item))
 
     return suppressions
 
@@ -751,92 +1529,200 @@ def get_ev_suppressions():
 
 #=== RedLock Methods ===
 
+# Helper method - body of the /login request
+def get_rl_login_data():
+    login_info_hash = {
+        'username': config['redlock_username'],
+        'password': config['redlock_password'],
+    }
+    if config['redlock_tenant'] is not None:
+        login_info_hash['customerName'] = config['redlock_tenant']
+    return json.dumps(login_info_hash)
+
+# Requests that authenticate themselves instead of using the current session token
+rl_auth_urls = ['/login', '/auth_token/extend']
+
+# Owns the RedLock session token.  A background thread extends it (or logs in again when that
+# fails) once it is 3/4 of refresh_in minutes old, so requests keep using the current token while
+# it is refreshed.  Refreshes are single-flight: the first caller that finds no usable token (at
+# start, after a 401, or when the background refresh is late) refreshes it under the lock, and the
+# others wait for its token instead of logging in themselves.
+class RedLockTokenManager(object):
+    def __init__(self, refresh_in):
+        self.refresh_in = refresh_in * 60.0
+        self.refresh_ahead = self.refresh_in * 0.75
+        self.session = (None, 0)
+        # Reentrant: refresh() is called with the lock held and stores its token with set_token
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Current token while it is younger than refresh_in, otherwise None.  Never blocks.
+    def get_valid(self):
+        token, obtained_at = self.session
+        if token is not None and time.time() < obtained_at + self.refresh_in:
+            return token
+        return None
+
+    # Current token even when it is older than refresh_in, to extend it, or None
+    def get_stale(self):
+        with self.lock:
+            return self.session[0]
+
+    # Store the session token from a /login or /auth_token/extend response
+    def set_token(self, rl_response_json):
+        if 'token' not in rl_response_json:
+            raise RedLockApiError('Login failed: %s' % rl_response_json.get('message'), rl_response_json.get('status_code'))
+        with self.lock:
+            self.session = (rl_response_json['token'], time.time())
+        return rl_response_json['token']
+
+    # Forget a token RedLock rejected, unless it was already replaced
+    def invalidate(self, token):
+        with self.lock:
+            if self.session[0] == token:
+                self.session = (None, 0)
+
+    # Token to send with a request, refreshing it first when there is no usable one
+    def get_token(self):
+        token = self.get_valid()
+        if token is not None:
+            return token
+        with self.lock:
+            token = self.get_valid()
+            if token is None:
+                token = self.refresh()
+            return token
+
+    # Extend the current token, or log in when there is none or RedLock won't extend it.
+    # Called with the lock held.
+    def refresh(self):
+        token = self.session[0]
+        if token is not None:
+            try:
+                return self.set_token(call_rl_api('GET', '/auth_token/extend', '', token))
+            except RedLockApiError as e:
+                print("Could not extend the RedLock token (%s), re-login" % e)
+        print("RedLock API Login")
+        return self.set_token(call_rl_api('POST', '/login', get_rl_login_data(), ''))
+
+    # Seconds until the background thread should refresh the token
+    def get_refresh_wait(self):
+        token, obtained_at = self.session
+        if token is None:
+            return 1.0
+        return max(obtained_at + self.refresh_ahead - time.time(), 1.0)
+
+    # Background thread: refresh the token ahead of refresh_in until stopped
+    def run(self):
+        while not self.stopped.wait(self.get_refresh_wait()):
+            with self.lock:
+                token, obtained_at = self.session
+                if token is None or time.time() < obtained_at + self.refresh_ahead:
+                    continue
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print("Background RedLock token refresh failed: %s" % e)
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='redlock-token-refresh', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+rl_tokens = RedLockTokenManager(config['refresh_in'])
+
+# Decide whether a failed RedLock request is retried.  status_code is None for timeouts.
+# Returns the seconds to back off, or None to give up.
+def get_rl_retry_wait(url, status_code, headers, retries, token):
+    # Rejected credentials stay rejected: retrying a failed login only risks locking the account
+    # (and spends the retry budget), and the token manager logs in when a token can't be extended
+    if status_code == 401 and url in rl_auth_urls:
+        return None
+    retryable = status_code is None or status_code in rl_retry_statuses
+    if not (retryable and retries < config['rl_max_retries'] and use_rl_retry()):
+        return None
+    wait = get_backoff(retries, config['rl_backoff_base'], config['rl_backoff_max'])
+    if status_code is not None:
+        retry_after = get_retry_after(headers)
+        if retry_after is not None:
+            wait = retry_after
+        # Session was rejected, log in again before retrying
+        if status_code == 401:
+            rl_tokens.invalidate(token)
+    print("Unexpected error: %s, retrying in %.1f seconds." % (status_code or 'timeout', wait))
+    return wait
+
+# Build the call_rl_api result from the final response.  status_code is None for timeouts.
+def get_rl_result(action, url, status_code, headers, text, retries):
+    if status_code is None:
+        raise RedLockApiError('%s %s timed out after %d retries' % (action, url, retries))
+
+    # Error Handling
+    if (status_code != 200):
+        if 'x-redlock-status' in headers:
+            message = json.loads(headers['x-redlock-status'])[0]["subject"]
+            return {'message': message, 'status_code': status_code}
+        raise RedLockApiError('%s %s failed with status %d after %d retries' % (action, url, status_code, retries), status_code)
+
+    # Successful writes may come back with an empty or non-JSON body
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {'message': '', 'status_code': 200}
+
 # Process API requests
-def call_rl_api(action, url, data, count = 0):
-    global redlock_token
-    global token_created_at
-    
+# Failed requests are retried in a loop, up to rl_max_retries per call and rl_retry_budget for the
+# whole run, with jittered exponential back-off.  Only timeouts and rl_retry_statuses are retried;
+# other errors are returned as {'message', 'status_code'} when RedLock explains them in
+# x-redlock-status, and raised as RedLockApiError otherwise.
+# /login and /auth_token/extend are sent with the given token, every other request with the
+# token manager's.
+def call_rl_api(action, url, data, token=None):
     # Construct RedLock API URL
     rl_create_url = '%s%s' % (config['redlock_api_base'], url)
-    
-    # Authenticate
-    now = datetime.now()
-    if (url != '/login' and url != '/auth_token/extend'):
-        if redlock_token == '' or (token_created_at + timedelta(minutes=config['refresh_in']) <= datetime.now()):
-            if redlock_token == '':
-                print("RedLock API Login")
-            else:
-                print("Token expired, re-login")
-            login_info_hash = {
-                'username': config['redlock_username'],
-                'password': config['redlock_password'],
-            }
-            if config['redlock_tenant'] is not None:
-                login_info_hash['customerName'] = config['redlock_tenant']
-            login_info = json.dumps(login_info_hash)
-
-            rl_response_json = call_rl_api('POST', '/login', data=login_info)
-            redlock_token = rl_response_json['token']
-            token_created_at = datetime.now()
-    
-    headers = {'Content-Type': 'application/json',
-              'x-redlock-auth': redlock_token}
-    
-    # Prepare and issue request
-    try:
-        r = requests.Request(action, rl_create_url, data=data, headers=headers)  
-        p = r.prepare()
-        s = requests.Session()
-        ask = s.send(p, timeout=(count+1) * 5, verify=False)
-        # Error Handling
-        if (ask.status_code != 200):
-            message = ''
-            if 'x-redlock-status' in ask.headers:
-                message = json.loads(ask.headers['x-redlock-status'])[0]["i18nKey"]
-                message = json.loads(ask.headers['x-redlock-status'])[0]["subject"]
-            
-                return {'message': message, 'status_code': ask.status_code}
-            if (count < 5):
-                print("Unexpected error: %s, retry." % ask.status_code)
-                rl_response_json = call_rl_api(action, url, data, (count + 1))
-
-            return rl_response_json
-        else:
-            if (ask.text != '' or not ask.text):
-                rl_response_json = ask.json()
-            elif 'x-redlock-status' in ask.headers:
-                return {'message': ask.headers['x-redlock-status'], 'status_code': ask.status_code}
-            else:
-                if (count < 5):
-                    rl_response_json = call_rl_api(action, url, data, (count + 1))
-                else:
-                    print("error, exiting")
-                    sys.exit()
-                    return {}
-
-            return rl_response_json
-    # Retry after timeout
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        print("Timed out, retry")
-        #if (count < 10):
-        rl_response_json = call_rl_api(action, url, data, (count + 1))
-        return rl_response_json
-        #else:
-        #    raise requests.exceptions.Timeout
-    except json.decoder.JSONDecodeError as e:
-        if (ask.status_code == 200 and (ask.text != '' or not ask.text)):
-            return {'message': '', 'status_code': 200}
-        else:
-            print(e)
-            sys.exit()
-    except Exception as e:
-        print("Ran into something else")
-        print(e)
-        sys.exit()
+    s = get_session('redlock')
+    started_at = time.time()
+    retries = 0
+    rate_limit_wait = 0.0
+
+    while True:
+        # Authenticate
+        if url not in rl_auth_urls:
+            token = rl_tokens.get_token()
+
+        headers = {'Content-Type': 'application/json',
+                  'x-redlock-auth': token}
+
+        # Prepare and issue request
+        r = requests.Request(action, rl_create_url, data=data, headers=headers)
+        p = s.prepare_request(r)
+        status_code, response_headers, text, size = None, {}, '', 0
+        try:
+            ask = s.send(p, timeout=(retries + 1) * config['rl_timeout'], verify=False)
+            status_code, response_headers, text, size = ask.status_code, ask.headers, ask.text, len(ask.content)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            pass
+
+        if status_code != 200:
+            wait = get_rl_retry_wait(url, status_code, response_headers, retries, token)
+            if wait is not None:
+                if status_code == 429:
+                    rate_limit_wait += wait
+                time.sleep(wait)
+                retries += 1
+                continue
+        break
 
-    print("No exceptions but got nothing?? Let's retry")
-    sys.exit()
-    return {}
+    record_endpoint('redlock', action, url, status_code, size, time.time() - started_at, retries, rate_limit_wait)
+    return get_rl_result(action, url, status_code, response_headers, text, retries)
 
 # Retrieve all account groups
 def get_rl_account_groups():
@@ -845,12 +1731,27 @@ def get_rl_account_groups():
     rl_response_json = call_rl_api('GET', rl_create_url, '')
     return rl_response_json
 
+# Helper method - RedLock Users listing.  /user/name only has each user's id (email) and display
+# name, incremental mode needs the full records of /user to compare them with the planned writes.
+def get_rl_users_url():
+    if config['incremental']:
+        return '/user'
+    return '/user/name'
+
+# Helper method - full /user records are keyed by email, like the id of /user/name
+def index_rl_users(rl_response_json):
+    if isinstance(rl_response_json, list):
+        for user in rl_response_json:
+            if 'id' not in user and 'email' in user:
+                user['id'] = user['email']
+    return rl_response_json
+
 # Retrieve RedLock Users
 def get_rl_users():
     print("Retrieve RedLock Users.")
-    rl_create_url = '/user/name'
+    rl_create_url = get_rl_users_url()
     rl_response_json = call_rl_api('GET', rl_create_url, '')
-    return rl_response_json
+    return index_rl_users(rl_response_json)
 
 # Retrieve RedLock Cloud Accounts
 def get_rl_cloud_accounts():
@@ -859,10 +1760,17 @@ def get_rl_cloud_accounts():
     rl_response_json = call_rl_api('GET', rl_create_url, '')
     return rl_response_json
 
+# Helper method - RedLock User Roles listing.  /user/role/name only has ids and names, incremental
+# mode needs the role type, Account Groups and description of the full /user/role records.
+def get_rl_user_roles_url():
+    if config['incremental']:
+        return '/user/role'
+    return '/user/role/name'
+
 # Retrieve RedLock User Roles
 def get_rl_user_roles():
     print("Retrieve RedLock User Roles.")
-    rl_create_url = '/user/role/name'
+    rl_create_url = get_rl_user_roles_url()
     rl_response_json = call_rl_api('GET', rl_create_url, '')
     return rl_response_json
 
@@ -876,10 +1784,130 @@ def get_rl_policy_ids():
         policy_ids.append(item['policyId'])
     return policy_ids
 
+# Fields each kind of RedLock record is indexed by.  The first one is the record's key.
+rl_inventory_indexes = {
+    'account_groups': ['name', 'id'],
+    'user_roles': ['name', 'id'],
+    'users': ['id'],
+    'alert_rules': ['name', 'policyScanConfigId'],
+    'cloud_accounts': ['accountId']
+}
+
+# RedLock records kept in dict indexes, so lookups by name, id or accountId are O(1) instead of
+# a scan of the full list.  Each kind is loaded once (on first use, unless load() is handed a
+# list already retrieved) and then kept current as records are created and updated.
+class RedLockInventory(object):
+    def __init__(self):
+        self.indexes = {}
+        # Shared by the write pipeline workers.  Re-entrant, since lookups may reload a kind
+        self.lock = threading.RLock()
+
+    # (Re)load every record of a kind, from records when given, else from RedLock
+    def load(self, kind, records=None):
+        with self.lock:
+            if records is None:
+                loaders = {
+                    'account_groups': get_rl_account_groups,
+                    'user_roles': get_rl_user_roles,
+                    'users': get_rl_users,
+                    'alert_rules': get_rl_alert_rules,
+                    'cloud_accounts': get_rl_cloud_accounts
+                }
+                records = loaders[kind]()
+            self.indexes[kind] = {}
+            for field in rl_inventory_indexes[kind]:
+                self.indexes[kind][field] = {}
+            for record in records:
+                self.add(kind, record)
+            return list(self.indexes[kind][rl_inventory_indexes[kind][0]].values())
+
+    def get_indexes(self, kind):
+        if kind not in self.indexes:
+            self.load(kind)
+        return self.indexes[kind]
+
+    # Add a record, replacing the one sharing any of its indexed fields
+    def add(self, kind, record):
+        with self.lock:
+            fields = rl_inventory_indexes[kind]
+            indexes = self.get_indexes(kind)
+            previous = None
+            for field in fields:
+                if previous is None and record.get(field) is not None:
+                    previous = indexes[field].get(record[field])
+            for field in fields:
+                if previous is not None and previous.get(field) != record.get(field):
+                    indexes[field].pop(previous.get(field), None)
+                if record.get(field) is not None:
+                    indexes[field][record[field]] = record
+            return record
+
+    # Merge changes into the record found by field == value
+    def update(self, kind, field, value, changes):
+        with self.lock:
+            record = self.find(kind, field, value)
+            if record is None:
+                return None
+            updated = dict(record)
+            updated.update(changes)
+            return self.add(kind, updated)
+
+    def is_complete(self, kind, record):
+        for field in rl_inventory_indexes[kind]:
+            if record.get(field) is None:
+                return False
+        return True
+
+    # Record found by field == value as last seen, without reloading incomplete records
+    def peek(self, kind, field, value):
+        with self.lock:
+            return self.get_indexes(kind)[field].get(value)
+
+    # Record found by field == value, or None.  A created record RedLock did not echo its id
+    # back for is completed by reloading the kind, only once something asks for it.
+    def find(self, kind, field, value):
+        with self.lock:
+            record = self.get_indexes(kind)[field].get(value)
+            if record is not None and not self.is_complete(kind, record):
+                self.load(kind)
+                record = self.indexes[kind][field].get(value)
+            return record
+
+    # All records of a kind, in the order RedLock returned them
+    def list(self, kind):
+        with self.lock:
+            records = list(self.get_indexes(kind)[rl_inventory_indexes[kind][0]].values())
+            for record in records:
+                if not self.is_complete(kind, record):
+                    return self.load(kind)
+            return records
+
+    # Add a record created by a POST, with whatever RedLock echoed back
+    def created(self, kind, record, rl_response_json):
+        with self.lock:
+            if kind not in self.indexes:
+                return
+            if isinstance(rl_response_json, dict):
+                record = dict(record)
+                record.update(rl_response_json)
+                record.pop('status_code', None)
+                record.pop('message', None)
+            self.add(kind, record)
+
+# Helper method - error of a RedLock write that RedLock rejected.  call_rl_api returns the errors
+# RedLock explains as {'message', 'status_code'}.
+def get_rl_write_error(action, label, name, rl_response_json):
+    return RedLockApiError('Could not %s %s %s: %s' % (action, label, name, rl_response_json.get('message')),
+                           rl_response_json.get('status_code'))
+
+# Raise when a RedLock write was rejected, so the write counts as failed instead of done
+def check_rl_write(action, label, name, rl_response_json):
+    if isinstance(rl_response_json, dict) and rl_response_json.get('status_code', 200) != 200:
+        raise get_rl_write_error(action, label, name, rl_response_json)
+
 # Create RedLock Account Group, based on Evident team.
 # If Account Group already exist, then don't do anything
-def create_rl_account_group(team, cloud_account_ids):
-    account_group_name = convert_team_name(team['name'])
+def create_rl_account_group(account_group_name, cloud_account_ids, inventory):
     if config['dry_run']:
         print("Account Group %s created/updated." % account_group_name)
         print("-- Cloud Account IDs: %s" % cloud_account_ids)
@@ -893,27 +1921,24 @@ def create_rl_account_group(team, cloud_account_ids):
     rl_create_url = '/cloud/group'
     rl_response_json = call_rl_api('POST', rl_create_url, data)
     if 'status_code' not in rl_response_json or rl_response_json['status_code'] == 200:
+        inventory.created('account_groups', {'name': account_group_name, 'accountIds': cloud_account_ids}, rl_response_json)
         print("Account Group %s created." % account_group_name)
         print("-- Cloud Account IDs: %s" % cloud_account_ids)
         return True
     elif rl_response_json['message'] == 'account_group_name_already_exists' or rl_response_json['message'] == 'invalid_param_value':
         print("Account Group %s already exists." % account_group_name)
     else:
-        print(rl_response_json)
+        raise get_rl_write_error('create', 'Account Group', account_group_name, rl_response_json)
 
     return False
 
 # Create RedLock Account Group, based on Evident team.
 # If Account Group already exist, then don't do anything
-def update_rl_account_group(team, cloud_account_ids, rl_account_groups):
-    account_group_name = convert_team_name(team['name'])
-    account_group_id = -1
-    for rl_account_group in rl_account_groups:
-        if account_group_name == rl_account_group['name']:
-            account_group_id = rl_account_group['id']
-            break
-
-    if account_group_id != -1:
+def update_rl_account_group(account_group_name, cloud_account_ids, inventory):
+    account_group = inventory.find('account_groups', 'name', account_group_name)
+
+    if account_group is not None:
+        account_group_id = account_group['id']
         data = json.dumps({
             'name': account_group_name,
             'description': 'Created by Evident Asset Migrator.',
@@ -921,20 +1946,21 @@ def update_rl_account_group(team, cloud_account_ids, rl_account_groups):
         })
         rl_create_url = '/cloud/group/%s' % account_group_id
         rl_response_json = call_rl_api('PUT', rl_create_url, data)
+        check_rl_write('update', 'Account Group', account_group_name, rl_response_json)
+        inventory.update('account_groups', 'id', account_group_id, {'accountIds': cloud_account_ids})
         print("Account Group %s updated." % account_group_name)
         print("-- Cloud Account IDs: %s" % cloud_account_ids)
         return True
     else:
-        print("Cannot find Account Group %s to update" % account_group_name)
-    
-    return False
+        raise RedLockApiError("Cannot find Account Group %s to update" % account_group_name)
 
 # Create RedLock User Role
-def create_rl_user_role(name, role_type, account_group_ids):
-    if name in stats['user_role_count']:
-        stats['user_role_count'][name] += 1
-    else:
-        stats['user_role_count'][name] = 1
+def create_rl_user_role(name, role_type, account_group_ids, inventory):
+    with stats_lock:
+        if name in stats['user_role_count']:
+            stats['user_role_count'][name] += 1
+        else:
+            stats['user_role_count'][name] = 1
 
     if config['dry_run']:
         print("User Role %s created/updated." % name)
@@ -951,6 +1977,7 @@ def create_rl_user_role(name, role_type, account_group_ids):
     rl_create_url = '/user/role'
     rl_response_json = call_rl_api('POST', rl_create_url, data)
     if 'status_code' not in rl_response_json or rl_response_json['status_code'] == 200:
+        inventory.created('user_roles', {'name': name, 'roleType': role_type, 'accountGroupIds': account_group_ids}, rl_response_json)
         print("User Role %s created." % name)
         print("-- Role Type: %s" % role_type)
         print("-- Account Groupd IDs: %s" % account_group_ids)
@@ -958,19 +1985,16 @@ def create_rl_user_role(name, role_type, account_group_ids):
     elif rl_response_json['message'] == 'user_role_name_already_exists' or rl_response_json['message'] == 'invalid_param_value':
         print("User Role %s already exists." % name)
     else:
-        print(rl_response_json)
+        raise get_rl_write_error('create', 'User Role', name, rl_response_json)
 
     return False
 
 # Update RedLock User Role
-def update_rl_user_role(name, role_type, account_group_ids, rl_user_roles):
-    role_id = -1
-    for rl_user_role in rl_user_roles:
-        if name == rl_user_role['name']:
-            role_id = rl_user_role['id']
-            break
-
-    if role_id != -1:
+def update_rl_user_role(name, role_type, account_group_ids, inventory):
+    role = inventory.find('user_roles', 'name', name)
+
+    if role is not None:
+        role_id = role['id']
         data = json.dumps({
             'name': name,
             'description': 'Created by Evident Asset Migrator.',
@@ -979,17 +2003,17 @@ def update_rl_user_role(name, role_type, account_group_ids, rl_user_roles):
         })
         rl_create_url = '/user/role/%s' % role_id
         rl_response_json = call_rl_api('PUT', rl_create_url, data)
+        check_rl_write('update', 'User Role', name, rl_response_json)
+        inventory.update('user_roles', 'id', role_id, {'roleType': role_type, 'accountGroupIds': account_group_ids})
         print("User Role %s updated." % name)
         print("-- Role Type: %s" % role_type)
         print("-- Account Groupd IDs: %s" % account_group_ids)
         return True
     else:
-        print("Cannot find User Role  %s to update" % name)
-    
-    return False
+        raise RedLockApiError("Cannot find User Role %s to update" % name)
 
 # Create RedLock User
-def create_rl_user(user, role_id):
+def create_rl_user(user, role_id, inventory):
     if config['dry_run']:
         print("User %s created/updated." % user['email'])
         print("-- Name: %s %s" % (user['first_name'], user['last_name']))
@@ -1005,25 +2029,21 @@ def create_rl_user(user, role_id):
     rl_create_url = '/user'
     rl_response_json = call_rl_api('POST', rl_create_url, data)
     if 'status_code' not in rl_response_json or rl_response_json['status_code'] == 200:
+        # Users are keyed by email, so the record is complete without echoing it back
+        inventory.created('users', {'id': user['email'], 'email': user['email'], 'roleId': role_id}, None)
         print("User %s created." % user['email'])
         print("-- Name: %s %s" % (user['first_name'], user['last_name']))
         return True
     elif rl_response_json['message'] == 'duplicate_user_name' or rl_response_json['status_code'] == 409:
         print("User %s already exists." % user['email'])
     else:
-        print(rl_response_json)
+        raise get_rl_write_error('create', 'User', user['email'], rl_response_json)
 
     return False
 
 # Create RedLock User
-def update_rl_user(user, role_id, rl_users):
-    found = False
-    for rl_user in rl_users:
-        if user['email'] == rl_user['id']:
-            found = True
-            break
-
-    if found:
+def update_rl_user(user, role_id, inventory):
+    if inventory.find('users', 'id', user['email']) is not None:
         data = json.dumps({
             'firstName': user['first_name'],
             'lastName': user['last_name'],
@@ -1032,35 +2052,34 @@ def update_rl_user(user, role_id, rl_users):
         })
         rl_create_url = '/user/%s' % user['email']
         rl_response_json = call_rl_api('PUT', rl_create_url, data)
+        check_rl_write('update', 'User', user['email'], rl_response_json)
+        inventory.update('users', 'id', user['email'], {'roleId': role_id})
         print("User %s updated." % user['email'])
         print("-- Name: %s %s" % (user['first_name'], user['last_name']))
         return True
     else:
-        print("Cannot find User  %s to update" % user['email'])
+        raise RedLockApiError("Cannot find User %s to update" % user['email'])
 
-    return False
-
-def get_role_id(name, rl_user_roles):
-    for role in rl_user_roles:
-        if name == role['name']:
-            return role['id']
+def get_role_id(name, inventory):
+    role = inventory.find('user_roles', 'name', name)
+    if role is not None:
+        return role['id']
 
     return False
 
-def get_account_group_ids(rl_account_groups):
+def get_account_group_ids(inventory):
     ids = []
-    for account_group in rl_account_groups:
+    for account_group in inventory.list('account_groups'):
         ids.append(account_group['id'])
 
     return ids
 
-def get_account_groups_ids_by_team(ev_teams, rl_account_groups):
+def get_account_groups_ids_by_team(ev_teams, inventory):
     ids = []
     for team in ev_teams:
-        for account_group in rl_account_groups:
-            if convert_team_name(team['name']) == account_group['name']:
-                ids.append(account_group['id'])
-                continue
+        account_group = inventory.find('account_groups', 'name', convert_team_name(team['name']))
+        if account_group is not None:
+            ids.append(account_group['id'])
 
     return ids
 
@@ -1072,8 +2091,9 @@ def get_rl_alert_rules():
     return rl_response_json
 
 # Create RedLock Alert Rule
-def create_rl_alert_rule(name, policies, target):    
-    stats['alert_rule_count'] += 1
+def create_rl_alert_rule(name, policies, target, inventory):    
+    with stats_lock:
+        stats['alert_rule_count'] += 1
     if not policies:
         scan_all = True
     else:
@@ -1091,10 +2111,12 @@ def create_rl_alert_rule(name, policies, target):
             print("-- Regions: %d" % len(target['regions']))
         return True
 
+    # Rules are created disabled in the same request when disable_new_alert_rules is set
+    enabled = not config['disable_new_alert_rules']
     data = json.dumps({
         'name': name,
         'description': 'Created by Evident Asset Migrator.',
-        'enabled': True,
+        'enabled': enabled,
         'scanAll': scan_all,
         'policies': policies,
         'policyLabels': [], 
@@ -1107,6 +2129,9 @@ def create_rl_alert_rule(name, policies, target):
     rl_create_url = '/alert/rule'
     rl_response_json = call_rl_api('POST', rl_create_url, data)
     if 'status_code' not in rl_response_json or rl_response_json['status_code'] == 200:
+        # 'enabled' only comes from RedLock's answer: the PATCH that disables the rule is skipped
+        # when RedLock says it created it disabled, not because it was asked to
+        inventory.created('alert_rules', {'name': name, 'policies': policies, 'target': target}, rl_response_json)
         print("Alert Rule %s created." % name)
         if scan_all:
             print("-- Policies: All")
@@ -1120,40 +2145,39 @@ def create_rl_alert_rule(name, policies, target):
     elif rl_response_json['message'] == 'name':
         print("Alert Rule %s already exists." % name)
     else:
-        print(rl_response_json)
+        raise get_rl_write_error('create', 'Alert Rule', name, rl_response_json)
 
     return False
 
-def disable_rl_alert_rule(name):
+def disable_rl_alert_rule(name, inventory):
     if config['dry_run']:
         print("Alert Rule %s disabled." % name)
         return True
 
-    alert_rule = False
-    for rl_alert_rule in rl_alert_rules:
-        if name == rl_alert_rule['name']:
-            alert_rule = rl_alert_rule
-            break
+    # Nothing to do when the create response says the rule is already disabled.  Otherwise the
+    # PATCH is sent anyway, it is harmless if RedLock did create the rule disabled.
+    alert_rule = inventory.peek('alert_rules', 'name', name)
+    if alert_rule is not None and alert_rule.get('enabled') is False:
+        print("Alert Rule %s disabled." % name)
+        return True
+
+    alert_rule = inventory.find('alert_rules', 'name', name)
 
-    if alert_rule:
+    if alert_rule is not None:
         rl_create_url = '/alert/rule/%s/status/false' % alert_rule['policyScanConfigId']
         rl_response_json = call_rl_api('PATCH', rl_create_url, '')
+        check_rl_write('disable', 'Alert Rule', name, rl_response_json)
+        inventory.update('alert_rules', 'name', name, {'enabled': False})
         print("Alert Rule %s disabled." % name)
         return True
     else:
-        print("Cannot find Alert Rule %s to disable" % name)
-
-    return False
+        raise RedLockApiError("Cannot find Alert Rule %s to disable" % name)
 
 # Create RedLock Alert Rule
-def update_rl_alert_rule(name, policies, target, alert_rules):
-    alert_rule = False
-    for rl_alert_rule in rl_alert_rules:
-        if name == rl_alert_rule['name']:
-            alert_rule = rl_alert_rule
-            break
-
-    if alert_rule:
+def update_rl_alert_rule(name, policies, target, inventory):
+    alert_rule = inventory.find('alert_rules', 'name', name)
+
+    if alert_rule is not None:
         if not policies:
             scan_all = True
         else:
@@ -1174,6 +2198,8 @@ def update_rl_alert_rule(name, policies, target, alert_rules):
         })
         rl_create_url = '/alert/rule/%s' % alert_rule['policyScanConfigId']
         rl_response_json = call_rl_api('PUT', rl_create_url, data)
+        check_rl_write('update', 'Alert Rule', name, rl_response_json)
+        inventory.update('alert_rules', 'name', name, {'enabled': True, 'policies': policies, 'target': target})
         print("Alert Rule %s updated." % name)
         if scan_all:
             print("-- Policies: All")
@@ -1182,352 +2208,1313 @@ def update_rl_alert_rule(name, policies, target, alert_rules):
         print("-- Regions: %d" % len(target['regions']))
         return True
     else:
-        print("Cannot find Alert Rule %s to update" % name)
-
-    return False
+        raise RedLockApiError("Cannot find Alert Rule %s to update" % name)
 
 #=== End RedLock Methods ===
 
-# === Begin Main Script ===
-if __name__ == '__main__':
-    can_proceed()
+#=== RedLock Write Pipeline ===
+# Planned RedLock writes are plain dicts with a 'type' (see rl_write_order), a 'name', the
+# fields the write needs and whether to 'overwrite' an existing object.  The planning loops
+# queue them while a dispatcher thread runs them on a thread pool per type.  A write only starts
+# once every write queued before it with an earlier type has finished, so User Roles see their
+# Account Groups and Users see their User Roles.
+
+# Resource types, in dependency order
+rl_write_order = ['account_group', 'user_role', 'user', 'alert_rule']
+
+# Order-insensitive form of a RedLock value, for comparisons
+def normalize_rl_value(value):
+    if isinstance(value, dict):
+        normalized = {}
+        for key, item in value.items():
+            normalized[key] = normalize_rl_value(item)
+        return normalized
+    if isinstance(value, list):
+        return sorted([normalize_rl_value(item) for item in value], key=json.dumps)
+    return value
+
+# Whether a current RedLock value differs from the desired one.  Only the keys of desired
+# dicts are compared, a missing value always counts as a difference.
+def is_rl_value_changed(current, desired):
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return True
+        for key, item in desired.items():
+            if key not in current or is_rl_value_changed(current[key], item):
+                return True
+        return False
+    return normalize_rl_value(current) != normalize_rl_value(desired)
+
+# Incremental mode: compare the desired fields of a planned write with the current RedLock
+# object.  Returns 'create' when it doesn't exist, 'unchanged' when nothing differs (or it must
+# not be overwritten) and 'update' otherwise.  None outside incremental mode, where writes try
+# a create first and update on "already exists".
+def get_rl_write_action(kind, name, desired, overwrite, inventory):
+    if not config['incremental']:
+        return None
+    current = inventory.find(kind, rl_inventory_indexes[kind][0], name)
+    if current is None:
+        return 'create'
+    if not overwrite or not is_rl_value_changed(current, desired):
+        return 'unchanged'
+    return 'update'
+
+# Create an Account Group, or update it if it already exists
+def write_rl_account_group(op, inventory):
+    action = get_rl_write_action('account_groups', op['name'], {'accountIds': op['cloud_account_ids']}, op['overwrite'], inventory)
+    if action == 'unchanged':
+        return 'unchanged'
+    if action != 'update' and create_rl_account_group(op['name'], op['cloud_account_ids'], inventory):
+        return 'created'
+    if op['overwrite'] and update_rl_account_group(op['name'], op['cloud_account_ids'], inventory):
+        return 'updated'
+    return 'skipped'
+
+# Create a User Role, or update it if it already exists.  Account Groups are resolved by name
+# when the write runs, after the Account Group writes.
+def write_rl_user_role(op, inventory):
+    if op['all_account_groups']:
+        account_group_ids = get_account_group_ids(inventory)
+    else:
+        account_group_ids = get_account_groups_ids_by_team(op['teams'], inventory)
+    desired = {'roleType': op['role_type'], 'accountGroupIds': account_group_ids}
+    action = get_rl_write_action('user_roles', op['name'], desired, op['overwrite'], inventory)
+    if action == 'unchanged':
+        return 'unchanged'
+    if action != 'update' and create_rl_user_role(op['name'], op['role_type'], account_group_ids, inventory):
+        return 'created'
+    if op['overwrite'] and update_rl_user_role(op['name'], op['role_type'], account_group_ids, inventory):
+        return 'updated'
+    return 'skipped'
+
+# Create a User, or update it if it already exists.  The role is resolved by name when the write runs.
+def write_rl_user(op, inventory):
+    role_id = get_role_id(op['role_name'], inventory)
+    user = op['user']
+    desired = {'firstName': user['first_name'], 'lastName': user['last_name'], 'timeZone': get_rl_time_zone(user['time_zone']), 'roleId': role_id}
+    action = get_rl_write_action('users', user['email'], desired, op['overwrite'], inventory)
+    if action == 'unchanged':
+        return 'unchanged'
+    if action != 'update' and create_rl_user(user, role_id, inventory):
+        return 'created'
+    if op['overwrite'] and update_rl_user(user, role_id, inventory):
+        return 'updated'
+    return 'skipped'
+
+# Create an Alert Rule, or update it if it already exists.  The enabled flag is not compared,
+# so rules disabled by disable_new_alert_rules (or by hand) count as unchanged.
+def write_rl_alert_rule(op, inventory):
+    # The Account Group is resolved by name when the write runs, it may not have existed when planned
+    target = op['target']
+    if op.get('account_group'):
+        account_group = inventory.find('account_groups', 'name', op['account_group'])
+        if account_group is not None:
+            target = dict(target, accountGroups=[account_group['id']])
+
+    desired = {'scanAll': not op['policies'], 'policies': op['policies'], 'target': target}
+    action = get_rl_write_action('alert_rules', op['name'], desired, op['overwrite'], inventory)
+    if action == 'unchanged':
+        return 'unchanged'
+    if action != 'update' and create_rl_alert_rule(op['name'], op['policies'], target, inventory):
+        if config['disable_new_alert_rules']:
+            disable_rl_alert_rule(op['name'], inventory)
+        return 'created'
+    if op['overwrite'] and update_rl_alert_rule(op['name'], op['policies'], target, inventory):
+        return 'updated'
+    return 'skipped'
+
+rl_writers = {
+    'account_group': write_rl_account_group,
+    'user_role': write_rl_user_role,
+    'user': write_rl_user,
+    'alert_rule': write_rl_alert_rule
+}
+
+# Runs planned writes in the background, rl_write_workers at a time per type.  submit() blocks
+# while rl_write_queue_size writes are waiting, so planning never runs far ahead of the writes.
+class RedLockWritePipeline(object):
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.queue = queue.Queue(config['rl_write_queue_size'])
+        self.executors = {}
+        self.slots = {}
+        self.pending = {}
+        self.planned = {}
+        self.results = {}
+        self.results_lock = threading.Lock()
+        for op_type in rl_write_order:
+            workers = config['rl_write_workers'][op_type]
+            self.executors[op_type] = ThreadPoolExecutor(max_workers=workers)
+            self.slots[op_type] = threading.BoundedSemaphore(workers)
+            self.pending[op_type] = []
+            self.planned[op_type] = set()
+            self.results[op_type] = {}
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    # Queue a planned write, unless the run being resumed already completed it
+    def submit(self, op):
+        self.planned[op['type']].add(op['name'])
+        if migration_checkpoint is not None and migration_checkpoint.is_done(op):
+            self.record(op['type'], 'resumed')
+            return
+        self.queue.put(op)
+
+    def dispatch(self):
+        while True:
+            op = self.queue.get()
+            if op is None:
+                self.queue.task_done()
+                return
+            op_type = op['type']
+            for earlier_type in rl_write_order[:rl_write_order.index(op_type)]:
+                wait(self.pending[earlier_type])
+                self.pending[earlier_type] = []
+            self.slots[op_type].acquire()
+            self.pending[op_type] = [future for future in self.pending[op_type] if not future.done()]
+            self.pending[op_type].append(self.executors[op_type].submit(self.run, op))
+            self.queue.task_done()
+
+    # Run one write, returns its outcome: created, updated, unchanged, skipped (already exists and
+    # must not be overwritten) or failed.  Writes RedLock rejected raise, so they count as failed and
+    # are not checkpointed: --resume tries them again.
+    def run(self, op):
+        try:
+            outcome = rl_writers[op['type']](op, self.inventory)
+        except Exception as e:
+            print("Failed to write %s %s: %s" % (op['type'].replace('_', ' '), op['name'], e))
+            outcome = 'failed'
+        finally:
+            self.slots[op['type']].release()
+
+        if outcome != 'failed' and not config['dry_run'] and migration_checkpoint is not None:
+            migration_checkpoint.done(op, outcome)
+        self.record(op['type'], outcome)
+        return outcome
+
+    def record(self, op_type, outcome):
+        with self.results_lock:
+            counts = self.results[op_type]
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    # Wait until every queued write has finished
+    def flush(self):
+        self.queue.join()
+        for op_type in rl_write_order:
+            wait(self.pending[op_type])
+
+    def close(self):
+        if not self.dispatcher.is_alive():
+            return
+        self.flush()
+        self.queue.put(None)
+        self.dispatcher.join()
+        for executor in self.executors.values():
+            executor.shutdown()
+
+    # Account Groups are written before anything is planned from them
+    def get_planned_account_group(self, name):
+        return None
+
+    def print_results(self):
+        print_rl_write_results(self.results)
+
+# Objects the migrator creates can be told apart by their description.  Listed in the order
+# stale objects are deleted: Alert Rules before the User Roles and Account Groups they use.
+rl_description = 'Created by Evident Asset Migrator.'
+rl_stale_kinds = [
+    ('alert_rule', 'alert_rules', 'policyScanConfigId', '/alert/rule/%s', 'Alert Rule'),
+    ('user_role', 'user_roles', 'id', '/user/role/%s', 'User Role'),
+    ('account_group', 'account_groups', 'id', '/cloud/group/%s', 'Account Group')
+]
+
+# Delete a RedLock object created by the migrator
+def delete_rl_object(record, id_field, url, label):
+    if config['dry_run']:
+        print("%s %s deleted." % (label, record['name']))
+        return True
+
+    rl_response_json = call_rl_api('DELETE', url % record[id_field], '')
+    if 'status_code' not in rl_response_json or rl_response_json['status_code'] == 200:
+        print("%s %s deleted." % (label, record['name']))
+        return True
+    print(rl_response_json)
+    return False
 
+# Incremental mode: find objects created by an earlier run that nothing was planned for this
+# time, and delete them when delete_stale is set.  Only types planned in this run are checked.
+def delete_stale_rl_objects(inventory, rl_writes):
+    for op_type, kind, id_field, url, label in rl_stale_kinds:
+        planned = rl_writes.planned[op_type]
+        if not planned:
+            continue
+        for record in inventory.list(kind):
+            if record.get('description') != rl_description or record['name'] in planned:
+                continue
+            if config['delete_stale']:
+                outcome = 'deleted' if delete_rl_object(record, id_field, url, label) else 'failed'
+            else:
+                print("%s %s is no longer migrated, set delete_stale to delete it." % (label, record['name']))
+                outcome = 'stale'
+            rl_writes.record(op_type, outcome)
+
+# Total write outcomes over every resource type
+def get_rl_write_totals(results):
+    totals = {}
+    for outcomes in results.values():
+        for outcome, count in outcomes.items():
+            totals[outcome] = totals.get(outcome, 0) + count
+    return totals
+
+# Print write outcome counts per resource type
+def print_rl_write_results(results):
+    for op_type in rl_write_order:
+        counts = results[op_type]
+        if counts:
+            summary = ', '.join('%d %s' % (counts[outcome], outcome) for outcome in sorted(counts))
+            print("-- %s: %s" % (op_type.replace('_', ' ').title() + 's', summary))
+
+#=== End RedLock Write Pipeline ===
+
+#=== Async Methods ===
+# async_mode equivalents of the API clients and collectors.  Each collection step of the main
+# script runs on one event loop, with every independent request in flight at the same time
+# (bounded by async_max_in_flight).  Rate limiting, retries and response handling are shared
+# with the threaded client.  Only collection is async: RedLock writes always go through the
+# threaded RedLockWritePipeline, in async_mode too.
+
+# aiohttp session plus the in-flight limit shared by every async request
+class AsyncClient(object):
+    def __init__(self):
+        self.session = None
+        self.semaphore = asyncio.Semaphore(config['async_max_in_flight'])
+        self.login_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=config['async_max_in_flight'], ssl=False)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    # Send a request, returns (status_code, headers, text) or None on timeout.  The URL is sent
+    # as-is: aiohttp would otherwise re-quote it, and Evident signatures cover the exact path.
+    async def send(self, action, url, data, headers, timeout):
+        try:
+            async with self.semaphore:
+                async with self.session.request(action, yarl.URL(url, encoded=True), data=data, headers=headers,
+                                                timeout=aiohttp.ClientTimeout(total=timeout)) as ask:
+                    return ask.status, ask.headers, await ask.text()
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            return None
+
+# Block (without blocking the event loop) until the rate limiter lets a request through
+async def async_acquire(rate_limiter):
+    wait = rate_limiter.reserve()
+    while wait > 0:
+        await asyncio.sleep(wait)
+        wait = rate_limiter.reserve()
+
+# Async version of call_ev_api
+async def async_call_ev_api(client, action, url, data):
+    url, ev_create_url = get_ev_url(url)
+    result, cache_headers = get_ev_cached(action, url)
+    if result is not None:
+        return result
+
+    started_at = time.time()
+    status_code, size, retries, rate_limit_wait = None, 0, 0, 0.0
     try:
-        if config['dry_run']:
-            print("THIS IS A DRY RUN.  NO RESOURCES WILL BE CREATED.")
+        for attempt in range(config['ev_max_retries'] + 1):
+            retries = attempt
+            waiting_since = time.time()
+            await async_acquire(ev_rate_limiter)
+            rate_limit_wait += time.time() - waiting_since
+            wait = get_backoff(attempt, config['ev_backoff_base'], config['ev_backoff_max'])
+            headers = get_ev_headers(action, url, data)
+            headers.update(cache_headers)
+            response = await client.send(action, ev_create_url, data, headers, 10)
+            if response is None:
+                status_code, size = None, 0
+                print("Timed out, retrying in %.1f seconds." % wait)
+                await asyncio.sleep(wait)
+                continue
+            status_code, size = response[0], len(response[2].encode('UTF-8'))
+
+            if response[0] == 304 and cache_headers:
+                ev_rate_limiter.on_success()
+                result = revalidate_ev_cache(url)
+                if result is not None:
+                    return result
+                cache_headers = {}
+                continue
 
-        if config['create_account_groups']:
-            print("Creating Account Groups.  One for each Evident Team.")
-            ev_teams = get_ev_teams()
-            ev_external_accounts = get_ev_external_accounts("basic")
-            rl_account_groups = get_rl_account_groups()
-
-            # Retrieve list of Cloud Account IDs
-            rl_cloud_accounts = get_rl_cloud_accounts()
-            all_ids = []
-            for rl_cloud_account in rl_cloud_accounts:
-                all_ids.append(rl_cloud_account['accountId'])
-
-            for team_id, team in ev_teams.items():
-                # Build list of Cloud Accounts to add to Account Group
-                cloud_account_ids = []
-                for external_account_id in team['external_account_ids']:
-                    if ev_external_accounts[external_account_id]['rl_id'] in all_ids:
-                        cloud_account_ids.append(ev_external_accounts[external_account_id]['rl_id'])
-
-                # Create or update Account Group
-                result = create_rl_account_group(team, cloud_account_ids)
-                if config['overwrite_account_groups'] and (not result):
-                    update_rl_account_group(team, cloud_account_ids, rl_account_groups)
+            done, result = handle_ev_response(response[0], response[1], response[2], wait)
+            if done:
+                store_ev_cache(action, url, response[0], response[1], response[2], result)
+                return result
+
+        # Give-up after all retries
+        raise EvidentApiError('%s %s failed after %d retries' % (action, url, config['ev_max_retries']))
+    finally:
+        record_endpoint('evident', action, url, status_code, size, time.time() - started_at, retries, rate_limit_wait)
+
+# Async version of RedLockTokenManager.get_token.  The token is refreshed on the event loop, and only
+# one task refreshes it at a time, the others wait for its token.  The manager's lock can't be held
+# across the request, so the token is read and stored through its locked methods.
+async def async_get_rl_token(client):
+    token = rl_tokens.get_valid()
+    if token is not None:
+        return token
+    async with client.login_lock:
+        token = rl_tokens.get_valid()
+        if token is not None:
+            return token
+        stale = rl_tokens.get_stale()
+        if stale is not None:
+            try:
+                return rl_tokens.set_token(await async_call_rl_api(client, 'GET', '/auth_token/extend', '', stale))
+            except RedLockApiError as e:
+                print("Could not extend the RedLock token (%s), re-login" % e)
+        print("RedLock API Login")
+        return rl_tokens.set_token(await async_call_rl_api(client, 'POST', '/login', get_rl_login_data(), ''))
+
+# Async version of call_rl_api
+async def async_call_rl_api(client, action, url, data, token=None):
+    rl_create_url = '%s%s' % (config['redlock_api_base'], url)
+    started_at = time.time()
+    retries = 0
+    rate_limit_wait = 0.0
+
+    while True:
+        # Authenticate
+        if url not in rl_auth_urls:
+            token = await async_get_rl_token(client)
+
+        headers = {'Content-Type': 'application/json',
+                   'x-redlock-auth': token}
+        response = await client.send(action, rl_create_url, data, headers, (retries + 1) * config['rl_timeout'])
+        status_code, response_headers, text = response if response is not None else (None, {}, '')
+
+        if status_code != 200:
+            wait = get_rl_retry_wait(url, status_code, response_headers, retries, token)
+            if wait is not None:
+                if status_code == 429:
+                    rate_limit_wait += wait
+                await asyncio.sleep(wait)
+                retries += 1
+                continue
+        break
+
+    record_endpoint('redlock', action, url, status_code, len(text.encode('UTF-8')), time.time() - started_at, retries, rate_limit_wait)
+    return get_rl_result(action, url, status_code, response_headers, text, retries)
+
+# Async version of ev_pages
+async def async_ev_pages(client, url):
+    ev_response_json = await async_call_ev_api(client, 'GET', url, '')
+    page_urls = get_ev_page_urls(ev_response_json)
+    if page_urls:
+        tasks = []
+        for page_url in page_urls:
+            tasks.append(asyncio.ensure_future(async_call_ev_api(client, 'GET', page_url, '')))
+        yield ev_response_json
+        for task in tasks:
+            yield await task
+        return
+
+    while True:
+        next_page = ev_response_json['links'].get('next')
+        if not next_page:
+            yield ev_response_json
+            return
+        if config['ev_prefetch']:
+            task = asyncio.ensure_future(async_call_ev_api(client, 'GET', next_page, ''))
+            yield ev_response_json
+            ev_response_json = await task
+        else:
+            yield ev_response_json
+            ev_response_json = await async_call_ev_api(client, 'GET', next_page, '')
 
-        if config['create_user_roles']:
-            print("Creating Users and User Roles.")
-            rl_account_groups = get_rl_account_groups()
+# Async version of ev_ids
+async def async_ev_ids(client, url):
+    ids = []
+    async for ev_response_json in async_ev_pages(client, url):
+        for item in ev_response_json['data']:
+            ids.append(item['id'])
+    return ids
 
-            # Create a role for Organization Level, Manager role users
-            create_rl_user_role("System Admin", "System Admin", [])
+# Async version of get_ev_teams
+async def async_get_ev_teams(client):
+    print("Retrieve Evident Teams.")
+    teams = {}
+    pending = []
+    async for ev_response_json in async_ev_pages(client, with_ev_include('/api/v2/teams?page[size]=100', ['external_accounts'])):
+        for item in ev_response_json['data']:
+            team = {'name': item['attributes']['name']}
+            teams[item['id']] = team
+            team['external_account_ids'] = get_ev_relationship_ids(item, 'external_accounts')
+            if team['external_account_ids'] is NOT_INCLUDED:
+                url = "%s?page[size]=100" % item['relationships']['external_accounts']['links']['related']
+                pending.append((team, asyncio.ensure_future(async_ev_ids(client, url))))
 
-            # Create a role for Organization Level, Customer role users
-            result = create_rl_user_role("Read Only System Admin", "Account Group Read Only", get_account_group_ids(rl_account_groups))
-            if config['overwrite_user_roles'] and (not result):
-                # Already exist, patch role with new set of account groups
-                rl_user_roles = get_rl_user_roles()
-                account_group_ids = get_account_group_ids(rl_account_groups)
-                update_rl_user_role("Read Only System Admin", "Account Group Read Only", account_group_ids, rl_user_roles)
-
-            rl_users = get_rl_users()
-            ev_users = get_ev_users()
-            rl_user_roles = get_rl_user_roles()
-
-            for ev_user in ev_users:
-                if ev_user['access_level'] == 'organization_level':
-                    if config['create_users']:
-                        if ev_user['role'] == 'manager':
-                            result = create_rl_user(ev_user, get_role_id("System Admin", rl_user_roles))
-                        if ev_user['role'] == 'customer':
-                            result = create_rl_user(ev_user, get_role_id("Read Only System Admin", rl_user_roles))
-                # Check if user has one team, if so, create a team role
-                else:
-                    if len(ev_user['teams']) == 0:
-                        print("User %s %s belongs to no teams (no access to anything), skipping." % (ev_user['first_name'], ev_user['last_name']))
-                        continue
-                    if len(ev_user['teams']) == 1:
-                        # Create a custom role for this team
-                        role_type = "Account Group Admin" if ev_user['role'] == 'manager' else "Account Group Read Only"
-                        account_group_ids = get_account_groups_ids_by_team(ev_user['teams'], rl_account_groups)
-                        role_name = "%s %s" % (convert_team_name(ev_user['teams'][0]['name']), role_type)
-                        result = create_rl_user_role(role_name, role_type, account_group_ids)
-                        if config['overwrite_user_roles'] and (not result):
-                            # Already exist, patch role with new set of account groups
-                            update_rl_user_role(role_name, role_type, account_group_ids, rl_user_roles)
-                        else:
-                            rl_user_roles = get_rl_user_roles()
-                    else: 
-                        # Create a custom role for this user
-                        role_type = "Account Group Admin" if ev_user['role'] == 'manager' else "Account Group Read Only"
-                        account_group_ids = get_account_groups_ids_by_team(ev_user['teams'], rl_account_groups)
-                        role_name = "%s %s Role" % (ev_user['first_name'], ev_user['last_name'])
-                        result = create_rl_user_role(role_name, role_type, account_group_ids)
-                        if config['overwrite_user_roles'] and (not result):
-                            # Already exist, patch role with new set of account groups
-                            update_rl_user_role(role_name, role_type, account_group_ids, rl_user_roles)
-                        else:
-                            rl_user_roles = get_rl_user_roles()
-
-                    # Create user
-                    if config['create_users']:
-                        role_id = get_role_id(role_name, rl_user_roles)
-                        result = create_rl_user(ev_user, role_id)
-                        if config['overwrite_users'] and (not result):
-                            # Already exist, patch user with new info
-                            update_rl_user(ev_user, role_id, rl_users)
+    for team, task in pending:
+        team['external_account_ids'] = await task
+    return teams
 
-        if config['create_alert_rules']:
-            print("Creating Alert Rules.  One for each Cloud Account.")
-            rl_cloud_accounts = get_rl_cloud_accounts()
-            rl_account_groups = get_rl_account_groups()
-            rl_policies = get_rl_policy_ids()
-            if config['migrate_disabled_signatures']:
-                ev_external_accounts = get_ev_external_accounts("detailed")
-            else:
-                ev_external_accounts = get_ev_external_accounts("basic")
-
-            if config['overwrite_alert_rules']:
-                rl_alert_rules = get_rl_alert_rules()
-
-            if config['migrate_suppressed_regions'] or config['migrate_suppressed_signatures']:
-                ev_regions = get_ev_regions()
-                ev_suppressions = get_ev_suppressions()
-
-                # Categorize the suppressions
-                print("-- Categorize Suppressions")
-                ev_regional_suppressions = []
-                ev_signature_all_region_suppressions = []
-                ev_signature_some_region_suppressions = []
-                ev_global_signature_suppressions = []
-                for suppression in ev_suppressions:
-                    print("---- Assessing %s" % suppression['id'])
-                    # Resource suppression, ignore
-                    if suppression['resource'] != '':
-                        print("------ Resource, ignored")
-                        continue
+# Collect the teams of an Evident user from their teams link
+async def async_get_ev_user_teams(client, url):
+    teams = []
+    async for ev_response_json in async_ev_pages(client, "%s?page[size]=100" % url):
+        for item in ev_response_json['data']:
+            teams.append({'name': item['attributes']['name']})
+    return teams
 
-                    if not suppression['signature_ids']:
-                        print("------ Signature (Regional)")
-                        ev_regional_suppressions.append(suppression)
-                    else:
-                        contains_aws_sigs = False
-                        contains_azure_sigs = False
-                        contains_global_sigs = False
-                        contains_none_global_sigs = False
-                        for signature_id in suppression['signature_ids']:
-                            # Signature does not have policy mapping, ignore
-                            if signature_id not in signature_policy_mapping['aws'] and signature_id not in signature_policy_mapping['azure']:
-                                suppression['signature_ids'].remove(signature_id)
-                                continue
-                            contains_aws_sigs = signature_id in signature_policy_mapping['aws']
-                            contains_azure_sigs = signature_id in signature_policy_mapping['azure']
-                                
-                            # Contains Global service signature
-                            if signature_id in global_signature_ids:
-                                contains_global_sigs = True
-                            else:
-                                contains_none_global_sigs = True
-
-                        # No signatures w/ mapping, ignore
-                        if not suppression['signature_ids']:
-                            print("------ Suppressed Signatures have no mappings, ignore")
-
-                        if contains_global_sigs:
-                            print("------ Signature (Global)")
-                            ev_global_signature_suppressions.append(suppression)
-                        
-                        if contains_none_global_sigs:
-                            all_region = True
-                            if contains_aws_sigs:
-                                for region_id, code in ev_regions['aws'].items():
-                                    if region_id != '9' and region_id not in suppression['region_ids']:
-                                        all_region = False
-                                        break
-                            if contains_azure_sigs:
-                                for region_id, code in ev_regions['azure'].items():
-                                    if region_id != '9' and region_id not in suppression['region_ids']:
-                                        all_region = False
-                                        break
-
-                            if all_region:
-                                print("------ Signature (All Region)")
-                                ev_signature_all_region_suppressions.append(suppression)
-                            else:
-                                print("------ Signature (Some Region)")
-                                ev_signature_some_region_suppressions.append(suppression)
-
-            # Create Alert Rule, one per account
-            for rl_cloud_account in rl_cloud_accounts:
-                # Find the relevant region codes
-                if (rl_cloud_account['cloudType'] == 'aws'):
-                    my_ev_regions = ev_regions['aws']
+# Async version of get_ev_users
+async def async_get_ev_users(client):
+    print("Retrieve Evident Users.")
+    users = []
+    pending = []
+    async for ev_response_json in async_ev_pages(client, with_ev_include('/api/v2/users?page[size]=100', ['teams'])):
+        included = index_ev_included(ev_response_json)
+        for item in ev_response_json['data']:
+            user = parse_ev_user(item)
+            users.append(user)
+            # Retrieve teams if access level is not organization level
+            if user['access_level'] == 'organization_level':
+                continue
+            user['teams'] = []
+            included_teams = get_ev_included(item, 'teams', included)
+            if included_teams is not NOT_INCLUDED:
+                for item2 in included_teams:
+                    user['teams'].append({'name': item2['attributes']['name']})
+            # Possible for user to have no teams (no access), need to check for that
+            elif item['relationships']['teams']['links']['related'] is not None:
+                url = item['relationships']['teams']['links']['related']
+                pending.append((user, asyncio.ensure_future(async_get_ev_user_teams(client, url))))
+
+    for user, task in pending:
+        user['teams'] = await task
+    return users
+
+# Async version of get_ev_external_account
+async def async_get_ev_external_account(client, item, level, included, progress):
+    external_account = {}
+    external_account['name'] = item['attributes']['name']
+    external_account['provider'] = item['attributes']['provider']
+
+    credentials = get_ev_included(item, 'credentials', included)
+    if credentials is NOT_INCLUDED:
+        credentials = (await async_call_ev_api(client, 'GET', item['relationships']['credentials']['links']['related'], ''))['data']
+    external_account['rl_id'] = parse_ev_credentials(item, credentials)
+
+    if level == 'detailed':
+        external_account['disabled_signature_ids'] = get_ev_relationship_ids(item, 'disabled_signatures')
+        if external_account['disabled_signature_ids'] is NOT_INCLUDED:
+            url = "%s?page[size]=100" % item['relationships']['disabled_signatures']['links']['related']
+            external_account['disabled_signature_ids'] = await async_ev_ids(client, url)
+
+        team = get_ev_included(item, 'team', included)
+        if team is NOT_INCLUDED:
+            team = (await async_call_ev_api(client, 'GET', item['relationships']['team']['links']['related'], ''))['data']
+        external_account['team_name'] = parse_ev_team_name(team)
+
+    progress.tick()
+    return external_account
+
+# Async version of get_ev_external_accounts
+async def async_get_ev_external_accounts(client, level):
+    print("Retrieve Evident External Accounts. Level of data - %s" % level)
+    external_accounts = {}
+    pending = []
+    progress = ProgressMeter('accounts', config['progress_every'])
+    if level == 'detailed':
+        url = with_ev_include('/api/v2/external_accounts?page[size]=100', ['credentials', 'team', 'disabled_signatures'])
+    else:
+        url = with_ev_include('/api/v2/external_accounts?page[size]=100', ['credentials'])
+
+    async for ev_response_json in async_ev_pages(client, url):
+        included = index_ev_included(ev_response_json)
+        for item in ev_response_json['data']:
+            task = asyncio.ensure_future(async_get_ev_external_account(client, item, level, included, progress))
+            pending.append((item['id'], task))
+
+    for external_account_id, task in pending:
+        external_accounts[external_account_id] = await task
+        if level == 'detailed':
+            print("-- %s" % external_accounts[external_account_id]['name'])
+
+    progress.report()
+    return external_accounts
+
+# Async version of get_ev_regions
+async def async_get_ev_regions(client):
+    print("Retrieve Evident Regions.")
+    aws_regions = {}
+    azure_regions = {}
+    async for ev_response_json in async_ev_pages(client, '/api/v2/regions?page[size]=100'):
+        for item in ev_response_json['data']:
+            parse_ev_region(item, aws_regions, azure_regions)
+
+    return {'aws': aws_regions, 'azure': azure_regions}
+
+# Async version of get_ev_suppressions
+async def async_get_ev_suppressions(client):
+    print("Retrieve Evident Suppression Rules.")
+    suppressions = []
+    url = '/api/v2/suppressions?page[size]=100&filter[status_eq]=active&include=regions,external_accounts,signatures,custom_signatures'
+    async for ev_response_json in async_ev_pages(client, url):
+        for item in ev_response_json['data']:
+            suppressions.append(parse_ev_suppression(item))
+
+    return suppressions
+
+# Async RedLock listing, `message` is printed like the threaded get_rl_* methods
+async def async_get_rl_list(client, message, url):
+    print(message)
+    return await async_call_rl_api(client, 'GET', url, '')
+
+# Async version of get_rl_policy_ids
+async def async_get_rl_policy_ids(client):
+    rl_response_json = await async_get_rl_list(client, "Retrieve RedLock Policy IDs.", '/policy')
+    policy_ids = []
+    for item in rl_response_json:
+        policy_ids.append(item['policyId'])
+    return policy_ids
+
+# Async version of get_rl_users
+async def async_get_rl_users(client):
+    return index_rl_users(await async_get_rl_list(client, "Retrieve RedLock Users.", get_rl_users_url()))
+
+# Async equivalents of the collection methods, used by collect() in async_mode
+async_collectors = {
+    get_ev_teams: async_get_ev_teams,
+    get_ev_users: async_get_ev_users,
+    get_ev_external_accounts: async_get_ev_external_accounts,
+    get_ev_regions: async_get_ev_regions,
+    get_ev_suppressions: async_get_ev_suppressions,
+    get_rl_account_groups: lambda client: async_get_rl_list(client, "Retrieve RedLock Account Groups.", '/cloud/group'),
+    get_rl_users: async_get_rl_users,
+    get_rl_cloud_accounts: lambda client: async_get_rl_list(client, "Retrieve RedLock Cloud Accounts.", '/cloud'),
+    get_rl_user_roles: lambda client: async_get_rl_list(client, "Retrieve RedLock User Roles.", get_rl_user_roles_url()),
+    get_rl_policy_ids: async_get_rl_policy_ids,
+    get_rl_alert_rules: lambda client: async_get_rl_list(client, "Retrieve RedLock Alert Rules.", '/alert/rule'),
+}
+
+async def async_collect(steps):
+    async with AsyncClient() as client:
+        tasks = []
+        for name, step in steps.items():
+            tasks.append(async_collectors[step[0]](client, *step[1:]))
+        results = await asyncio.gather(*tasks)
+    return dict(zip(steps.keys(), results))
+
+# Run the collection steps of a phase of the main script, e.g.
+#   collect({'ev_teams': (get_ev_teams,), 'ev_external_accounts': (get_ev_external_accounts, 'basic')})
+# In async_mode every step runs concurrently on one event loop, otherwise they run one after another.
+# Returns the results keyed like `steps`.
+def collect(steps):
+    # Evident collections saved by the run being resumed are not collected again
+    results = {}
+    remaining = {}
+    for name, step in steps.items():
+        saved = get_checkpointed_collection(name, step)
+        if saved is not None:
+            print("Reusing %s from the checkpoint." % name)
+            results[name] = saved
+        else:
+            remaining[name] = step
+
+    if not config['async_mode']:
+        for name, step in remaining.items():
+            results[name] = step[0](*step[1:])
+            checkpoint_collection(name, step, results[name])
+        return results
+
+    if aiohttp is None:
+        raise Exception("async_mode requires aiohttp, install it with: pip3 install aiohttp")
+    if remaining:
+        results.update(asyncio.run(async_collect(remaining)))
+        for name, step in remaining.items():
+            checkpoint_collection(name, step, results[name])
+    return results
+
+#=== End Async Methods ===
+
+#=== Planning Methods ===
+
+suppression_categories = ['regional', 'global', 'all_region', 'some_region']
+
+# Sort non-resource Evident suppressions into the categories the Alert Rules are planned from:
+# regional (no signatures), global (global service signatures), and signatures suppressed in all
+# or only some regions.  Returns a dict of category -> list of suppressions.
+def categorize_suppressions(ev_suppressions, ev_regions):
+    print("-- Categorize Suppressions")
+    categorized = {}
+    for category in suppression_categories:
+        categorized[category] = []
+
+    for suppression in ev_suppressions:
+        print("---- Assessing %s" % suppression['id'])
+        # Resource suppression, ignore
+        if suppression['resource'] != '':
+            print("------ Resource, ignored")
+            continue
+
+        if not suppression['signature_ids']:
+            print("------ Signature (Regional)")
+            categorized['regional'].append(suppression)
+        else:
+            contains_aws_sigs = False
+            contains_azure_sigs = False
+            contains_global_sigs = False
+            contains_none_global_sigs = False
+            # Iterate over a copy, unmapped signatures are removed as we go
+            for signature_id in list(suppression['signature_ids']):
+                # Signature does not have policy mapping, ignore
+                if signature_id not in signature_policy_mapping['aws'] and signature_id not in signature_policy_mapping['azure']:
+                    suppression['signature_ids'].remove(signature_id)
+                    continue
+                contains_aws_sigs = signature_id in signature_policy_mapping['aws']
+                contains_azure_sigs = signature_id in signature_policy_mapping['azure']
+
+                # Contains Global service signature
+                if signature_id in global_signature_ids:
+                    contains_global_sigs = True
                 else:
-                    my_ev_regions = ev_regions['azure']
-
-                account_group_name = False
-                for ev_external_account_id, ev_external_account in ev_external_accounts.items():
-                    if rl_cloud_account['accountId'] == ev_external_account['rl_id']:
-                        external_account_id = ev_external_account_id
-                        account_group_name = convert_team_name(ev_external_account['team_name'])
-                        break
-                if account_group_name:
-                    account_group = False
-                    for rl_account_group in rl_account_groups:
-                        if rl_account_group['name'] == account_group_name:
-                            account_group = rl_account_group
+                    contains_none_global_sigs = True
+
+            # No signatures w/ mapping, ignore
+            if not suppression['signature_ids']:
+                print("------ Suppressed Signatures have no mappings, ignore")
+
+            if contains_global_sigs:
+                print("------ Signature (Global)")
+                categorized['global'].append(suppression)
+
+            if contains_none_global_sigs:
+                all_region = True
+                if contains_aws_sigs:
+                    for region_id, code in ev_regions['aws'].items():
+                        if region_id != '9' and region_id not in suppression['region_ids']:
+                            all_region = False
                             break
-                    
-                    if not account_group:
-                        print("Can't find Account Group for Cloud Account %s, choosing a random Account Group with the Cloud Account." % rl_cloud_account['name'])
-                        if len(rl_cloud_account['groups']) > 0:
-                            account_group_id = rl_cloud_account['groups'][0]['id']
-                            for rl_account_group in rl_account_groups:
-                                if rl_account_group['id'] == account_group_id:
-                                    account_group = rl_account_group
-                                    break
-                        else:
-                            print("Account is not part of any Account Group, skipping.")
-                            continue
-
-                    ex_account_ids = account_group['accountIds'].copy()
-                    ex_account_ids.remove(rl_cloud_account['accountId'])
-                    cloud_type = rl_cloud_account['cloudType']
-
-                    policies = rl_policies.copy()
-                    policy_count = len(policies)
-                    # Remove disabled signatures from list
-                    if config['migrate_disabled_signatures']:
-                        for signature_id in ev_external_account['disabled_signature_ids']:
-                            if signature_id in signature_policy_mapping[cloud_type]:
-                                for policy_id in signature_policy_mapping[cloud_type][signature_id]: 
-                                    if policy_id in policies:
-                                        policies.remove(policy_id)
-
-                    enabled_region_codes = []
-                    # Process regional suppressions
-                    if config['migrate_suppressed_regions']:
-                        # Find regions to disable
-                        disabled_region_codes = []
-                        for suppression in ev_regional_suppressions:
-                            if external_account_id in suppression['external_account_ids']:
-                                for region_id in suppression['region_ids']:
-                                    disabled_region_codes.append(my_ev_regions[region_id])
-                            else:
-                                continue
-                        if disabled_region_codes:
-                            enabled_region_codes = rl_region_codes.copy()
-                            for code in disabled_region_codes:
-                                if code in enabled_region_codes:
-                                    enabled_region_codes.remove(code)
-
-                    # Process Global service suppressions
-                    for suppression in ev_global_signature_suppressions:
-                        if external_account_id not in suppression['external_account_ids']:
-                            continue
-
-                        # Global region not selected, won't affect global signatures, skip
-                        if '9' not in suppression['region_ids']:
-                            continue
-
-                        for signature_id in suppression['signature_ids']:
-                            # Global signature, remove from policies
-                            if signature_id in global_signature_ids:
-                                for policy_id in signature_policy_mapping[cloud_type][signature_id]: 
-                                    if policy_id in policies:
-                                        policies.remove(policy_id)
-
-                    # Process Signatures (All Region) suppressions
-                    for suppression in ev_signature_all_region_suppressions:
-                        if external_account_id not in suppression['external_account_ids']:
-                            continue
-
-                        for signature_id in suppression['signature_ids']:
-                            # Make sure it's not a global sig
-                            if signature_id not in global_signature_ids:
-                                for policy_id in signature_policy_mapping[cloud_type][signature_id]: 
-                                    if policy_id in policies:
-                                        policies.remove(policy_id)
-
-                    # Process Signature (Some Regions) suppressions
-                    signature_id_to_disabled_region_codes = {}
-                    for suppression in ev_signature_some_region_suppressions:
-                        if external_account_id not in suppression['external_account_ids']:
-                            continue
-
-                        for signature_id in suppression['signature_ids']:
-                            # Make sure it's not a global sig
-                            if signature_id not in global_signature_ids:
-                                disabled_region_codes = []
-                                for region_id in suppression['region_ids']:
-                                    # Add this region in if it isn't globally suppressed already
-                                    if my_ev_regions[region_id] in enabled_region_codes:
-                                        disabled_region_codes.append(my_ev_regions[region_id])
-
-                                # Add this entry if at least some regions are being disabled
-                                if disabled_region_codes:
-                                    if signature_id not in signature_id_to_disabled_region_codes:
-                                        signature_id_to_disabled_region_codes[signature_id] = disabled_region_codes
-                                    else:
-                                        signature_id_to_disabled_region_codes[signature_id] += disabled_region_codes
-
-                    for signature_id, disabled_region_codes in signature_id_to_disabled_region_codes.items():
-                        # Check if signature is completely suppressed or not
-                        # If the policy ID is still in the list, it means it wasn't removed by a disabled sig or signature suppression
-                        # In that case, we need to remove it from the list, but also create an Alert Rule to enable that policy on
-                        # the regions that wasn't suppressed
-                        excluded_policy_ids = []
-                        for policy_id in signature_policy_mapping[cloud_type][signature_id]: 
-                            if policy_id in policies:
-                                policies.remove(policy_id)
-                                excluded_policy_ids.append(policy_id)
-                        if excluded_policy_ids:
-                            enabled_region_codes_2 = enabled_region_codes.copy()
-                            for code in disabled_region_codes:
-                                if code in enabled_region_codes_2:
-                                    enabled_region_codes_2.remove(code)
-
-                            target = {'accountGroups': [account_group['id']], 'excludedAccounts': ex_account_ids, 'regions': enabled_region_codes_2, 'tags': []}
-                            alert_rule_name = "%s Alert Rule - Sig ID %s" % (rl_cloud_account['name'], signature_id)
-                            result = create_rl_alert_rule(alert_rule_name, excluded_policy_ids, target)
-
-                            if config['disable_new_alert_rules'] and result:
-                                rl_alert_rules = get_rl_alert_rules()
-                                disable_rl_alert_rule(alert_rule_name)
-
-                            if config['overwrite_alert_rules'] and (not result):
-                                # Already exist, patch alert rule with new info
-                                update_rl_alert_rule(alert_rule_name, excluded_policy_ids, target, rl_alert_rules)
-
-                    
-                    # No policies are disabled, scan all
-                    if policy_count == len(policies):
-                        policies = []
-
-                    target = {'accountGroups': [account_group['id']], 'excludedAccounts': ex_account_ids, 'regions': enabled_region_codes, 'tags': []}
-                    alert_rule_name = "%s Alert Rule" % rl_cloud_account['name']
-                    result = create_rl_alert_rule(alert_rule_name, policies, target)
-
-                    if config['disable_new_alert_rules'] and result:
-                        rl_alert_rules = get_rl_alert_rules()
-                        disable_rl_alert_rule(alert_rule_name)
-
-                    if config['overwrite_alert_rules'] and (not result):
-                        # Already exist, patch alert rule with new info
-                        update_rl_alert_rule(alert_rule_name, policies, target, rl_alert_rules)
+                if contains_azure_sigs:
+                    for region_id, code in ev_regions['azure'].items():
+                        if region_id != '9' and region_id not in suppression['region_ids']:
+                            all_region = False
+                            break
+
+                if all_region:
+                    print("------ Signature (All Region)")
+                    categorized['all_region'].append(suppression)
                 else:
-                    print("Cloud Account %s is not configured in Evident, skipping." % rl_cloud_account['name'])
+                    print("------ Signature (Some Region)")
+                    categorized['some_region'].append(suppression)
+
+    return categorized
+
+# Suppression buckets of an External Account that has no suppressions
+no_suppressions = {'regional': [], 'global': [], 'all_region': [], 'some_region': []}
+
+# Inverted index of categorized suppressions: External Account ID -> category -> suppressions,
+# keeping the suppressions' order.  Built once, so planning an account only touches its own suppressions.
+def index_suppressions_by_account(categorized):
+    index = {}
+    for category in suppression_categories:
+        for suppression in categorized[category]:
+            for external_account_id in set(suppression['external_account_ids']):
+                if external_account_id not in index:
+                    index[external_account_id] = {'regional': [], 'global': [], 'all_region': [], 'some_region': []}
+                index[external_account_id][category].append(suppression)
+    return index
+
+# Bitmap of the RedLock policy universe.  Every policy ID is one bit of an int, so disabling a
+# signature is a single AND-NOT no matter how many policies there are, and policies come back
+# out in their original RedLock order.
+class PolicyUniverse(object):
+    def __init__(self, policy_ids):
+        self.policy_ids = []
+        self.bits = {}
+        for policy_id in policy_ids:
+            if policy_id not in self.bits:
+                self.bits[policy_id] = 1 << len(self.policy_ids)
+                self.policy_ids.append(policy_id)
+        self.all = (1 << len(self.policy_ids)) - 1
+        self.signature_masks = {}
+
+    # Mask of the policies mapped to an Evident signature
+    def signature_mask(self, cloud_type, signature_id):
+        key = (cloud_type, signature_id)
+        if key not in self.signature_masks:
+            mask = 0
+            for policy_id in signature_policy_mapping[cloud_type].get(signature_id, []):
+                mask |= self.bits.get(policy_id, 0)
+            self.signature_masks[key] = mask
+        return self.signature_masks[key]
+
+    # Policy IDs of a mask, in RedLock order
+    def to_list(self, mask):
+        policy_ids = []
+        while mask:
+            lowest = mask & -mask
+            policy_ids.append(self.policy_ids[lowest.bit_length() - 1])
+            mask ^= lowest
+        return policy_ids
+
+# Plan the Alert Rules of one Cloud Account: one rule per signature that is only suppressed in some
+# regions, then the account's main rule.  `suppressions` holds the account's own categorized Evident
+# suppressions, from index_suppressions_by_account.
+# Returns a list of {'name', 'policies', 'target'}; an empty policies list means scan all.
+def plan_account_alert_rules(rl_cloud_account, ev_external_account, external_account_id, account_group,
+                             my_ev_regions, universe, suppressions):
+    alert_rules = []
+    ex_account_ids = account_group['accountIds'].copy()
+    ex_account_ids.remove(rl_cloud_account['accountId'])
+    cloud_type = rl_cloud_account['cloudType']
+
+    # Policies still enabled
+    policies = universe.all
+    # Remove disabled signatures from list
+    if config['migrate_disabled_signatures']:
+        for signature_id in ev_external_account['disabled_signature_ids']:
+            policies &= ~universe.signature_mask(cloud_type, signature_id)
+
+    enabled_region_codes = []
+    # Process regional suppressions
+    if config['migrate_suppressed_regions']:
+        # Find regions to disable
+        disabled_region_codes = set()
+        for suppression in suppressions['regional']:
+            for region_id in suppression['region_ids']:
+                disabled_region_codes.add(my_ev_regions[region_id])
+        if disabled_region_codes:
+            enabled_region_codes = [code for code in rl_region_codes if code not in disabled_region_codes]
+    enabled_region_code_set = set(enabled_region_codes)
+
+    # Process Global service suppressions
+    for suppression in suppressions['global']:
+        # Global region not selected, won't affect global signatures, skip
+        if '9' not in suppression['region_ids']:
+            continue
+
+        for signature_id in suppression['signature_ids']:
+            # Global signature, remove from policies
+            if signature_id in global_signature_ids:
+                policies &= ~universe.signature_mask(cloud_type, signature_id)
+
+    # Process Signatures (All Region) suppressions
+    for suppression in suppressions['all_region']:
+        for signature_id in suppression['signature_ids']:
+            # Make sure it's not a global sig
+            if signature_id not in global_signature_ids:
+                policies &= ~universe.signature_mask(cloud_type, signature_id)
+
+    # Process Signature (Some Regions) suppressions
+    signature_id_to_disabled_region_codes = {}
+    for suppression in suppressions['some_region']:
+        for signature_id in suppression['signature_ids']:
+            # Make sure it's not a global sig
+            if signature_id not in global_signature_ids:
+                disabled_region_codes = []
+                for region_id in suppression['region_ids']:
+                    # Add this region in if it isn't globally suppressed already
+                    if my_ev_regions[region_id] in enabled_region_code_set:
+                        disabled_region_codes.append(my_ev_regions[region_id])
+
+                # Add this entry if at least some regions are being disabled
+                if disabled_region_codes:
+                    if signature_id not in signature_id_to_disabled_region_codes:
+                        signature_id_to_disabled_region_codes[signature_id] = disabled_region_codes
+                    else:
+                        signature_id_to_disabled_region_codes[signature_id] += disabled_region_codes
+
+    for signature_id, disabled_region_codes in signature_id_to_disabled_region_codes.items():
+        # Check if signature is completely suppressed or not
+        # If the policy is still enabled, it means it wasn't removed by a disabled sig or signature suppression
+        # In that case, we need to remove it from the list, but also create an Alert Rule to enable that policy on
+        # the regions that wasn't suppressed
+        excluded_policy_ids = []
+        for policy_id in signature_policy_mapping[cloud_type][signature_id]:
+            if policies & universe.bits.get(policy_id, 0):
+                policies &= ~universe.bits[policy_id]
+                excluded_policy_ids.append(policy_id)
+        if excluded_policy_ids:
+            disabled_region_codes = set(disabled_region_codes)
+            enabled_region_codes_2 = [code for code in enabled_region_codes if code not in disabled_region_codes]
+
+            target = {'accountGroups': [account_group['id']], 'excludedAccounts': ex_account_ids, 'regions': enabled_region_codes_2, 'tags': []}
+            alert_rule_name = "%s Alert Rule - Sig ID %s" % (rl_cloud_account['name'], signature_id)
+            alert_rules.append({'name': alert_rule_name, 'policies': excluded_policy_ids, 'target': target})
+
+    # No policies are disabled, scan all
+    if policies == universe.all:
+        policy_ids = []
+    else:
+        policy_ids = universe.to_list(policies)
+
+    target = {'accountGroups': [account_group['id']], 'excludedAccounts': ex_account_ids, 'regions': enabled_region_codes, 'tags': []}
+    alert_rule_name = "%s Alert Rule" % rl_cloud_account['name']
+    alert_rules.append({'name': alert_rule_name, 'policies': policy_ids, 'target': target})
+    return alert_rules
+
+#=== End Planning Methods ===
+
+#=== Profiling ===
+# The migration runs in phases (see plan_migration).  Each phase's wall time and process CPU time
+# (all threads) are measured: a phase that spends most of its wall time off the CPU is waiting on the
+# APIs, one that keeps the CPU busy is planning-bound.  With `profiler` set, each phase is also profiled
+# into a collapsed stack file ("frame;frame;frame count" lines) that flamegraph.pl, speedscope or
+# inferno load directly.
+
+# Samples the stacks of every other thread every `interval` seconds.  Stacks are rooted at the
+# thread's name, so pipeline workers waiting on RedLock show up apart from the planner.
+class SamplingProfiler(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread-%d' % thread_id))
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    # One line per distinct stack, with its number of samples
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write('%s %d\n' % (stack, count))
+
+# Helper method - collapsed stack frame name of a pstats function key
+def get_pstats_frame(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+# Write cProfile stats as collapsed stacks, in microseconds.  cProfile keeps caller/callee pairs
+# rather than whole stacks, so a function's time is split across its callers in proportion to the
+# time each caller spent in it.  Recursive calls are folded into the outermost one.
+def write_pstats_collapsed(stats, path):
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((func, caller_stats[3]))
+
+    stacks = {}
+    def walk(func, stack, share):
+        tt = stats.stats[func][2]
+        stack = stack + [get_pstats_frame(func)]
+        self_time = int(tt * share * 1000000)
+        if self_time > 0:
+            key = ';'.join(stack)
+            stacks[key] = stacks.get(key, 0) + self_time
+        for callee, edge_ct in callees.get(func, []):
+            callee_ct = stats.stats[callee][3]
+            if get_pstats_frame(callee) in stack or callee_ct <= 0:
+                continue
+            callee_share = share * min(1.0, edge_ct / callee_ct)
+            # Skip branches below a microsecond, they would not show on a flame graph anyway
+            if callee_ct * callee_share >= 0.000001:
+                walk(callee, stack, callee_share)
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [], 1.0)
+
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('%s %d\n' % (stack, count))
+
+# Times the migration phases one after the other: start() ends the running phase, if any
+class MigrationPhases(object):
+    def __init__(self):
+        self.phases = []
+        self.current = None
+        if config['profiler'] not in (None, 'sampling', 'cprofile'):
+            raise ValueError("profiler must be None, 'sampling' or 'cprofile', not %r" % config['profiler'])
+
+    def start(self, name):
+        self.stop()
+        profiler = None
+        if config['profiler'] == 'sampling':
+            profiler = SamplingProfiler(config['profile_interval'])
+            profiler.start()
+        elif config['profiler'] == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.current = {'name': name, 'started_at': time.time(), 'cpu_started_at': time.process_time(), 'profiler': profiler}
+
+    def stop(self):
+        phase = self.current
+        if phase is None:
+            return
+        self.current = None
+        phase['wall'] = time.time() - phase['started_at']
+        phase['cpu'] = time.process_time() - phase['cpu_started_at']
+        profiler = phase.pop('profiler')
+        if profiler is not None:
+            if not os.path.isdir(config['profile_dir']):
+                os.makedirs(config['profile_dir'])
+            path = os.path.join(config['profile_dir'], '%02d_%s.collapsed' % (len(self.phases) + 1, phase['name']))
+            if isinstance(profiler, SamplingProfiler):
+                profiler.stop()
+                profiler.write_collapsed(path)
+            else:
+                profiler.disable()
+                stats = pstats.Stats(profiler)
+                stats.dump_stats(path[:-len('.collapsed')] + '.pstats')
+                write_pstats_collapsed(stats, path)
+            phase['profile'] = path
+        self.phases.append(phase)
+
+    def print_results(self):
+        for phase in self.phases:
+            cpu_share = phase['cpu'] / phase['wall'] * 100 if phase['wall'] > 0 else 0
+            print("-- %s: %.2fs wall, %.2fs CPU (%.0f%%)" % (phase['name'], phase['wall'], phase['cpu'], cpu_share))
+        if config['profiler'] and self.phases:
+            print("Phase profiles written to %s." % config['profile_dir'])
+
+#=== End Profiling ===
+
+#=== Migration ===
+
+# Saves planned writes to a JSON Lines plan file instead of running them (--plan)
+class MigrationPlanWriter(object):
+    def __init__(self, path, inventory):
+        self.inventory = inventory
+        self.file = open(path, 'w')
+        self.account_groups = {}
+        self.results = {}
+        for op_type in rl_write_order:
+            self.results[op_type] = {}
+
+    def submit(self, op):
+        self.file.write(json.dumps(op) + '\n')
+        counts = self.results[op['type']]
+        counts['planned'] = counts.get('planned', 0) + 1
+
+        # Keep Account Groups as they will be once the plan is applied
+        if op['type'] == 'account_group':
+            account_group = self.inventory.find('account_groups', 'name', op['name'])
+            if account_group is None or op['overwrite']:
+                account_group_id = account_group['id'] if account_group is not None else None
+                self.account_groups[op['name']] = {'name': op['name'], 'id': account_group_id, 'accountIds': op['cloud_account_ids']}
+
+    def get_planned_account_group(self, name):
+        return self.account_groups.get(name)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def print_results(self):
+        print_rl_write_results(self.results)
+
+# Planned writes saved by --plan, one per line
+def read_migration_plan(path):
+    with open(path) as plan_file:
+        for line in plan_file:
+            if line.strip():
+                yield json.loads(line)
+
+# Collect Evident and RedLock data and plan every RedLock write, handing each one to rl_writes.
+# Each step is timed (and profiled) as its own phase.
+def plan_migration(rl_inventory, rl_writes, phases):
+    if config['create_account_groups']:
+        phases.start('account_groups')
+        print("Creating Account Groups.  One for each Evident Team.")
+        collected = collect({
+            'ev_teams': (get_ev_teams,),
+            'ev_external_accounts': (get_ev_external_accounts, "basic"),
+            'rl_account_groups': (get_rl_account_groups,),
+            'rl_cloud_accounts': (get_rl_cloud_accounts,)
+        })
+        ev_teams = collected['ev_teams']
+        ev_external_accounts = collected['ev_external_accounts']
+        rl_inventory.load('account_groups', collected['rl_account_groups'])
+        rl_inventory.load('cloud_accounts', collected['rl_cloud_accounts'])
+
+        for team_id, team in ev_teams.items():
+            # Build list of Cloud Accounts to add to Account Group
+            cloud_account_ids = []
+            for external_account_id in team['external_account_ids']:
+                if rl_inventory.find('cloud_accounts', 'accountId', ev_external_accounts[external_account_id]['rl_id']) is not None:
+                    cloud_account_ids.append(ev_external_accounts[external_account_id]['rl_id'])
+
+            # Create or update Account Group
+            rl_writes.submit({
+                'type': 'account_group',
+                'name': convert_team_name(team['name']),
+                'cloud_account_ids': cloud_account_ids,
+                'overwrite': config['overwrite_account_groups']
+            })
+        rl_writes.flush()
+
+    if config['create_user_roles']:
+        phases.start('users_and_roles')
+        print("Creating Users and User Roles.")
+        collected = collect({
+            'rl_users': (get_rl_users,),
+            'ev_users': (get_ev_users,),
+            'rl_user_roles': (get_rl_user_roles,)
+        })
+        rl_inventory.load('users', collected['rl_users'])
+        ev_users = collected['ev_users']
+        rl_inventory.load('user_roles', collected['rl_user_roles'])
+
+        # Roles are queued first, so they are all written before any user that needs them
+        role_ops = {
+            # Create a role for Organization Level, Manager role users
+            "System Admin": {
+                'type': 'user_role',
+                'name': "System Admin",
+                'role_type': "System Admin",
+                'teams': [],
+                'all_account_groups': False,
+                'overwrite': False
+            },
+            # Create a role for Organization Level, Customer role users
+            "Read Only System Admin": {
+                'type': 'user_role',
+                'name': "Read Only System Admin",
+                'role_type': "Account Group Read Only",
+                'teams': [],
+                'all_account_groups': True,
+                'overwrite': config['overwrite_user_roles']
+            }
+        }
+        user_ops = []
+
+        for ev_user in ev_users:
+            user = {
+                'email': ev_user['email'],
+                'first_name': ev_user['first_name'],
+                'last_name': ev_user['last_name'],
+                'time_zone': ev_user['time_zone']
+            }
+            if ev_user['access_level'] == 'organization_level':
+                if config['create_users']:
+                    if ev_user['role'] == 'manager':
+                        user_ops.append({'type': 'user', 'name': user['email'], 'user': user, 'role_name': "System Admin", 'overwrite': False})
+                    if ev_user['role'] == 'customer':
+                        user_ops.append({'type': 'user', 'name': user['email'], 'user': user, 'role_name': "Read Only System Admin", 'overwrite': False})
+            # Check if user has one team, if so, create a team role
+            else:
+                if len(ev_user['teams']) == 0:
+                    print("User %s %s belongs to no teams (no access to anything), skipping." % (ev_user['first_name'], ev_user['last_name']))
+                    continue
+                role_type = "Account Group Admin" if ev_user['role'] == 'manager' else "Account Group Read Only"
+                if len(ev_user['teams']) == 1:
+                    # Create a custom role for this team
+                    role_name = "%s %s" % (convert_team_name(ev_user['teams'][0]['name']), role_type)
+                else: 
+                    # Create a custom role for this user
+                    role_name = "%s %s Role" % (ev_user['first_name'], ev_user['last_name'])
+
+                # A role planned twice is written once: the last plan wins if roles are overwritten, else the first
+                if role_name not in role_ops or config['overwrite_user_roles']:
+                    role_ops[role_name] = {
+                        'type': 'user_role',
+                        'name': role_name,
+                        'role_type': role_type,
+                        'teams': [{'name': team['name']} for team in ev_user['teams']],
+                        'all_account_groups': False,
+                        'overwrite': config['overwrite_user_roles']
+                    }
+
+                # Create user
+                if config['create_users']:
+                    user_ops.append({'type': 'user', 'name': user['email'], 'user': user, 'role_name': role_name, 'overwrite': config['overwrite_users']})
+
+        for op in list(role_ops.values()) + user_ops:
+            rl_writes.submit(op)
+        rl_writes.flush()
+
+    if config['create_alert_rules']:
+        phases.start('detailed_collection')
+        print("Creating Alert Rules.  One for each Cloud Account.")
+        steps = {
+            'rl_cloud_accounts': (get_rl_cloud_accounts,),
+            'rl_account_groups': (get_rl_account_groups,),
+            'rl_policies': (get_rl_policy_ids,)
+        }
+        if config['migrate_disabled_signatures']:
+            steps['ev_external_accounts'] = (get_ev_external_accounts, "detailed")
+        else:
+            steps['ev_external_accounts'] = (get_ev_external_accounts, "basic")
+
+        # Loaded once, new rules are added to the inventory as they are created
+        if config['overwrite_alert_rules'] or config['disable_new_alert_rules'] or config['incremental']:
+            steps['rl_alert_rules'] = (get_rl_alert_rules,)
+
+        if config['migrate_suppressed_regions'] or config['migrate_suppressed_signatures']:
+            steps['ev_regions'] = (get_ev_regions,)
+            steps['ev_suppressions'] = (get_ev_suppressions,)
+
+        collected = collect(steps)
+        rl_inventory.load('cloud_accounts', collected['rl_cloud_accounts'])
+        rl_inventory.load('account_groups', collected['rl_account_groups'])
+        rl_policies = collected['rl_policies']
+        ev_external_accounts = collected['ev_external_accounts']
+        if 'rl_alert_rules' in collected:
+            rl_inventory.load('alert_rules', collected['rl_alert_rules'])
+
+        # Index External Accounts by RedLock Cloud Account ID, the first one wins
+        ev_external_account_ids_by_rl_id = {}
+        for ev_external_account_id, ev_external_account in ev_external_accounts.items():
+            ev_external_account_ids_by_rl_id.setdefault(ev_external_account['rl_id'], ev_external_account_id)
+
+        ev_account_suppressions = {}
+        if config['migrate_suppressed_regions'] or config['migrate_suppressed_signatures']:
+            phases.start('suppression_categorization')
+            ev_regions = collected['ev_regions']
+            ev_suppressions = collected['ev_suppressions']
+
+            # Categorize the suppressions, then index them by External Account
+            ev_account_suppressions = index_suppressions_by_account(categorize_suppressions(ev_suppressions, ev_regions))
+
+        phases.start('alert_rule_planning')
+        policy_universe = PolicyUniverse(rl_policies)
+
+        # Create Alert Rule, one per account
+        for rl_cloud_account in rl_inventory.list('cloud_accounts'):
+            # Find the relevant region codes
+            if (rl_cloud_account['cloudType'] == 'aws'):
+                my_ev_regions = ev_regions['aws']
+            else:
+                my_ev_regions = ev_regions['azure']
+
+            account_group_name = False
+            external_account_id = ev_external_account_ids_by_rl_id.get(rl_cloud_account['accountId'])
+            if external_account_id is not None:
+                ev_external_account = ev_external_accounts[external_account_id]
+                account_group_name = convert_team_name(ev_external_account['team_name'])
+            if account_group_name:
+                # With --plan, Account Groups are used as planned, they are not written yet
+                account_group = rl_writes.get_planned_account_group(account_group_name)
+                if account_group is None:
+                    account_group = rl_inventory.find('account_groups', 'name', account_group_name)
+                
+                if account_group is None:
+                    print("Can't find Account Group for Cloud Account %s, choosing a random Account Group with the Cloud Account." % rl_cloud_account['name'])
+                    if len(rl_cloud_account['groups']) > 0:
+                        account_group = rl_inventory.find('account_groups', 'id', rl_cloud_account['groups'][0]['id']) or False
+                    else:
+                        print("Account is not part of any Account Group, skipping.")
+                        continue
+
+                account_suppressions = ev_account_suppressions.get(external_account_id, no_suppressions)
+                alert_rules = plan_account_alert_rules(rl_cloud_account, ev_external_account, external_account_id, account_group,
+                                                       my_ev_regions, policy_universe, account_suppressions)
+                for alert_rule in alert_rules:
+                    alert_rule['type'] = 'alert_rule'
+                    alert_rule['account_group'] = account_group['name'] if account_group else None
+                    alert_rule['overwrite'] = config['overwrite_alert_rules']
+                    rl_writes.submit(alert_rule)
+            else:
+                print("Cloud Account %s is not configured in Evident, skipping." % rl_cloud_account['name'])
+
+# Run the migration.  With plan_path, the planned writes are saved to that file instead of being
+# run.  With apply_path, the writes saved in that file are run without collecting anything.
+# With resume, the checkpoint of an interrupted run is picked up instead of starting over.
+def run_migration(plan_path=None, apply_path=None, resume=False):
+    open_checkpoint(resume)
+    phases = MigrationPhases()
+    rl_inventory = RedLockInventory()
+    rl_tokens.start()
+    if plan_path is not None:
+        rl_writes = MigrationPlanWriter(plan_path, rl_inventory)
+    else:
+        rl_writes = RedLockWritePipeline(rl_inventory)
+
+    try:
+        if plan_path is not None:
+            print("Planning only.  RedLock writes will be saved to %s." % plan_path)
+        elif config['dry_run']:
+            print("THIS IS A DRY RUN.  NO RESOURCES WILL BE CREATED.")
+
+        if apply_path is not None:
+            phases.start('apply_plan')
+            print("Applying migration plan %s." % apply_path)
+            for op in read_migration_plan(apply_path):
+                rl_writes.submit(op)
+        else:
+            phases.start('can_proceed')
+            can_proceed()
+            plan_migration(rl_inventory, rl_writes, phases)
+        # Writes still queued or running when planning ends
+        phases.start('redlock_writes')
+        rl_writes.close()
+
+        # Only once everything was planned, or objects that failed to be planned would count as stale
+        if config['incremental'] and plan_path is None:
+            phases.start('stale_objects')
+            delete_stale_rl_objects(rl_inventory, rl_writes)
+    except MigrationAbortedError as e:
+        print(e)
+        stats['errors'].append('%s: %s' % (type(e).__name__, e))
+        rl_writes.close()
     except Exception as e:
         print("Unexpected error.")
         print(traceback.print_exc())
+        stats['errors'].append('%s: %s' % (type(e).__name__, e))
+        rl_writes.close()
+    phases.stop()
+    rl_tokens.stop()
 
-    if config['create_user_roles']:
-        print("Created/Updated %d User Roles" % len(stats['user_role_count']))
-    if config['create_alert_rules']:
-        print("Created/Updated %d Alert Rules" % stats['alert_rule_count'])
+    if plan_path is not None:
+        print("Planned RedLock writes:")
+    else:
+        if config['create_user_roles']:
+            print("Created/Updated %d User Roles" % len(stats['user_role_count']))
+        if config['create_alert_rules']:
+            print("Created/Updated %d Alert Rules" % stats['alert_rule_count'])
+        print("RedLock writes:")
+    rl_writes.print_results()
+    print("Phase timing:")
+    phases.print_results()
+    print_endpoint_stats()
+    close_telemetry_trace()
+    for api, counts in get_connection_stats().items():
+        print("%s API connections: %d opened, %d reused" % (api.capitalize(), counts['opened'], counts['reused']))
     print("Asset Migrator completed.")
+    return rl_writes.results
+
+#=== End Migration ===
+
+# === Begin Main Script ===
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate Evident Teams, Users, Disabled Signatures and Suppressions to RedLock.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--plan', metavar='FILE', help='collect and plan only, saving the planned RedLock writes to FILE (JSON Lines)')
+    mode.add_argument('--apply', metavar='FILE', help='run the RedLock writes saved in FILE by --plan, without collecting anything')
+    parser.add_argument('--resume', action='store_true', help='finish an interrupted run: reuse its Evident collections and skip the RedLock writes it completed')
+    args = parser.parse_args()
+    if args.resume and not config['checkpoint_path']:
+        parser.error("--resume needs checkpoint_path to be set (before the interrupted run)")
+
+    run_migration(plan_path=args.plan, apply_path=args.apply, resume=args.resume)
+
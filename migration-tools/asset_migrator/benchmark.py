@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+import simulators
+from migrator_loader import load_migrator, parse_config_override
+
+#=== Description ===
+# End-to-end benchmark of asset_migrator.py against the local Evident and RedLock simulators
+# (simulators.py).  For every org size, fresh simulators are started in a child process and a fresh
+# copy of the migrator runs a full migration against them.  Reports the wall time, the requests each
+# simulator served (and the 429s/503s it injected) and the peak memory allocated by the migrator.
+#
+# The migrator is loaded with migrator_loader.py, with the simulators' URLs and credentials and
+# the benchmark config applied to its config.
+#
+# Peak memory is measured with tracemalloc, which slows the migrator down.  Use --no-memory for
+# wall times without that overhead.
+#
+# Run command: `python3 benchmark.py` (10, 1,000 and 10,000 accounts), or for example
+# `python3 benchmark.py --sizes 1000 --latency 0.05 --throttle-rate 0.01 --set ev_rate_limit=50`
+#=== End Description ===
+
+#=== Configuration ===
+
+# Org sizes (Evident External Accounts) benchmarked by default
+benchmark_sizes = [10, 1000, 10000]
+
+# asset_migrator.py config of every run, on top of the simulators' URLs and credentials.
+# Writes are made (against the simulator), and nothing is cached or checkpointed between runs.
+benchmark_migrator_config = {
+    'dry_run': False,
+    'create_users': True,
+    'ev_cache_path': None,
+    'checkpoint_path': None
+}
+
+#=== End Configuration ===
+
+#=== Benchmark Methods ===
+
+# Evident signature IDs and RedLock policy IDs of the migrator's signature_policy_mapping, so the
+# synthetic org's disabled signatures and suppressions exercise it.  A few signatures without a
+# mapping are added, which the migrator ignores.  Only AWS signatures, like the synthetic suppressions.
+def get_mapped_ids(migrator):
+    mapping = migrator.signature_policy_mapping
+    signature_ids = list(mapping['aws'])
+    unmapped_ids = [str(i) for i in range(1, 301) if str(i) not in mapping['aws'] and str(i) not in mapping['azure']]
+    signature_ids.extend(unmapped_ids[:20])
+
+    policy_ids = []
+    for cloud_type in ('aws', 'azure'):
+        for mapped_policy_ids in mapping[cloud_type].values():
+            for policy_id in mapped_policy_ids:
+                if policy_id not in policy_ids:
+                    policy_ids.append(policy_id)
+    return signature_ids, policy_ids
+
+# Child process: serve one synthetic org until the benchmark asks for the request counters
+def serve_simulators(options, connection):
+    with simulators.Simulators(**options) as sims:
+        connection.send(sims.get_migrator_config())
+        connection.recv()
+        connection.send(sims.get_stats())
+
+# Migrate one synthetic org of `accounts` External Accounts.  Returns a row of measurements.
+# With rerun, the org is then migrated again in incremental mode, which must not write anything.
+def run_benchmark(accounts, simulator_options, config_overrides, migrator_path, log_path, measure_memory, rerun=False):
+    options = dict(simulator_options)
+    options['accounts'] = accounts
+
+    # Spawned, so the simulators' org and CPU time stay out of the migrator's process
+    context = multiprocessing.get_context('spawn')
+    connection, child_connection = context.Pipe()
+    process = context.Process(target=serve_simulators, args=(options, child_connection), daemon=True)
+    process.start()
+    migrator_config = connection.recv()
+    migrator_config.update(benchmark_migrator_config)
+    migrator_config.update(config_overrides)
+
+    results = {}
+    rerun_results = None
+    peak = None
+    try:
+        migrator = load_migrator(migrator_path, migrator_config)
+        with open(log_path or os.devnull, 'w') as log:
+            with contextlib.redirect_stdout(log):
+                if measure_memory:
+                    tracemalloc.start()
+                started_at = time.perf_counter()
+                results = migrator.run_migration()
+                wall_time = time.perf_counter() - started_at
+                if measure_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                if rerun:
+                    print("=== Incremental re-run ===")
+                    migrator = load_migrator(migrator_path, dict(migrator_config, incremental=True))
+                    rerun_results = migrator.run_migration()
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        connection.send('stop')
+        stats = connection.recv()
+        process.join()
+
+    return {
+        'accounts': accounts,
+        'wall_time': wall_time,
+        'peak_memory': peak,
+        'writes': migrator.get_rl_write_totals(results),
+        'results': results,
+        'rerun_writes': None if rerun_results is None else migrator.get_rl_write_totals(rerun_results),
+        'simulators': stats
+    }
+
+# Print one line per benchmarked org size
+def print_benchmark_rows(rows):
+    print("%8s %10s %10s %10s %6s %6s %9s  %s" % ('Accounts', 'Wall (s)', 'Evident', 'RedLock', '429s', '503s', 'Peak MB', 'Writes'))
+    for row in rows:
+        evident = row['simulators']['evident']
+        redlock = row['simulators']['redlock']
+        peak = '-' if row['peak_memory'] is None else '%.1f' % (row['peak_memory'] / 1048576.0)
+        writes = ', '.join('%d %s' % (row['writes'][outcome], outcome) for outcome in sorted(row['writes']))
+        print("%8d %10.2f %10d %10d %6d %6d %9s  %s" % (
+            row['accounts'], row['wall_time'], evident['requests'], redlock['requests'],
+            evident['throttled'] + redlock['throttled'], evident['failed'] + redlock['failed'], peak, writes or 'none'))
+
+# Incremental re-runs that wrote anything, although nothing changed since the first run
+def get_rerun_writes(rows):
+    rerun_writes = []
+    for row in rows:
+        writes = row['rerun_writes'] or {}
+        changed = ', '.join('%d %s' % (writes[outcome], outcome) for outcome in sorted(writes) if outcome not in ('unchanged', 'skipped'))
+        if changed:
+            rerun_writes.append('%d accounts (%s)' % (row['accounts'], changed))
+    return rerun_writes
+
+#=== End Benchmark Methods ===
+
+# === Begin Main Script ===
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark asset_migrator.py end to end against local Evident and RedLock simulators.')
+    parser.add_argument('--sizes', type=lambda text: [int(size) for size in text.split(',')], default=benchmark_sizes,
+                        help='comma-separated org sizes, in External Accounts (default: 10,1000,10000)')
+    simulators.add_simulator_arguments(parser)
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', type=parse_config_override, action='append', default=[],
+                        help='asset_migrator.py config override, VALUE is JSON (e.g. --set ev_rate_limit=100)')
+    parser.add_argument('--migrator', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asset_migrator.py'),
+                        help='path of asset_migrator.py')
+    parser.add_argument('--log-dir', help='keep the migrator output of each run in this directory')
+    parser.add_argument('--json', metavar='FILE', help='also write the measurements, with per-endpoint request counts, to FILE')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory (tracemalloc slows the migrator down)')
+    parser.add_argument('--rerun', action='store_true', help='migrate every org again with incremental set, and fail if that re-run writes anything (request counts include the re-run)')
+    args = parser.parse_args()
+
+    simulator_options = simulators.get_simulator_options(args)
+    simulator_options['signature_ids'], simulator_options['policy_ids'] = get_mapped_ids(load_migrator(args.migrator, {}))
+
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    rows = []
+    for accounts in args.sizes:
+        print("Benchmarking %d accounts." % accounts)
+        log_path = None
+        if args.log_dir:
+            log_path = os.path.join(args.log_dir, 'benchmark_%d.log' % accounts)
+        rows.append(run_benchmark(accounts, simulator_options, dict(args.overrides),
+                                  args.migrator, log_path, not args.no_memory, args.rerun))
+        sys.stdout.flush()
+
+    print_benchmark_rows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2, sort_keys=True)
+
+    if args.rerun:
+        rerun_writes = get_rerun_writes(rows)
+        if rerun_writes:
+            print("Incremental re-runs wrote to RedLock: %s" % '; '.join(rerun_writes))
+            sys.exit(1)
+        print("Incremental re-runs made no writes.")
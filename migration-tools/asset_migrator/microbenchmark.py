@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+from __future__ import print_function
+
+import argparse
+import contextlib
+import copy
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from migrator_loader import load_migrator
+
+#=== Description ===
+# Microbenchmarks of the CPU-bound planning stages of asset_migrator.py, on synthetic data of
+# increasing size and without any API calls:
+# - categorize_suppressions: Evident suppressions sorted into regional/global/all region/some region
+# - index_suppressions_by_account: categorized suppressions indexed by External Account
+# - plan_account_alert_rules: the per-Cloud Account Alert Rule planning loop, including its PolicyUniverse
+# - get_ev_headers: APIAuth signing of Evident GETs, one per External Account
+#
+# Each size replaces the migrator's signature_policy_mapping and global_signature_ids with a synthetic
+# mapping, and generates matching Evident suppressions, External Accounts and RedLock policies.
+# Throughput is the best of --repeat runs (suppressions or accounts per second).  Allocations are
+# measured in a separate run with tracemalloc: the peak while the stage runs, and what it keeps.
+#
+# Regression check: save a baseline with --save-baseline, then compare later runs with --baseline.
+# The exit code is 1 when any stage's throughput drops more than --threshold below its baseline.
+#
+# Run command: `python3 microbenchmark.py --save-baseline baseline.json`, then after a change
+# `python3 microbenchmark.py --baseline baseline.json`
+#=== End Description ===
+
+#=== Configuration ===
+
+# Synthetic data sizes: External Accounts, suppressions, mapped signatures and RedLock policies
+microbenchmark_sizes = {
+    'small': {'accounts': 100, 'suppressions': 50, 'signatures': 100, 'policies': 300},
+    'medium': {'accounts': 1000, 'suppressions': 500, 'signatures': 300, 'policies': 1000},
+    'large': {'accounts': 10000, 'suppressions': 5000, 'signatures': 600, 'policies': 3000}
+}
+
+# Max throughput drop (fraction of the baseline) before a stage counts as regressed
+microbenchmark_threshold = 0.2
+
+#=== End Configuration ===
+
+#=== Synthetic Data ===
+
+# Planning inputs in the shape the migrator's collectors return them, generated from a seed
+def get_synthetic_data(migrator, size, seed):
+    rand = random.Random(seed)
+    policy_ids = ['policy-%d' % i for i in range(size['policies'])]
+
+    # Signatures mapped to 1-4 policies each, a tenth of them global service signatures
+    mapping = {'aws': {}, 'azure': {}}
+    signature_ids = []
+    for i in range(1, size['signatures'] + 1):
+        signature_id = str(i)
+        signature_ids.append(signature_id)
+        cloud_type = 'azure' if i % 5 == 0 else 'aws'
+        mapping[cloud_type][signature_id] = rand.sample(policy_ids, rand.randint(1, 4))
+    aws_signature_ids = list(mapping['aws'])
+    global_signature_ids = aws_signature_ids[::10]
+    # Signatures without a mapping, which are ignored
+    unmapped_signature_ids = [str(size['signatures'] + i) for i in range(1, 11)]
+
+    # AWS regions with RedLock region codes, region 9 being global, and Azure regions
+    aws_codes = [code for code in migrator.rl_region_codes if code[:2] in ('us', 'eu', 'ap', 'ca', 'sa')]
+    ev_regions = {'aws': {'9': 'global'}, 'azure': {}}
+    for i, code in enumerate(aws_codes):
+        ev_regions['aws'][str(i + 10)] = code
+    for i, code in enumerate(['eastus', 'westus', 'northeurope', 'westeurope']):
+        ev_regions['azure'][str(i + 100)] = code
+    aws_region_ids = list(ev_regions['aws'])
+
+    # External Accounts, a tenth of them Azure, in Teams (Account Groups) of 20
+    ev_external_accounts = {}
+    rl_cloud_accounts = []
+    account_groups = {}
+    aws_account_ids = []
+    for i in range(1, size['accounts'] + 1):
+        external_account_id = str(i)
+        cloud_type = 'azure' if i % 10 == 0 else 'aws'
+        team_name = 'Team %d' % ((i - 1) // 20)
+        disabled_signature_ids = []
+        if rand.random() < 0.3:
+            disabled_signature_ids = rand.sample(list(mapping[cloud_type]), min(len(mapping[cloud_type]), rand.randint(1, 5)))
+        ev_external_accounts[external_account_id] = {
+            'name': 'Account %d' % i,
+            'provider': 'amazon' if cloud_type == 'aws' else 'azure',
+            'rl_id': '%012d' % i,
+            'disabled_signature_ids': disabled_signature_ids,
+            'team_name': team_name
+        }
+        if team_name not in account_groups:
+            account_groups[team_name] = {'id': 'group-%d' % len(account_groups), 'name': team_name, 'accountIds': []}
+        account_groups[team_name]['accountIds'].append('%012d' % i)
+        rl_cloud_accounts.append({'accountId': '%012d' % i, 'name': 'Account %d' % i, 'cloudType': cloud_type,
+                                  'groups': [{'id': account_groups[team_name]['id']}]})
+        if cloud_type == 'aws':
+            aws_account_ids.append(external_account_id)
+
+    # Suppressions of AWS accounts: resource, regional, and signatures in all or some regions
+    ev_suppressions = []
+    for i in range(1, size['suppressions'] + 1):
+        kind = rand.random()
+        resource = ''
+        region_ids = rand.sample(aws_region_ids, rand.randint(1, len(aws_region_ids)))
+        suppressed_signature_ids = []
+        if kind < 0.1:
+            resource = 'arn:aws:s3:::bucket-%d' % i
+        elif kind > 0.4:
+            suppressed_signature_ids = rand.sample(aws_signature_ids, min(len(aws_signature_ids), rand.randint(1, 4)))
+            if rand.random() < 0.2:
+                suppressed_signature_ids.append(rand.choice(unmapped_signature_ids))
+            if rand.random() < 0.3:
+                region_ids = list(aws_region_ids)
+        ev_suppressions.append({
+            'id': str(i),
+            'resource': resource,
+            'region_ids': region_ids,
+            'external_account_ids': rand.sample(aws_account_ids, min(len(aws_account_ids), rand.randint(1, 10))),
+            'signature_ids': suppressed_signature_ids
+        })
+
+    return {
+        'signature_policy_mapping': mapping,
+        'global_signature_ids': global_signature_ids,
+        'rl_policies': policy_ids,
+        'ev_regions': ev_regions,
+        'ev_external_accounts': ev_external_accounts,
+        'rl_cloud_accounts': rl_cloud_accounts,
+        'account_groups': account_groups,
+        'ev_suppressions': ev_suppressions
+    }
+
+#=== End Synthetic Data ===
+
+#=== Stages ===
+# Each stage has a setup, run outside of the measurements, and a run.  Returns (setup, run, ops):
+# setup() returns the argument of run(argument), ops is the number of items one run processes.
+
+def get_categorize_stage(migrator, data):
+    # Suppressions are changed in place (unmapped signatures are removed), every run gets a copy
+    def setup():
+        return copy.deepcopy(data['ev_suppressions'])
+
+    def run(ev_suppressions):
+        migrator.categorize_suppressions(ev_suppressions, data['ev_regions'])
+    return setup, run, len(data['ev_suppressions'])
+
+def get_index_stage(migrator, data):
+    categorized = migrator.categorize_suppressions(copy.deepcopy(data['ev_suppressions']), data['ev_regions'])
+
+    def setup():
+        return categorized
+
+    def run(categorized):
+        migrator.index_suppressions_by_account(categorized)
+    return setup, run, len(data['ev_suppressions'])
+
+# Same loop as plan_migration's Alert Rule phase, without the writes
+def get_plan_stage(migrator, data):
+    account_suppressions = migrator.index_suppressions_by_account(
+        migrator.categorize_suppressions(copy.deepcopy(data['ev_suppressions']), data['ev_regions']))
+    ev_external_account_ids_by_rl_id = {}
+    for external_account_id, ev_external_account in data['ev_external_accounts'].items():
+        ev_external_account_ids_by_rl_id.setdefault(ev_external_account['rl_id'], external_account_id)
+
+    def setup():
+        return None
+
+    def run(argument):
+        universe = migrator.PolicyUniverse(data['rl_policies'])
+        for rl_cloud_account in data['rl_cloud_accounts']:
+            my_ev_regions = data['ev_regions']['aws'] if rl_cloud_account['cloudType'] == 'aws' else data['ev_regions']['azure']
+            external_account_id = ev_external_account_ids_by_rl_id[rl_cloud_account['accountId']]
+            ev_external_account = data['ev_external_accounts'][external_account_id]
+            account_group = data['account_groups'][ev_external_account['team_name']]
+            migrator.plan_account_alert_rules(rl_cloud_account, ev_external_account, external_account_id, account_group,
+                                              my_ev_regions, universe, account_suppressions.get(external_account_id, migrator.no_suppressions))
+    return setup, run, len(data['rl_cloud_accounts'])
+
+# APIAuth headers of one Evident GET per External Account, as the collectors send them
+def get_sign_stage(migrator, data):
+    urls = ['/api/v2/external_accounts/%s?include=credentials' % external_account_id
+            for external_account_id in data['ev_external_accounts']]
+
+    def setup():
+        return None
+
+    def run(argument):
+        for url in urls:
+            migrator.get_ev_headers('GET', url, '')
+    return setup, run, len(urls)
+
+microbenchmark_stages = [
+    ('get_ev_headers', get_sign_stage),
+    ('categorize_suppressions', get_categorize_stage),
+    ('index_suppressions_by_account', get_index_stage),
+    ('plan_account_alert_rules', get_plan_stage)
+]
+
+#=== End Stages ===
+
+#=== Measurements ===
+
+# Best ops/sec of `repeat` runs, then the allocations of one more run
+def measure_stage(setup, run, ops, repeat):
+    best = None
+    for i in range(repeat):
+        argument = setup()
+        started_at = time.perf_counter()
+        run(argument)
+        elapsed = time.perf_counter() - started_at
+        if best is None or elapsed < best:
+            best = elapsed
+
+    argument = setup()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    run(argument)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ops': ops,
+        'seconds': best,
+        'ops_per_sec': ops / best if best > 0 else float('inf'),
+        'peak_bytes': peak - before,
+        'retained_bytes': current - before
+    }
+
+# Run every stage for every size, in the order they are listed.  Stage output goes to /dev/null.
+def run_microbenchmarks(migrator, sizes, repeat, seed):
+    results = {}
+    for size_name in sizes:
+        data = get_synthetic_data(migrator, microbenchmark_sizes[size_name], seed)
+        migrator.signature_policy_mapping = data['signature_policy_mapping']
+        migrator.global_signature_ids = data['global_signature_ids']
+        for stage_name, get_stage in microbenchmark_stages:
+            with open(os.devnull, 'w') as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    setup, run, ops = get_stage(migrator, data)
+                    results['%s/%s' % (stage_name, size_name)] = measure_stage(setup, run, ops, repeat)
+    return results
+
+# Throughput change against the baseline, as a fraction, of every stage the baseline has
+def compare_to_baseline(results, baseline):
+    changes = {}
+    for key, result in results.items():
+        if key in baseline:
+            changes[key] = result['ops_per_sec'] / baseline[key]['ops_per_sec'] - 1
+    return changes
+
+def print_microbenchmark_results(results, changes):
+    print("%-45s %8s %12s %10s %12s %9s" % ('Stage', 'Ops', 'Ops/sec', 'Peak KB', 'Retained KB', 'Change'))
+    for key, result in results.items():
+        change = '-' if key not in changes else '%+.1f%%' % (changes[key] * 100)
+        print("%-45s %8d %12.0f %10.1f %12.1f %9s" % (key, result['ops'], result['ops_per_sec'],
+                                                     result['peak_bytes'] / 1024.0, result['retained_bytes'] / 1024.0, change))
+
+#=== End Measurements ===
+
+# === Begin Main Script ===
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmark the suppression categorization and Alert Rule planning stages of asset_migrator.py.')
+    parser.add_argument('--sizes', type=lambda text: text.split(','), default=list(microbenchmark_sizes),
+                        help='comma-separated sizes out of %s (default: all)' % ', '.join(microbenchmark_sizes))
+    parser.add_argument('--repeat', type=int, default=5, help='runs per stage, the fastest one counts (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--baseline', metavar='FILE', help='compare throughput with a baseline saved by --save-baseline')
+    parser.add_argument('--threshold', type=float, default=microbenchmark_threshold,
+                        help='max throughput drop against the baseline, as a fraction (default: %.2f)' % microbenchmark_threshold)
+    parser.add_argument('--save-baseline', metavar='FILE', help='save the results as a baseline to FILE')
+    parser.add_argument('--migrator', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asset_migrator.py'),
+                        help='path of asset_migrator.py')
+    args = parser.parse_args()
+    for size_name in args.sizes:
+        if size_name not in microbenchmark_sizes:
+            parser.error("unknown size %s" % size_name)
+
+    migrator = load_migrator(args.migrator, {})
+    results = run_microbenchmarks(migrator, args.sizes, args.repeat, args.seed)
+
+    changes = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            changes = compare_to_baseline(results, json.load(f))
+    print_microbenchmark_results(results, changes)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    regressions = [key for key, change in changes.items() if change < -args.threshold]
+    if regressions:
+        print("Throughput regressed more than %.0f%%: %s" % (args.threshold * 100, ', '.join(sorted(regressions))))
+        sys.exit(1)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from migrator_loader import load_migrator, parse_config_override
+
+#=== Description ===
+# Migrate many Evident organizations to many RedLock tenants in one run.  Every tenant of the
+# tenants file is migrated by asset_migrator.py in a worker process of its own, with a fresh copy
+# of the migrator, so RedLock tokens, rate limiters, connection pools, caches and stats are never
+# shared between tenants.  Up to --workers tenants (default: one per CPU) are migrated at once.
+#
+# The tenants file is a JSON list of asset_migrator.py config overrides, each with a unique "name":
+#   [{"name": "acme", "evident_public_key": "...", "evident_secret_key": "...",
+#     "redlock_username": "...", "redlock_password": "...", "redlock_tenant": "Acme",
+#     "redlock_api_base": "https://api2.redlock.io"}, ...]
+#
+# Each tenant runs in its own directory under --work-dir, so relative paths of the config
+# (checkpoint_path, ev_cache_path, profile_dir, telemetry_trace_path) are per tenant.  The
+# migrator output goes to asset_migrator.log in that directory.  A combined summary of every
+# tenant is printed at the end, and the exit code is 1 when any tenant failed.
+#
+# Run command: `python3 migrate_tenants.py tenants.json`, then for example
+# `python3 migrate_tenants.py tenants.json --resume --tenant acme` to finish a failed tenant
+#=== End Description ===
+
+#=== Configuration ===
+
+# Directory with one working directory per tenant
+tenants_work_dir = 'asset_migrator_tenants'
+
+# Checkpoint of every tenant that doesn't set checkpoint_path, in its directory, so failed
+# tenants can be finished with --resume
+tenant_checkpoint_path = 'asset_migrator_checkpoint.sqlite'
+
+# Credentials every tenant must set, asset_migrator.py only has placeholders for them.
+# redlock_tenant is optional: without it, RedLock logs in to the user's default tenant.
+tenant_required_keys = ['evident_public_key', 'evident_secret_key', 'redlock_username', 'redlock_password']
+
+#=== End Configuration ===
+
+#=== Tenant Methods ===
+
+# Read and check the tenants file.  Returns a list of (name, config overrides)
+def read_tenants(path):
+    with open(path) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError('%s must hold a JSON list of tenants' % path)
+
+    tenants = []
+    for number, entry in enumerate(entries, 1):
+        overrides = dict(entry)
+        name = overrides.pop('name', None)
+        if not name or not re.match(r'^[A-Za-z0-9_.-]+$', name):
+            raise ValueError('tenant %d needs a "name" made of letters, digits, ".", "_" and "-"' % number)
+        if name in [tenant[0] for tenant in tenants]:
+            raise ValueError('tenant name %s is used twice' % name)
+        missing = [key for key in tenant_required_keys if key not in overrides]
+        if missing:
+            raise ValueError('tenant %s does not set %s' % (name, ', '.join(missing)))
+        tenants.append((name, overrides))
+    return tenants
+
+# Helper method - calls, retries and failures per API, over every endpoint
+def get_request_totals(endpoint_stats):
+    totals = {}
+    for api, endpoints in endpoint_stats.items():
+        api_totals = totals.setdefault(api, {'calls': 0, 'retries': 0, 'failures': 0})
+        for endpoint in endpoints.values():
+            for counter in api_totals:
+                api_totals[counter] += endpoint[counter]
+    return totals
+
+# Worker process: migrate one tenant in its own directory.  Returns its summary row
+def migrate_tenant(name, overrides, migrator_path, work_dir, resume):
+    tenant_dir = os.path.join(work_dir, name)
+    if not os.path.isdir(tenant_dir):
+        os.makedirs(tenant_dir)
+    os.chdir(tenant_dir)
+    log_path = os.path.join(tenant_dir, 'asset_migrator.log')
+
+    row = {'name': name, 'log': log_path, 'errors': [], 'results': {}, 'writes': {}, 'requests': {}}
+    started_at = time.time()
+    with open(log_path, 'w') as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            try:
+                if resume and not overrides['checkpoint_path']:
+                    raise ValueError('--resume needs checkpoint_path to be set')
+                migrator = load_migrator(migrator_path, overrides)
+                row['results'] = migrator.run_migration(resume=resume)
+                row['writes'] = migrator.get_rl_write_totals(row['results'])
+                row['errors'] = migrator.stats['errors']
+                row['requests'] = get_request_totals(migrator.endpoint_stats)
+            # A sys.exit() in the migrator ends this tenant only, not the whole pool
+            except (Exception, SystemExit) as e:
+                row['errors'].append('%s: %s' % (type(e).__name__, e))
+    row['wall_time'] = time.time() - started_at
+    row['status'] = 'failed' if row['errors'] or row['writes'].get('failed') else 'completed'
+    return row
+
+# Migrate every tenant on a pool of `workers` processes.  Returns the summary rows, in tenant order
+def migrate_tenants(tenants, migrator_path, work_dir, resume, workers):
+    # Spawned, so every tenant starts from a clean interpreter instead of a copy of this one
+    context = multiprocessing.get_context('spawn')
+    rows = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {}
+        for name, overrides in tenants:
+            future = executor.submit(migrate_tenant, name, overrides, migrator_path, work_dir, resume)
+            futures[future] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                row = future.result()
+            except (Exception, SystemExit) as e:
+                # The worker process itself died
+                row = {'name': name, 'status': 'failed', 'errors': ['%s: %s' % (type(e).__name__, e)],
+                       'wall_time': 0.0, 'writes': {}, 'results': {}, 'requests': {}, 'log': None}
+            rows[name] = row
+            print("Tenant %s %s in %.1f seconds (%d of %d)." % (name, row['status'], row['wall_time'], len(rows), len(tenants)))
+            sys.stdout.flush()
+    return [rows[name] for name, overrides in tenants]
+
+# Print one line per tenant, the totals and the errors of failed tenants
+def print_tenant_summary(rows, wall_time):
+    print("%-24s %-10s %10s %10s %10s %9s  %s" % ('Tenant', 'Status', 'Wall (s)', 'Evident', 'RedLock', 'Failures', 'Writes'))
+    totals = {'writes': {}, 'evident': 0, 'redlock': 0, 'failures': 0}
+    for row in rows:
+        requests = row['requests']
+        evident = requests.get('evident', {}).get('calls', 0)
+        redlock = requests.get('redlock', {}).get('calls', 0)
+        failures = sum(api_totals['failures'] for api_totals in requests.values())
+        writes = ', '.join('%d %s' % (row['writes'][outcome], outcome) for outcome in sorted(row['writes']))
+        print("%-24s %-10s %10.1f %10d %10d %9d  %s" % (row['name'], row['status'], row['wall_time'], evident, redlock, failures, writes or 'none'))
+
+        totals['evident'] += evident
+        totals['redlock'] += redlock
+        totals['failures'] += failures
+        for outcome, count in row['writes'].items():
+            totals['writes'][outcome] = totals['writes'].get(outcome, 0) + count
+
+    writes = ', '.join('%d %s' % (totals['writes'][outcome], outcome) for outcome in sorted(totals['writes']))
+    print("%-24s %-10s %10.1f %10d %10d %9d  %s" % ('Total', '', wall_time, totals['evident'], totals['redlock'], totals['failures'], writes or 'none'))
+
+    failed = [row for row in rows if row['status'] != 'completed']
+    print("%d of %d tenants completed." % (len(rows) - len(failed), len(rows)))
+    for row in failed:
+        print("-- %s: %s (log: %s)" % (row['name'], '; '.join(row['errors']) or 'failed writes', row['log']))
+
+#=== End Tenant Methods ===
+
+# === Begin Main Script ===
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate many Evident organizations to RedLock tenants, one asset_migrator.py process per tenant.')
+    parser.add_argument('tenants', help='JSON list of per-tenant asset_migrator.py config overrides, each with a "name"')
+    parser.add_argument('--tenant', dest='names', metavar='NAME', action='append',
+                        help='only migrate this tenant (repeatable)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='tenants migrated at once (default: number of CPUs)')
+    parser.add_argument('--set', dest='overrides', metavar='KEY=VALUE', type=parse_config_override, action='append', default=[],
+                        help='asset_migrator.py config override for every tenant, VALUE is JSON (e.g. --set dry_run=false)')
+    parser.add_argument('--work-dir', default=tenants_work_dir, help='directory with one working directory per tenant (default: %s)' % tenants_work_dir)
+    parser.add_argument('--resume', action='store_true', help='finish interrupted runs from their checkpoints')
+    parser.add_argument('--migrator', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asset_migrator.py'),
+                        help='path of asset_migrator.py')
+    parser.add_argument('--json', metavar='FILE', help='also write the summary, with per-type write results, to FILE')
+    args = parser.parse_args()
+
+    try:
+        tenants = read_tenants(args.tenants)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.names:
+        unknown = [name for name in args.names if name not in [tenant[0] for tenant in tenants]]
+        if unknown:
+            parser.error("unknown tenant %s" % ', '.join(unknown))
+        tenants = [tenant for tenant in tenants if tenant[0] in args.names]
+
+    # Overrides of the command line apply to every tenant, the tenant's own settings win
+    for name, overrides in tenants:
+        for key, value in reversed(args.overrides):
+            overrides.setdefault(key, value)
+        overrides.setdefault('checkpoint_path', tenant_checkpoint_path)
+
+    workers = max(1, min(args.workers, len(tenants)))
+    print("Migrating %d tenants, %d at a time." % (len(tenants), workers))
+    started_at = time.time()
+    rows = migrate_tenants(tenants, os.path.abspath(args.migrator), os.path.abspath(args.work_dir), args.resume, workers)
+    print_tenant_summary(rows, time.time() - started_at)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2, sort_keys=True)
+    if any(row['status'] != 'completed' for row in rows):
+        sys.exit(1)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+from __future__ import print_function
+
+import argparse
+import json
+import re
+import types
+
+#=== Description ===
+# Load asset_migrator.py as a module, with config overrides, for the scripts that run it
+# (migrate_tenants.py, benchmark.py and microbenchmark.py).
+#
+# asset_migrator.py is configured by editing its config, and its credentials are <placeholders>
+# until then, so it can't be imported as-is.  load_migrator() replaces the placeholders with None,
+# so credentials that are not overridden stay unset, applies the overrides at the end of the
+# Configuration section (before the rate limiter, signer and connection pools are built from it)
+# and runs the source as a module.  Every call returns a fresh copy, with state of its own.
+#=== End Description ===
+
+#=== Loader Methods ===
+
+# Load a fresh copy of asset_migrator.py, with config_overrides applied to its config
+def load_migrator(path, config_overrides):
+    with open(path) as f:
+        source = f.read()
+
+    # Credentials still set to <placeholders> would be a syntax error
+    source = re.sub(r"(?<=: )<([a-z ]+)>(?=,)", 'None', source)
+    marker = '#=== End Configuration ==='
+    if marker not in source:
+        raise ValueError('%s has no "%s" line to apply the config overrides at' % (path, marker))
+    source = source.replace(marker, 'config.update(config_overrides)\n' + marker, 1)
+
+    migrator = types.ModuleType('asset_migrator')
+    migrator.__file__ = path
+    migrator.config_overrides = config_overrides
+    exec(compile(source, path, 'exec'), migrator.__dict__)
+    return migrator
+
+# Helper method - parse a --set key=value config override, value being JSON (or a plain string)
+def parse_config_override(text):
+    if '=' not in text:
+        raise argparse.ArgumentTypeError('expected key=value, got %s' % text)
+    key, value = text.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+#=== End Loader Methods ===
@@ -0,0 +1,975 @@
+#!/usr/bin/env python3
+from __future__ import print_function
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode, unquote
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from hashlib import sha1
+from hashlib import md5
+
+import argparse
+import base64
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+#=== Description ===
+# Local stand-ins for the Evident and RedLock APIs used by asset_migrator.py, so the migrator can be
+# benchmarked and regression-tested without live tenants.  See benchmark.py.
+#
+# The Evident simulator serves a synthetic organization over the JSON:API endpoints the migrator
+# reads (organizations, teams, users, external_accounts and their credentials/team/disabled_signatures,
+# regions, suppressions and signatures), with pagination links and include= side-loading.  Every
+# request must carry a valid APIAuth HMAC signature.
+# The RedLock simulator serves /login, /auth_token/extend, /cloud, /cloud/group, /user, /user/role,
+# /policy and /alert/rule, and keeps the objects the migrator creates, updates and deletes.
+#
+# Both can add latency and inject 429 (rate limit) and 503 (failure) responses at a given rate.
+# GET /_simulator/stats returns the request counters of a simulator; it is never delayed or failed.
+#
+# Run command: `python3 simulators.py --accounts 1000`, then point evident_api_base and
+# redlock_api_base (and the credentials) of asset_migrator.py at the printed URLs.
+#=== End Description ===
+
+#=== Configuration ===
+
+simulator_defaults = {
+    # Synthetic organization size.  Teams, users and suppressions default to a share of the accounts
+    'accounts': 100,
+    'teams': None,
+    'users': None,
+    'suppressions': None,
+    # -- Cloud Accounts that only exist in RedLock
+    'rl_only_accounts': None,
+    # -- Organizations the Evident key sees.  More than one is an Evident role user, which the migrator refuses
+    'organizations': 1,
+    # -- Evident signature IDs to draw from (default: 1 to 300)
+    'signature_ids': None,
+    # -- RedLock policies, starting with policy_ids when given
+    'policies': 1000,
+    'policy_ids': None,
+    # -- Seed of the synthetic data and of the injected errors
+    'seed': 0,
+
+    # Credentials the simulators accept
+    'evident_public_key': 'simulator-public-key',
+    'evident_secret_key': 'simulator-secret-key',
+    'redlock_username': 'simulator@example.com',
+    'redlock_password': 'simulator',
+    'redlock_tenant': 'Simulator',
+    # -- Seconds a RedLock session token is valid for
+    'token_ttl': 600,
+    # -- Max age (in seconds) of the Date header of a signed Evident request
+    'max_clock_skew': 900,
+
+    # Seconds added to every request, randomized by +/- latency_jitter (a fraction of latency)
+    'latency': 0.0,
+    'latency_jitter': 0.5,
+    # Share of requests answered with 429, and the Retry-After (in seconds) sent with them
+    'throttle_rate': 0.0,
+    'retry_after': 1,
+    # Share of requests answered with 503
+    'failure_rate': 0.0,
+
+    # Listen address.  Port 0 picks a free port
+    'host': '127.0.0.1',
+    'evident_port': 0,
+    'redlock_port': 0
+}
+
+# Evident region ID -> (provider, code).  Region 9 is the global region, as in Evident
+ev_regions = {
+    '1': ('amazon', 'us_east_1'),
+    '2': ('amazon', 'us_west_1'),
+    '3': ('amazon', 'us_west_2'),
+    '4': ('amazon', 'eu_west_1'),
+    '5': ('amazon', 'eu_central_1'),
+    '6': ('amazon', 'ap_southeast_1'),
+    '7': ('amazon', 'ap_northeast_1'),
+    '8': ('amazon', 'sa_east_1'),
+    '9': ('amazon', 'global'),
+    '10': ('amazon', 'us_east_2'),
+    '11': ('amazon', 'ca_central_1'),
+    '12': ('amazon', 'eu_west_2'),
+    '20': ('azure', 'eastus'),
+    '21': ('azure', 'westus'),
+    '22': ('azure', 'northeurope'),
+    '23': ('azure', 'westeurope')
+}
+
+#=== End Configuration ===
+
+#=== Synthetic Organization ===
+
+# Evident organization and RedLock tenant data, generated from a seed so every run serves the same org.
+# Every External Account has a Team and a matching RedLock Cloud Account; suppressions only cover
+# AWS accounts and regions, like the ones the migrator plans Alert Rules from.
+class SyntheticOrg(object):
+    def __init__(self, options):
+        rand = random.Random(options['seed'])
+        accounts = options['accounts']
+        team_count = options['teams'] or max(1, accounts // 20)
+        user_count = options['users'] or max(5, accounts // 4)
+        suppression_count = options['suppressions']
+        if suppression_count is None:
+            suppression_count = max(1, accounts // 10)
+        rl_only_accounts = options['rl_only_accounts']
+        if rl_only_accounts is None:
+            rl_only_accounts = accounts // 20
+        signature_ids = options['signature_ids'] or [str(i) for i in range(1, 301)]
+        self.policy_ids = list(options['policy_ids'] or [])
+        while len(self.policy_ids) < options['policies']:
+            self.policy_ids.append(str(uuid.UUID(int=rand.getrandbits(128))))
+
+        self.teams = []
+        for i in range(1, team_count + 1):
+            self.teams.append({'id': str(i), 'name': 'Team %d' % i, 'external_account_ids': []})
+
+        self.external_accounts = []
+        for i in range(1, accounts + 1):
+            team = self.teams[(i - 1) % team_count]
+            if i % 10 == 0:
+                provider = 'azure'
+                rl_id = str(uuid.UUID(int=rand.getrandbits(128)))
+            else:
+                provider = 'amazon'
+                rl_id = '%012d' % (100000000000 + i)
+            disabled_signature_ids = []
+            if rand.random() < 0.3:
+                disabled_signature_ids = rand.sample(signature_ids, min(len(signature_ids), rand.randint(1, 3)))
+            self.external_accounts.append({
+                'id': str(i),
+                'name': 'Account %d' % i,
+                'provider': provider,
+                'rl_id': rl_id,
+                'team_id': team['id'],
+                'disabled_signature_ids': disabled_signature_ids
+            })
+            team['external_account_ids'].append(str(i))
+
+        # First user is the organization manager, a few more are organization level, the rest belong to teams
+        self.users = []
+        for i in range(1, user_count + 1):
+            if i == 1 or i % 20 == 0:
+                access_level = 'organization_level'
+                team_ids = []
+            else:
+                access_level = 'team_level'
+                team_ids = [self.teams[(i - 1) % team_count]['id']]
+                if i % 7 == 0:
+                    team_ids.append(self.teams[i % team_count]['id'])
+                if i % 50 == 0:
+                    team_ids = []
+            self.users.append({
+                'id': str(i),
+                'first_name': 'First%d' % i,
+                'last_name': 'Last%d' % i,
+                'email': 'user%d@example.com' % i,
+                'access_level': access_level,
+                'time_zone': 'Pacific Time (US & Canada)',
+                'role_id': 2 if i == 1 or i % 3 == 0 else 3,
+                'team_ids': sorted(set(team_ids))
+            })
+
+        aws_region_ids = [region_id for region_id, region in ev_regions.items() if region[0] == 'amazon']
+        aws_account_ids = [account['id'] for account in self.external_accounts if account['provider'] == 'amazon']
+        self.suppressions = []
+        for i in range(1, suppression_count + 1):
+            kind = rand.random()
+            if kind < 0.1:
+                # Resource suppression, ignored by the migrator
+                resource = 'arn:aws:s3:::bucket-%d' % i
+                region_ids, signature_ids_2 = [], []
+            else:
+                resource = ''
+                region_ids = rand.sample(aws_region_ids, rand.randint(1, len(aws_region_ids)))
+                signature_ids_2 = []
+                if kind > 0.4:
+                    signature_ids_2 = rand.sample(signature_ids, min(len(signature_ids), rand.randint(1, 3)))
+            account_ids = []
+            if aws_account_ids:
+                account_ids = rand.sample(aws_account_ids, min(len(aws_account_ids), rand.randint(1, 5)))
+            self.suppressions.append({
+                'id': str(i),
+                'resource': resource,
+                'region_ids': region_ids,
+                'external_account_ids': account_ids,
+                'signature_ids': signature_ids_2
+            })
+        self.signature_ids = signature_ids
+
+        # RedLock side: every Evident account plus some RedLock-only ones, all in the default Account Group
+        self.cloud_accounts = []
+        for account in self.external_accounts:
+            cloud_type = 'aws' if account['provider'] == 'amazon' else 'azure'
+            self.cloud_accounts.append({'accountId': account['rl_id'], 'name': account['name'], 'cloudType': cloud_type})
+        for i in range(1, rl_only_accounts + 1):
+            self.cloud_accounts.append({'accountId': '%012d' % (200000000000 + i), 'name': 'RedLock Account %d' % i, 'cloudType': 'aws'})
+
+#=== End Synthetic Organization ===
+
+#=== Simulator Server ===
+
+# Helper method - the endpoint a request is counted under, with IDs templated out
+# Example: /api/v2/external_accounts/12/credentials?page[size]=100 -> /api/v2/external_accounts/{id}/credentials
+def get_endpoint_path(path):
+    path = urlsplit(path).path
+    segments = []
+    for segment in path.split('/'):
+        if re.search(r'[0-9@]', segment) and not re.match(r'v[0-9]+$', segment):
+            segment = '{id}'
+        segments.append(segment)
+    return '/'.join(segments)
+
+# Request counters, delay and error injection shared by both simulators.  Subclasses route requests.
+class SimulatorApi(object):
+    name = 'simulator'
+
+    def __init__(self, org, options):
+        self.org = org
+        self.options = options
+        self.url = None
+        self.random = random.Random(options['seed'])
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'endpoints': {}, 'statuses': {}, 'throttled': 0, 'failed': 0, 'rejected': 0}
+
+    def record(self, action, path, status):
+        endpoint = '%s %s' % (action, get_endpoint_path(path))
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+            self.stats['statuses'][str(status)] = self.stats['statuses'].get(str(status), 0) + 1
+
+    def count(self, counter):
+        with self.lock:
+            self.stats[counter] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def delay(self):
+        latency = self.options['latency']
+        if latency > 0:
+            jitter = self.options['latency_jitter']
+            time.sleep(latency * self.random.uniform(1 - jitter, 1 + jitter))
+
+    # Returns (status, headers, body) for every request, body being JSON-serializable, bytes or None
+    def respond(self, action, path, headers, body):
+        if action == 'GET' and urlsplit(path).path == '/_simulator/stats':
+            return 200, {}, self.get_stats()
+
+        self.delay()
+        if self.random.random() < self.options['throttle_rate']:
+            self.count('throttled')
+            response = self.throttled()
+        elif self.random.random() < self.options['failure_rate']:
+            self.count('failed')
+            response = 503, {'Content-Type': 'text/html'}, b'<html><body>503 Service Unavailable</body></html>'
+        else:
+            response = self.route(action, path, headers, body)
+        self.record(action, path, response[0])
+        return response
+
+    def throttled(self):
+        return 429, {'Retry-After': str(self.options['retry_after'])}, {'message': 'Too Many Requests'}
+
+    def route(self, action, path, headers, body):
+        raise NotImplementedError()
+
+# Dispatch HTTP requests to the server's SimulatorApi.  Keep-alive, like the real APIs.
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle's algorithm hold the body back
+    disable_nagle_algorithm = True
+
+    def handle_api(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, response_body = self.server.api.respond(self.command, self.path, self.headers, body)
+
+        if response_body is None:
+            response_body = b''
+        elif not isinstance(response_body, bytes):
+            response_body = json.dumps(response_body).encode('UTF-8')
+        self.send_response(status)
+        if 'Content-Type' not in headers:
+            self.send_header('Content-Type', self.server.api.content_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    do_GET = handle_api
+    do_POST = handle_api
+    do_PUT = handle_api
+    do_PATCH = handle_api
+    do_DELETE = handle_api
+
+    # Quiet, a benchmark makes tens of thousands of requests
+    def log_message(self, format, *args):
+        pass
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, api):
+        ThreadingHTTPServer.__init__(self, address, SimulatorHandler)
+        self.api = api
+        api.url = 'http://%s:%d' % (self.server_address[0], self.server_address[1])
+
+#=== End Simulator Server ===
+
+#=== Evident Simulator ===
+
+# Helper method - Content-MD5 of a request body, as the migrator signs it
+def get_content_md5(body):
+    return base64.b64encode(md5(body).digest()).decode()
+
+# Evident JSON:API v2.  Records carry absolute relationship and pagination links, as the real API does,
+# and include= side-loads credentials, teams, external accounts, disabled signatures and suppression
+# relationships into `included`.
+class EvidentApi(SimulatorApi):
+    name = 'evident'
+    content_type = 'application/vnd.api+json'
+
+    def __init__(self, org, options):
+        SimulatorApi.__init__(self, org, options)
+        self.teams = dict((team['id'], team) for team in org.teams)
+        self.external_accounts = dict((account['id'], account) for account in org.external_accounts)
+        self.users = dict((user['id'], user) for user in org.users)
+        self.routes = [
+            (r'/api/v2/organizations', self.get_organizations),
+            (r'/api/v2/teams', self.get_teams),
+            (r'/api/v2/teams/(\w+)/external_accounts', self.get_team_external_accounts),
+            (r'/api/v2/users', self.get_users),
+            (r'/api/v2/users/(\w+)/teams', self.get_user_teams),
+            (r'/api/v2/external_accounts', self.get_external_accounts),
+            (r'/api/v2/external_accounts/(\w+)/credentials', self.get_external_account_credentials),
+            (r'/api/v2/external_accounts/(\w+)/team', self.get_external_account_team),
+            (r'/api/v2/external_accounts/(\w+)/disabled_signatures', self.get_external_account_disabled_signatures),
+            (r'/api/v2/regions', self.get_regions),
+            (r'/api/v2/signatures', self.get_signatures),
+            (r'/api/v2/suppressions', self.get_suppressions)
+        ]
+
+    def error(self, status, title):
+        return status, {}, {'errors': [{'status': str(status), 'title': title}]}
+
+    def throttled(self):
+        return 429, {'Retry-After': str(self.options['retry_after'])}, {'errors': [{'status': '429', 'title': 'Too Many Requests'}]}
+
+    # Check the APIAuth signature: HMAC-SHA1 of "METHOD,content type,Content-MD5,path,Date"
+    def is_signed(self, action, path, headers, body):
+        authorization = headers.get('Authorization', '')
+        match = re.match(r'APIAuth ([^:]+):(.+)$', authorization)
+        if not match or match.group(1) != self.options['evident_public_key']:
+            return False
+        content_md5 = headers.get('Content-MD5', '')
+        if content_md5 != get_content_md5(body):
+            return False
+        try:
+            dated = parsedate_to_datetime(headers.get('Date', ''))
+        except (TypeError, ValueError):
+            return False
+        if abs((datetime.now(timezone.utc) - dated).total_seconds()) > self.options['max_clock_skew']:
+            return False
+
+        key = self.options['evident_secret_key'].encode('UTF-8')
+        # The client signs the path before it is percent-encoded on the wire
+        for signed_path in (path, unquote(path)):
+            canonical = '%s,%s,%s,%s,%s' % (action, headers.get('Content-Type', ''), content_md5, signed_path, headers['Date'])
+            expected = base64.b64encode(hmac.new(key, canonical.encode('UTF-8'), sha1).digest()).decode()
+            if hmac.compare_digest(expected, match.group(2)):
+                return True
+        return False
+
+    def route(self, action, path, headers, body):
+        if not self.is_signed(action, path, headers, body):
+            self.count('rejected')
+            return self.error(401, 'Unauthorized')
+        if action != 'GET':
+            return self.error(405, 'Method Not Allowed')
+
+        parts = urlsplit(path)
+        query = dict(parse_qsl(parts.query))
+        for pattern, handler in self.routes:
+            match = re.match(pattern + '$', parts.path)
+            if match:
+                return handler(parts.path, query, *match.groups())
+        return self.error(404, 'Not Found')
+
+    def link(self, path):
+        return '%s%s' % (self.url, path)
+
+    def get_includes(self, query):
+        return set(include for include in query.get('include', '').split(',') if include)
+
+    # One page of records, with next/last links that keep the rest of the query
+    def get_page(self, path, query, records, included=None):
+        try:
+            size = min(100, max(1, int(query.get('page[size]', 20))))
+            number = max(1, int(query.get('page[number]', 1)))
+        except ValueError:
+            return self.error(400, 'Bad Request')
+        last = max(1, (len(records) + size - 1) // size)
+
+        def page_link(page_number):
+            page_query = dict(query)
+            page_query['page[number]'] = page_number
+            page_query['page[size]'] = size
+            return self.link('%s?%s' % (path, urlencode(sorted(page_query.items()))))
+
+        links = {'self': page_link(number), 'last': page_link(last)}
+        if number < last:
+            links['next'] = page_link(number + 1)
+        document = {'data': records[(number - 1) * size:number * size], 'links': links}
+        if included is not None:
+            document['included'] = included(document['data'])
+        return 200, {}, document
+
+    def team_record(self, team, includes=()):
+        record = {
+            'id': team['id'],
+            'type': 'teams',
+            'attributes': {'name': team['name']},
+            'relationships': {
+                'external_accounts': {'links': {'related': self.link('/api/v2/teams/%s/external_accounts' % team['id'])}}
+            }
+        }
+        if 'external_accounts' in includes:
+            record['relationships']['external_accounts']['data'] = [{'type': 'external_accounts', 'id': account_id} for account_id in team['external_account_ids']]
+        return record
+
+    def credentials_record(self, account):
+        if account['provider'] == 'amazon':
+            attributes = {'account': account['rl_id']}
+        else:
+            attributes = {'subscription_id': account['rl_id']}
+        return {'id': account['id'], 'type': 'credentials', 'attributes': attributes}
+
+    def signature_record(self, signature_id):
+        return {'id': signature_id, 'type': 'signatures', 'attributes': {'identifier': 'SIG-%s' % signature_id}}
+
+    def external_account_record(self, account, includes=()):
+        account_link = '/api/v2/external_accounts/%s' % account['id']
+        record = {
+            'id': account['id'],
+            'type': 'external_accounts',
+            'attributes': {'name': account['name'], 'provider': account['provider']},
+            'relationships': {
+                'credentials': {'links': {'related': self.link(account_link + '/credentials')}},
+                'team': {'links': {'related': self.link(account_link + '/team')}},
+                'disabled_signatures': {'links': {'related': self.link(account_link + '/disabled_signatures')}}
+            }
+        }
+        relationships = record['relationships']
+        if 'credentials' in includes:
+            relationships['credentials']['data'] = {'type': 'credentials', 'id': account['id']}
+        if 'team' in includes:
+            relationships['team']['data'] = {'type': 'teams', 'id': account['team_id']}
+        if 'disabled_signatures' in includes:
+            relationships['disabled_signatures']['data'] = [{'type': 'signatures', 'id': signature_id} for signature_id in account['disabled_signature_ids']]
+        return record
+
+    def user_record(self, user, includes=()):
+        record = {
+            'id': user['id'],
+            'type': 'users',
+            'attributes': {
+                'first_name': user['first_name'],
+                'last_name': user['last_name'],
+                'email': user['email'],
+                'access_level': user['access_level'],
+                'time_zone': user['time_zone']
+            },
+            'relationships': {
+                'role': {'links': {'related': self.link('/api/v2/roles/%d' % user['role_id'])}},
+                'teams': {'links': {'related': self.link('/api/v2/users/%s/teams' % user['id'])}}
+            }
+        }
+        if 'teams' in includes:
+            record['relationships']['teams']['data'] = [{'type': 'teams', 'id': team_id} for team_id in user['team_ids']]
+        return record
+
+    def region_record(self, region_id):
+        provider, code = ev_regions[region_id]
+        return {'id': region_id, 'type': 'regions', 'attributes': {'provider': provider, 'code': code}}
+
+    # Helper method - the distinct included records of a page, in order
+    def unique(self, records):
+        seen = set()
+        unique = []
+        for record in records:
+            if (record['type'], record['id']) not in seen:
+                seen.add((record['type'], record['id']))
+                unique.append(record)
+        return unique
+
+    # A user with the Evident role sees more than one organization, the migrator refuses to run then
+    def get_organizations(self, path, query):
+        organizations = [{'id': str(number), 'type': 'organizations', 'attributes': {'name': 'Simulated Organization %d' % number}}
+                         for number in range(1, self.options['organizations'] + 1)]
+        return 200, {}, {'data': organizations}
+
+    def get_teams(self, path, query):
+        includes = self.get_includes(query)
+        records = [self.team_record(team, includes) for team in self.org.teams]
+
+        def included(page):
+            if 'external_accounts' not in includes:
+                return []
+            return [self.external_account_record(self.external_accounts[ref['id']])
+                    for record in page for ref in record['relationships']['external_accounts']['data']]
+        return self.get_page(path, query, records, included)
+
+    def get_team_external_accounts(self, path, query, team_id):
+        if team_id not in self.teams:
+            return self.error(404, 'Not Found')
+        records = [self.external_account_record(self.external_accounts[account_id]) for account_id in self.teams[team_id]['external_account_ids']]
+        return self.get_page(path, query, records)
+
+    def get_users(self, path, query):
+        includes = self.get_includes(query)
+        records = [self.user_record(user, includes) for user in self.org.users]
+
+        def included(page):
+            if 'teams' not in includes:
+                return []
+            return self.unique([self.team_record(self.teams[ref['id']])
+                                for record in page for ref in record['relationships']['teams']['data']])
+        return self.get_page(path, query, records, included)
+
+    def get_user_teams(self, path, query, user_id):
+        if user_id not in self.users:
+            return self.error(404, 'Not Found')
+        return self.get_page(path, query, [self.team_record(self.teams[team_id]) for team_id in self.users[user_id]['team_ids']])
+
+    def get_external_accounts(self, path, query):
+        includes = self.get_includes(query)
+        records = [self.external_account_record(account, includes) for account in self.org.external_accounts]
+
+        def included(page):
+            side_loaded = []
+            for record in page:
+                account = self.external_accounts[record['id']]
+                if 'credentials' in includes:
+                    side_loaded.append(self.credentials_record(account))
+                if 'team' in includes:
+                    side_loaded.append(self.team_record(self.teams[account['team_id']]))
+                if 'disabled_signatures' in includes:
+                    side_loaded.extend(self.signature_record(signature_id) for signature_id in account['disabled_signature_ids'])
+            return self.unique(side_loaded)
+        return self.get_page(path, query, records, included)
+
+    def get_external_account_credentials(self, path, query, account_id):
+        if account_id not in self.external_accounts:
+            return self.error(404, 'Not Found')
+        return 200, {}, {'data': self.credentials_record(self.external_accounts[account_id])}
+
+    def get_external_account_team(self, path, query, account_id):
+        if account_id not in self.external_accounts:
+            return self.error(404, 'Not Found')
+        return 200, {}, {'data': self.team_record(self.teams[self.external_accounts[account_id]['team_id']])}
+
+    def get_external_account_disabled_signatures(self, path, query, account_id):
+        if account_id not in self.external_accounts:
+            return self.error(404, 'Not Found')
+        signature_ids = self.external_accounts[account_id]['disabled_signature_ids']
+        return self.get_page(path, query, [self.signature_record(signature_id) for signature_id in signature_ids])
+
+    def get_regions(self, path, query):
+        return self.get_page(path, query, [self.region_record(region_id) for region_id in ev_regions])
+
+    def get_signatures(self, path, query):
+        return self.get_page(path, query, [self.signature_record(signature_id) for signature_id in self.org.signature_ids])
+
+    # Suppressions always carry their relationship linkage, which the migrator reads directly
+    def get_suppressions(self, path, query):
+        includes = self.get_includes(query)
+        records = []
+        for suppression in self.org.suppressions:
+            records.append({
+                'id': suppression['id'],
+                'type': 'suppressions',
+                'attributes': {'resource': suppression['resource'], 'status': 'active'},
+                'relationships': {
+                    'regions': {'data': [{'type': 'regions', 'id': region_id} for region_id in suppression['region_ids']]},
+                    'external_accounts': {'data': [{'type': 'external_accounts', 'id': account_id} for account_id in suppression['external_account_ids']]},
+                    'signatures': {'data': [{'type': 'signatures', 'id': signature_id} for signature_id in suppression['signature_ids']]},
+                    'custom_signatures': {'data': []}
+                }
+            })
+
+        def included(page):
+            side_loaded = []
+            for record in page:
+                relationships = record['relationships']
+                if 'regions' in includes:
+                    side_loaded.extend(self.region_record(ref['id']) for ref in relationships['regions']['data'])
+                if 'external_accounts' in includes:
+                    side_loaded.extend(self.external_account_record(self.external_accounts[ref['id']]) for ref in relationships['external_accounts']['data'])
+                if 'signatures' in includes:
+                    side_loaded.extend(self.signature_record(ref['id']) for ref in relationships['signatures']['data'])
+            return self.unique(side_loaded)
+        return self.get_page(path, query, records, included)
+
+#=== End Evident Simulator ===
+
+#=== RedLock Simulator ===
+
+# RedLock API.  Account Groups, User Roles, Users and Alert Rules live in memory, so a benchmark
+# sees the effect of its own writes (and a second run sees the first run's objects).
+class RedLockApi(SimulatorApi):
+    name = 'redlock'
+    content_type = 'application/json'
+
+    def __init__(self, org, options):
+        SimulatorApi.__init__(self, org, options)
+        self.tokens = {}
+        self.next_id = 1
+        self.cloud_accounts = org.cloud_accounts
+        self.account_groups = {}
+        self.user_roles = {}
+        self.users = {}
+        self.alert_rules = {}
+
+        default_group = self.add(self.account_groups, 'id', {
+            'name': 'Default Account Group',
+            'description': 'Default account group',
+            'accountIds': [account['accountId'] for account in self.cloud_accounts]
+        })
+        self.add(self.user_roles, 'id', {'name': 'System Admin', 'description': 'Default role', 'roleType': 'System Admin', 'accountGroupIds': []})
+        admin_role = list(self.user_roles.values())[0]
+        self.users[options['redlock_username']] = {
+            'email': options['redlock_username'],
+            'firstName': 'Simulator',
+            'lastName': 'Admin',
+            'timeZone': 'America/Los_Angeles',
+            'roleId': admin_role['id']
+        }
+        self.add(self.alert_rules, 'policyScanConfigId', {
+            'name': 'Default Alert Rule',
+            'description': 'Default alert rule',
+            'enabled': True,
+            'scanAll': True,
+            'policies': [],
+            'target': {'accountGroups': [default_group['id']], 'excludedAccounts': [], 'regions': [], 'tags': []}
+        })
+
+        self.routes = [
+            ('POST', r'/login', self.login),
+            ('GET', r'/auth_token/extend', self.extend_token),
+            ('POST', r'/auth_token/extend', self.extend_token),
+            ('GET', r'/cloud', self.get_cloud_accounts),
+            ('GET', r'/cloud/group', self.get_account_groups),
+            ('POST', r'/cloud/group', self.create_account_group),
+            ('PUT', r'/cloud/group/([^/]+)', self.update_account_group),
+            ('DELETE', r'/cloud/group/([^/]+)', self.delete_account_group),
+            ('GET', r'/user/role', self.get_user_roles),
+            ('GET', r'/user/role/name', self.get_user_role_names),
+            ('POST', r'/user/role', self.create_user_role),
+            ('PUT', r'/user/role/([^/]+)', self.update_user_role),
+            ('DELETE', r'/user/role/([^/]+)', self.delete_user_role),
+            ('GET', r'/user', self.get_users),
+            ('GET', r'/user/name', self.get_user_names),
+            ('POST', r'/user', self.create_user),
+            ('PUT', r'/user/([^/]+)', self.update_user),
+            ('DELETE', r'/user/([^/]+)', self.delete_user),
+            ('GET', r'/policy', self.get_policies),
+            ('GET', r'/alert/rule', self.get_alert_rules),
+            ('POST', r'/alert/rule', self.create_alert_rule),
+            ('PATCH', r'/alert/rule/([^/]+)/status/(true|false)', self.set_alert_rule_status),
+            ('PUT', r'/alert/rule/([^/]+)', self.update_alert_rule),
+            ('DELETE', r'/alert/rule/([^/]+)', self.delete_alert_rule)
+        ]
+
+    # Errors are explained in the x-redlock-status header, like the real API
+    def error(self, status, subject):
+        status_header = json.dumps([{'i18nKey': subject, 'severity': 'error', 'subject': subject}])
+        return status, {'x-redlock-status': status_header}, None
+
+    def add(self, records, id_field, record):
+        record[id_field] = 'sim-%d' % self.next_id
+        self.next_id += 1
+        records[record[id_field]] = record
+        return record
+
+    def new_token(self):
+        token = uuid.uuid4().hex
+        self.tokens[token] = time.time() + self.options['token_ttl']
+        return token
+
+    def is_authenticated(self, headers):
+        expires_at = self.tokens.get(headers.get('x-redlock-auth', ''))
+        return expires_at is not None and expires_at > time.time()
+
+    def route(self, action, path, headers, body):
+        path = urlsplit(path).path
+        try:
+            data = json.loads(body.decode('UTF-8')) if body else None
+        except ValueError:
+            return self.error(400, 'invalid_param_value')
+
+        for route_action, pattern, handler in self.routes:
+            match = re.match(pattern + '$', path)
+            if route_action == action and match:
+                with self.lock:
+                    if handler != self.login and not self.is_authenticated(headers):
+                        self.stats['rejected'] += 1
+                        return self.error(401, 'invalid_token')
+                    return handler(data, *[unquote(group) for group in match.groups()])
+        return self.error(404, 'not_found')
+
+    def login(self, data):
+        data = data or {}
+        if data.get('username') != self.options['redlock_username'] or data.get('password') != self.options['redlock_password']:
+            return self.error(401, 'invalid_credentials')
+        if data.get('customerName') not in (None, self.options['redlock_tenant']):
+            return self.error(401, 'invalid_customer_name')
+        return 200, {}, {'token': self.new_token(), 'message': 'login_successful', 'customerNames': [{'customerName': self.options['redlock_tenant']}]}
+
+    def extend_token(self, data):
+        return 200, {}, {'token': self.new_token(), 'message': 'login_successful'}
+
+    # Cloud Accounts list the Account Groups they belong to
+    def get_cloud_accounts(self, data):
+        groups = {}
+        for account_group in self.account_groups.values():
+            for account_id in account_group['accountIds']:
+                groups.setdefault(account_id, []).append({'id': account_group['id'], 'name': account_group['name']})
+        cloud_accounts = []
+        for account in self.cloud_accounts:
+            cloud_account = dict(account)
+            cloud_account['enabled'] = True
+            cloud_account['groups'] = groups.get(account['accountId'], [])
+            cloud_accounts.append(cloud_account)
+        return 200, {}, cloud_accounts
+
+    def find_by_name(self, records, name):
+        for record in records.values():
+            if record['name'] == name:
+                return record
+        return None
+
+    def get_account_groups(self, data):
+        return 200, {}, list(self.account_groups.values())
+
+    def create_account_group(self, data):
+        if not data or not data.get('name'):
+            return self.error(400, 'invalid_param_value')
+        if self.find_by_name(self.account_groups, data['name']) is not None:
+            return self.error(400, 'account_group_name_already_exists')
+        record = {'name': data['name'], 'description': data.get('description', ''), 'accountIds': data.get('accountIds', [])}
+        return 200, {}, self.add(self.account_groups, 'id', record)
+
+    def update_account_group(self, data, account_group_id):
+        if account_group_id not in self.account_groups:
+            return self.error(404, 'not_found')
+        self.account_groups[account_group_id].update(data or {})
+        return 200, {}, None
+
+    def delete_account_group(self, data, account_group_id):
+        if self.account_groups.pop(account_group_id, None) is None:
+            return self.error(404, 'not_found')
+        return 200, {}, None
+
+    def get_user_roles(self, data):
+        return 200, {}, list(self.user_roles.values())
+
+    def get_user_role_names(self, data):
+        return 200, {}, [{'id': role['id'], 'name': role['name']} for role in self.user_roles.values()]
+
+    def create_user_role(self, data):
+        if not data or not data.get('name'):
+            return self.error(400, 'invalid_param_value')
+        if self.find_by_name(self.user_roles, data['name']) is not None:
+            return self.error(400, 'user_role_name_already_exists')
+        record = {'name': data['name'], 'description': data.get('description', ''), 'roleType': data.get('roleType'),
+                  'accountGroupIds': data.get('accountGroupIds', [])}
+        return 200, {}, self.add(self.user_roles, 'id', record)
+
+    def update_user_role(self, data, role_id):
+        if role_id not in self.user_roles:
+            return self.error(404, 'not_found')
+        self.user_roles[role_id].update(data or {})
+        return 200, {}, None
+
+    def delete_user_role(self, data, role_id):
+        if self.user_roles.pop(role_id, None) is None:
+            return self.error(404, 'not_found')
+        return 200, {}, None
+
+    def get_users(self, data):
+        return 200, {}, list(self.users.values())
+
+    def get_user_names(self, data):
+        return 200, {}, [{'id': email, 'displayName': '%s %s' % (user['firstName'], user['lastName'])} for email, user in self.users.items()]
+
+    # Users are keyed by email, RedLock answers their creation with an empty body
+    def create_user(self, data):
+        if not data or not data.get('email'):
+            return self.error(400, 'invalid_param_value')
+        if data['email'] in self.users:
+            return self.error(409, 'duplicate_user_name')
+        self.users[data['email']] = dict(data)
+        return 200, {}, None
+
+    def update_user(self, data, email):
+        if email not in self.users:
+            return self.error(404, 'not_found')
+        self.users[email].update(data or {})
+        return 200, {}, None
+
+    def delete_user(self, data, email):
+        if self.users.pop(email, None) is None:
+            return self.error(404, 'not_found')
+        return 200, {}, None
+
+    def get_policies(self, data):
+        return 200, {}, [{'policyId': policy_id, 'name': 'Policy %s' % policy_id, 'enabled': True} for policy_id in self.org.policy_ids]
+
+    def get_alert_rules(self, data):
+        return 200, {}, list(self.alert_rules.values())
+
+    def create_alert_rule(self, data):
+        if not data or not data.get('name'):
+            return self.error(400, 'invalid_param_value')
+        if self.find_by_name(self.alert_rules, data['name']) is not None:
+            return self.error(400, 'name')
+        return 200, {}, self.add(self.alert_rules, 'policyScanConfigId', dict(data))
+
+    def update_alert_rule(self, data, rule_id):
+        if rule_id not in self.alert_rules:
+            return self.error(404, 'not_found')
+        self.alert_rules[rule_id].update(data or {})
+        return 200, {}, None
+
+    def set_alert_rule_status(self, data, rule_id, enabled):
+        if rule_id not in self.alert_rules:
+            return self.error(404, 'not_found')
+        self.alert_rules[rule_id]['enabled'] = enabled == 'true'
+        return 200, {}, None
+
+    def delete_alert_rule(self, data, rule_id):
+        if self.alert_rules.pop(rule_id, None) is None:
+            return self.error(404, 'not_found')
+        return 200, {}, None
+
+#=== End RedLock Simulator ===
+
+#=== Simulators ===
+
+# Both simulators of one synthetic org, each on its own port and serving thread
+class Simulators(object):
+    def __init__(self, **options):
+        self.options = dict(simulator_defaults)
+        for name, value in options.items():
+            if name not in self.options:
+                raise ValueError('Unknown simulator option %s' % name)
+            self.options[name] = value
+        self.org = SyntheticOrg(self.options)
+        self.evident = SimulatorServer((self.options['host'], self.options['evident_port']), EvidentApi(self.org, self.options))
+        self.redlock = SimulatorServer((self.options['host'], self.options['redlock_port']), RedLockApi(self.org, self.options))
+        self.threads = []
+
+    def start(self):
+        for server in (self.evident, self.redlock):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self.evident, self.redlock):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # asset_migrator.py config entries pointing the migrator at these simulators
+    def get_migrator_config(self):
+        return {
+            'evident_api_base': self.evident.api.url,
+            'evident_public_key': self.options['evident_public_key'],
+            'evident_secret_key': self.options['evident_secret_key'],
+            'redlock_api_base': self.redlock.api.url,
+            'redlock_username': self.options['redlock_username'],
+            'redlock_password': self.options['redlock_password'],
+            'redlock_tenant': self.options['redlock_tenant']
+        }
+
+    def get_stats(self):
+        return {'evident': self.evident.api.get_stats(), 'redlock': self.redlock.api.get_stats()}
+
+# Helper method - print request counters of both simulators
+def print_simulator_stats(stats):
+    for api in ('evident', 'redlock'):
+        api_stats = stats[api]
+        print("%s simulator: %d requests, %d throttled, %d failed, %d rejected" % (
+            api.capitalize(), api_stats['requests'], api_stats['throttled'], api_stats['failed'], api_stats['rejected']))
+        for endpoint in sorted(api_stats['endpoints']):
+            print("-- %s: %d" % (endpoint, api_stats['endpoints'][endpoint]))
+
+# Command line options shared with benchmark.py
+def add_simulator_arguments(parser):
+    parser.add_argument('--teams', type=int, help='number of Evident teams (default: accounts / 20)')
+    parser.add_argument('--users', type=int, help='number of Evident users (default: accounts / 4)')
+    parser.add_argument('--suppressions', type=int, help='number of Evident suppressions (default: accounts / 10)')
+    parser.add_argument('--latency', type=float, default=simulator_defaults['latency'], help='seconds added to every request')
+    parser.add_argument('--throttle-rate', type=float, default=simulator_defaults['throttle_rate'], help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=simulator_defaults['retry_after'], help='Retry-After seconds sent with 429 responses')
+    parser.add_argument('--failure-rate', type=float, default=simulator_defaults['failure_rate'], help='share of requests answered with 503')
+    parser.add_argument('--token-ttl', type=float, default=simulator_defaults['token_ttl'], help='seconds a RedLock session token is valid for')
+    parser.add_argument('--seed', type=int, default=simulator_defaults['seed'], help='seed of the synthetic org and injected errors')
+
+# Simulator options from parsed command line arguments
+def get_simulator_options(args):
+    return {
+        'teams': args.teams,
+        'users': args.users,
+        'suppressions': args.suppressions,
+        'latency': args.latency,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after,
+        'failure_rate': args.failure_rate,
+        'token_ttl': args.token_ttl,
+        'seed': args.seed
+    }
+
+#=== End Simulators ===
+
+# === Begin Main Script ===
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic Evident organization and RedLock tenant for asset_migrator.py.')
+    parser.add_argument('--accounts', type=int, default=simulator_defaults['accounts'], help='number of Evident External Accounts')
+    add_simulator_arguments(parser)
+    parser.add_argument('--host', default=simulator_defaults['host'], help='listen address')
+    parser.add_argument('--evident-port', type=int, default=8001, help='Evident simulator port')
+    parser.add_argument('--redlock-port', type=int, default=8002, help='RedLock simulator port')
+    args = parser.parse_args()
+
+    options = get_simulator_options(args)
+    options.update({'accounts': args.accounts, 'host': args.host, 'evident_port': args.evident_port, 'redlock_port': args.redlock_port})
+    simulators = Simulators(**options).start()
+    print("Serving %d accounts.  asset_migrator.py config:" % args.accounts)
+    for name, value in sorted(simulators.get_migrator_config().items()):
+        print("    '%s': '%s'," % (name, value))
+    print("Press Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulators.stop()
+    print_simulator_stats(simulators.get_stats())